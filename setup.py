@@ -41,6 +41,10 @@ setup(
         "markdown_urlize==0.2.0",
         "markupsafe==2.0.1",
     ],
+    extras_require={
+        "brotli": ["brotli>=1.0.0"],
+        "images": ["Pillow>=9.0.0"],
+    },
     setup_requires=["pytest-runner"],
     tests_require=[
         "mock==2.0.0",
@@ -0,0 +1,185 @@
+# Core modules
+import json
+from glob import glob
+from os import path, remove
+from shutil import rmtree
+
+# Third party modules
+import yaml
+from git import Repo
+
+# Local modules
+from ubuntudesign.documentation_builder.benchmarks import (
+    compare_results,
+    format_comparison,
+    generate_corpus,
+    load_results,
+    run_benchmarks,
+    save_results,
+    stages,
+    summarise,
+)
+
+
+fixtures_base = path.join(path.dirname(__file__), 'fixtures')
+
+
+def _read(filepath):
+    with open(filepath) as source_file:
+        return source_file.read()
+
+
+def test_generate_corpus():
+    corpus = path.join(fixtures_base, 'corpus')
+    if path.exists(corpus):
+        rmtree(corpus)
+
+    page_paths = generate_corpus(
+        corpus,
+        pages=20,
+        depth=1,
+        navigation_size=5,
+        code_blocks=3,
+        frontmatter=1,
+        media=4
+    )
+
+    assert len(page_paths) == 20
+    assert sorted(
+        path.relpath(filepath, corpus)
+        for filepath in glob(path.join(corpus, '**/*.md'), recursive=True)
+    ) == sorted(page_paths)
+    assert len(glob(path.join(corpus, 'en', 'topic-*', 'metadata.yaml'))) == 3
+    assert len(glob(path.join(corpus, 'media', '*.png'))) == 4
+
+    with open(path.join(corpus, 'en', 'metadata.yaml')) as metadata_file:
+        navigation = yaml.safe_load(metadata_file)['navigation']
+    assert len(navigation) == 5
+    assert navigation[0]['location'] == 'index.md'
+
+    page = _read(path.join(corpus, page_paths[1]))
+    assert page.startswith('---\ntitle: ')
+    assert page.count('``` python') == 3
+    assert '](../../media/image-1.png)' in page
+
+    # The same seed generates the same corpus
+    generate_corpus(corpus, pages=20, depth=1, frontmatter=0, seed=1)
+    first_page = _read(path.join(corpus, page_paths[1]))
+    generate_corpus(corpus, pages=20, depth=1, frontmatter=0, seed=1)
+
+    assert _read(path.join(corpus, page_paths[1])) == first_page
+    assert not first_page.startswith('---')
+
+    rmtree(corpus)
+
+
+def test_generate_corpus_versions():
+    corpus = path.join(fixtures_base, 'corpus')
+    if path.exists(corpus):
+        rmtree(corpus)
+
+    generate_corpus(corpus, pages=5, depth=0, versions=['latest', '1.0'])
+
+    repo = Repo(corpus)
+    assert sorted(
+        head.name for head in repo.heads if head.name in ['latest', '1.0']
+    ) == ['1.0', 'latest']
+    assert _read(path.join(corpus, 'versions')) == 'latest\n1.0\n'
+    assert repo.git.show('1.0:en/index.md').endswith('This is version 1.0.')
+
+    rmtree(corpus)
+
+
+def test_run_benchmarks():
+    corpus = path.join(fixtures_base, 'corpus')
+    if path.exists(corpus):
+        rmtree(corpus)
+    generate_corpus(corpus, pages=10, depth=1, media=2)
+
+    results = run_benchmarks(corpus, repeat=2)
+
+    assert list(results) == stages
+    for times in results.values():
+        assert len(times) == 2
+        assert all(seconds > 0 for seconds in times)
+
+    # The corpus itself isn't changed
+    assert 'Change 1.' not in _read(path.join(corpus, 'en', 'index.md'))
+
+    rmtree(corpus)
+
+
+def test_run_benchmarks_versions(monkeypatch):
+    corpus = path.join(fixtures_base, 'corpus')
+    cache = path.join(fixtures_base, 'cache')
+    for directory in [corpus, cache]:
+        if path.exists(directory):
+            rmtree(directory)
+    generate_corpus(corpus, pages=5, depth=0, versions=['latest', '1.0'])
+    monkeypatch.setenv('XDG_CACHE_HOME', cache)
+
+    results = run_benchmarks(corpus, repeat=1, build_version_branches=True)
+
+    assert 'build_one_changed' not in results
+    assert results['build_warm'][0] > 0
+
+    # The version branches aren't left cloned in the cache
+    assert glob(path.join(cache, 'documentation-builder', '*')) == []
+
+    rmtree(corpus)
+    if path.exists(cache):
+        rmtree(cache)
+
+
+def test_summarise():
+    assert summarise([3, 1, 2, 6]) == {
+        'median': 2.5,
+        'min': 1,
+        'max': 6,
+        'mad': 1.0,
+    }
+
+
+def test_compare_results():
+    baseline = {
+        'parse_markdown': [1.0, 1.01, 0.99],
+        'write_html': [1.0, 1.01, 0.99],
+        'copy_media': [1.0, 1.01, 0.99],
+        'find_files': [1.0, 1.5, 0.5],
+        'build_cold': [1.0],
+    }
+    results = {
+        'parse_markdown': [1.18, 1.19, 1.17],
+        'write_html': [0.8, 0.81, 0.79],
+        'copy_media': [1.05, 1.06, 1.04],
+        'find_files': [1.3, 1.8, 0.8],
+    }
+
+    comparisons = compare_results(baseline, results, threshold=0.1)
+
+    assert [
+        (comparison['stage'], comparison['status'])
+        for comparison in comparisons
+    ] == [
+        ('find_files', 'unchanged'),
+        ('parse_markdown', 'regressed'),
+        ('write_html', 'improved'),
+        ('copy_media', 'unchanged'),
+    ]
+    assert format_comparison(comparisons[1]) == (
+        'parse_markdown +18% median (1000.00 to 1180.00 ms, noise \u00b13%)'
+    )
+
+
+def test_save_results():
+    results_path = path.join(fixtures_base, 'results.json')
+    results = {'parse_markdown': [0.25, 0.5], 'write_html': [0.75]}
+
+    save_results(results_path, results, {'pages': 10})
+
+    with open(results_path) as results_file:
+        saved = json.load(results_file)
+    assert saved['stages']['parse_markdown']['median'] == 0.375
+    assert load_results(results_path) == (results, {'pages': 10})
+
+    remove(results_path)
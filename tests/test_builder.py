@@ -8,19 +8,27 @@ function of the builder.
 """
 
 # Core modules
+import gzip
+import json
 import re
+import tracemalloc
 from glob import glob
-from os import path, utime
-from shutil import rmtree
+from os import listdir, path, remove, rename, utime
+from shutil import copyfile, copytree, rmtree
 
 # Third party modules
+import pytest
 from bs4 import BeautifulSoup
 from io import StringIO
 from git import Repo
 from pytest import raises
 
 # Local modules
-from ubuntudesign.documentation_builder.builder import Builder
+from ubuntudesign.documentation_builder.builder import (
+    Builder,
+    default_stylesheet,
+)
+from ubuntudesign.documentation_builder.operations import asset_path
 
 
 fixtures_base = path.join(path.dirname(__file__), 'fixtures')
@@ -36,6 +44,71 @@ def test_missing_base():
         )
 
 
+def test_build_result():
+    fixtures = path.join(fixtures_base, 'builder')
+    base = path.join(fixtures, 'base-copy')
+    output = path.join(fixtures, 'output')
+    for directory in [base, output]:
+        if path.exists(directory):
+            rmtree(directory)
+    copytree(path.join(fixtures, 'base'), base)
+
+    builder = Builder(
+        base_directory=base, output_path=output, quiet=True, defer_build=True
+    )
+    parser = builder.parser
+
+    result = builder.build()
+
+    pages = ['en/index.html', 'en/subfolder/nested.html', 'fr/index.html']
+    assert sorted(result['built']) == pages
+    assert result['skipped'] == []
+    assert result['removed'] == []
+    assert result['cache'] == {'fingerprint': 'miss', 'state': 'disk'}
+    assert result['timings']['build_branch'] > 0
+    assert result['timings']['total'] >= sum(
+        seconds for stage, seconds in result['timings'].items()
+        if stage != 'total'
+    )
+
+    # Building again reuses the builder's parser and records
+    result = builder.build()
+
+    assert builder.parser is parser
+    assert result['built'] == []
+    assert result['cache'] == {'fingerprint': 'hit', 'state': 'memory'}
+
+    # Only the files asked for are rebuilt
+    for page in ['index.md', path.join('subfolder', 'nested.md')]:
+        with open(path.join(base, 'en', page), 'a') as page_file:
+            page_file.write('\nMore text\n')
+    remove(path.join(base, 'fr', 'index.md'))
+
+    result = builder.build(files=['en/subfolder/nested.md'])
+
+    assert result['built'] == ['en/subfolder/nested.html']
+    assert result['skipped'] == ['en/index.html']
+    assert result['removed'] == ['fr/index.html']
+    assert result['cache'] == {'fingerprint': 'miss', 'state': 'memory'}
+
+    # A build of some files doesn't count as a build of everything
+    result = builder.build()
+
+    assert result['built'] == ['en/index.html']
+    assert result['skipped'] == ['en/subfolder/nested.html']
+
+    # Once the output folder is deleted, everything is built again
+    rmtree(output)
+    result = builder.build()
+
+    assert result['built'] == ['en/index.html', 'en/subfolder/nested.html']
+    assert result['cache'] == {'fingerprint': 'miss', 'state': 'disk'}
+    assert path.isfile(path.join(output, 'media', 'image.png'))
+
+    rmtree(base)
+    rmtree(output)
+
+
 def test_no_metadata():
     base = path.join(fixtures_base, 'builder', 'no-metadata')
     output = path.join(fixtures_base, 'builder', 'output')
@@ -138,6 +211,1229 @@ def test_basic_build():
     rmtree(output)
 
 
+def test_identical_output_not_rewritten():
+    fixtures = path.join(fixtures_base, 'builder')
+    base = path.join(fixtures, 'base')
+    metadata = path.join(base, 'metadata.yaml')
+    output = path.join(fixtures, 'output')
+    index = path.join(output, 'en', 'index.html')
+    if path.exists(output):
+        rmtree(output)
+
+    Builder(base_directory=base, output_path=output, quiet=True)
+
+    # Touching the metadata rebuilds every page...
+    past = 1000000000
+    metadata_mtime = path.getmtime(metadata)
+    utime(index, (past, past))
+    utime(metadata, None)
+    mock_out = StringIO()
+    Builder(base_directory=base, output_path=output, out=mock_out)
+    utime(metadata, (metadata_mtime, metadata_mtime))
+
+    # ...but identical pages aren't rewritten
+    assert path.getmtime(index) == past
+    assert 'not rewritten:\n- {}'.format(index) in mock_out.getvalue()
+
+    # And pages aren't rebuilt again afterwards
+    mock_out = StringIO()
+    Builder(base_directory=base, output_path=output, out=mock_out)
+    assert 'Skipping unmodified files' in mock_out.getvalue()
+    assert 'not rewritten' not in mock_out.getvalue()
+
+    rmtree(output)
+
+
+def test_change_manifest():
+    fixtures = path.join(fixtures_base, 'builder')
+    base = path.join(fixtures, 'base-copy')
+    output = path.join(fixtures, 'output')
+    manifest_path = path.join(fixtures, 'output-manifest.json')
+    for directory in [base, output]:
+        if path.exists(directory):
+            rmtree(directory)
+    copytree(path.join(fixtures, 'base'), base)
+
+    def build_manifest():
+        Builder(
+            base_directory=base,
+            output_path=output,
+            manifest_path=manifest_path,
+            quiet=True
+        )
+        with open(manifest_path) as manifest_file:
+            return json.load(manifest_file)
+
+    # Everything is new in the first build
+    manifest = build_manifest()
+    added = {entry['path']: entry for entry in manifest['added']}
+    assert sorted(added.keys()) == [
+        asset_path(default_stylesheet, 'css'),
+        'en/index.html',
+        'en/subfolder/nested.html',
+        'fr/index.html',
+        'media/image.png',
+        'media/subfolder/document.pdf',
+    ]
+    assert added['media/image.png']['size'] == path.getsize(
+        path.join(base, 'media', 'image.png')
+    )
+    assert len(added['en/index.html']['hash']) == 64
+    assert manifest['changed'] == []
+    assert manifest['removed'] == []
+
+    # Only pages whose output changed are listed
+    with open(path.join(base, 'fr', 'index.md'), 'a') as page:
+        page.write('\nUne nouvelle ligne.\n')
+    utime(path.join(base, 'metadata.yaml'), None)
+    manifest = build_manifest()
+    assert manifest['added'] == []
+    assert [entry['path'] for entry in manifest['changed']] == [
+        'fr/index.html'
+    ]
+
+    rmtree(output)
+    rmtree(base)
+    remove(manifest_path)
+
+
+def test_prune_orphaned_outputs():
+    fixtures = path.join(fixtures_base, 'builder')
+    base = path.join(fixtures, 'base-copy')
+    output = path.join(fixtures, 'output')
+    manifest_path = path.join(fixtures, 'output-manifest.json')
+    for directory in [base, output]:
+        if path.exists(directory):
+            rmtree(directory)
+    copytree(path.join(fixtures, 'base'), base)
+
+    Builder(base_directory=base, output_path=output, quiet=True)
+
+    # Delete and rename some sources
+    remove(path.join(base, 'en', 'subfolder', 'nested.md'))
+    rmtree(path.join(base, 'media', 'subfolder'))
+    rename(
+        path.join(base, 'fr', 'index.md'),
+        path.join(base, 'fr', 'accueil.md')
+    )
+
+    Builder(
+        base_directory=base,
+        output_path=output,
+        manifest_path=manifest_path,
+        quiet=True
+    )
+
+    assert not path.exists(path.join(output, 'en', 'subfolder'))
+    assert not path.exists(path.join(output, 'media', 'subfolder'))
+    assert not path.exists(path.join(output, 'fr', 'index.html'))
+    assert path.isfile(path.join(output, 'fr', 'accueil.html'))
+    assert path.isfile(path.join(output, 'en', 'index.html'))
+    assert path.isfile(path.join(output, 'media', 'image.png'))
+
+    with open(manifest_path) as manifest_file:
+        manifest = json.load(manifest_file)
+
+    assert [entry['path'] for entry in manifest['added']] == [
+        'fr/accueil.html'
+    ]
+    assert [entry['path'] for entry in manifest['removed']] == [
+        'en/subfolder/nested.html',
+        'fr/index.html',
+        'media/subfolder/document.pdf',
+    ]
+
+    rmtree(output)
+    rmtree(base)
+    remove(manifest_path)
+
+
+def test_unchanged_inputs():
+    fixtures = path.join(fixtures_base, 'builder')
+    base = path.join(fixtures, 'base')
+    output = path.join(fixtures, 'output')
+    manifest_path = path.join(fixtures, 'output-manifest.json')
+    nested = path.join(base, 'en', 'subfolder', 'nested.md')
+    if path.exists(output):
+        rmtree(output)
+
+    Builder(base_directory=base, output_path=output, quiet=True)
+
+    # A build with no changes stops straight away, but still writes
+    # an (empty) change manifest
+    mock_out = StringIO()
+    Builder(
+        base_directory=base,
+        output_path=output,
+        manifest_path=manifest_path,
+        out=mock_out
+    )
+    assert mock_out.getvalue().startswith('Nothing has changed')
+    with open(manifest_path) as manifest_file:
+        assert json.load(manifest_file) == {
+            'added': [], 'changed': [], 'removed': []
+        }
+
+    # Changing build options means building again
+    mock_out = StringIO()
+    Builder(
+        base_directory=base,
+        output_path=output,
+        site_root='/docs',
+        out=mock_out
+    )
+    assert 'Nothing has changed' not in mock_out.getvalue()
+
+    # As does changing a source file
+    nested_mtime = path.getmtime(nested)
+    utime(nested, None)
+    mock_out = StringIO()
+    Builder(
+        base_directory=base,
+        output_path=output,
+        site_root='/docs',
+        out=mock_out
+    )
+    utime(nested, (nested_mtime, nested_mtime))
+    assert 'Nothing has changed' not in mock_out.getvalue()
+    assert 'Built:\n- {}'.format(
+        path.join(output, 'en', 'subfolder', 'nested.html')
+    ) in mock_out.getvalue()
+
+    # As does deleting a built page
+    Builder(
+        base_directory=base, output_path=output, site_root='/docs', quiet=True
+    )
+    index = path.join(output, 'en', 'index.html')
+    remove(index)
+    mock_out = StringIO()
+    Builder(
+        base_directory=base,
+        output_path=output,
+        site_root='/docs',
+        out=mock_out
+    )
+    assert 'Nothing has changed' not in mock_out.getvalue()
+    assert path.isfile(index)
+
+    # The manifest and trace the build writes aren't among its inputs,
+    # even when they're written into the source folder
+    inside_manifest = path.join(base, 'manifest.json')
+    inside_trace = path.join(base, 'trace.json')
+    for iteration in range(2):
+        mock_out = StringIO()
+        Builder(
+            base_directory=base,
+            output_path=output,
+            site_root='/docs',
+            manifest_path=inside_manifest,
+            trace_path=inside_trace,
+            out=mock_out
+        )
+    assert mock_out.getvalue().startswith('Nothing has changed')
+    remove(inside_manifest)
+    remove(inside_trace)
+
+    rmtree(output)
+    remove(manifest_path)
+
+
+def test_media_copy_mode():
+    fixtures = path.join(fixtures_base, 'builder')
+    base = path.join(fixtures, 'base')
+    output = path.join(fixtures, 'output')
+    document = path.join('media', 'subfolder', 'document.pdf')
+    if path.exists(output):
+        rmtree(output)
+
+    def build(mode):
+        Builder(
+            base_directory=base,
+            output_path=output,
+            media_copy_mode=mode,
+            quiet=True
+        )
+
+        return path.samefile(
+            path.join(output, document), path.join(base, document)
+        )
+
+    assert not build('copy')
+
+    # Changing the copy mode relinks media already copied
+    assert build('hardlink')
+    assert not build('copy')
+
+    rmtree(output)
+
+
+def test_referenced_media_only():
+    fixtures = path.join(fixtures_base, 'builder')
+    base = path.join(fixtures, 'base-copy')
+    output = path.join(fixtures, 'output')
+    for directory in [base, output]:
+        if path.exists(directory):
+            rmtree(directory)
+    copytree(path.join(fixtures, 'base'), base)
+    unused = path.join(base, 'media', 'unused.png')
+    with open(unused, 'w') as unused_file:
+        unused_file.write('unused')
+
+    mock_out = StringIO()
+    Builder(
+        base_directory=base,
+        output_path=output,
+        referenced_media_only=True,
+        out=mock_out
+    )
+
+    assert path.isfile(path.join(output, 'media', 'image.png'))
+    assert path.isfile(
+        path.join(output, 'media', 'subfolder', 'document.pdf')
+    )
+    assert not path.exists(path.join(output, 'media', 'unused.png'))
+    assert '- {}'.format(unused) in mock_out.getvalue()
+
+    # Media is removed when it's no longer linked to
+    remove(path.join(base, 'en', 'subfolder', 'nested.md'))
+    Builder(
+        base_directory=base,
+        output_path=output,
+        referenced_media_only=True,
+        quiet=True
+    )
+
+    assert not path.exists(path.join(output, 'media', 'image.png'))
+    assert not path.exists(path.join(output, 'media', 'subfolder'))
+
+    rmtree(output)
+    rmtree(base)
+
+
+def test_content_addressed_media():
+    fixtures = path.join(fixtures_base, 'builder')
+    base = path.join(fixtures, 'base-copy')
+    output = path.join(fixtures, 'output')
+    for directory in [base, output]:
+        if path.exists(directory):
+            rmtree(directory)
+    copytree(path.join(fixtures, 'base'), base)
+    nested_page = path.join(output, 'en', 'subfolder', 'nested.html')
+
+    def stored_files():
+        return sorted(
+            path.relpath(filepath, path.join(output, 'media'))
+            for filepath in glob(
+                path.join(output, 'media', '**', '*'), recursive=True
+            )
+            if path.isfile(filepath)
+        )
+
+    Builder(
+        base_directory=base,
+        output_path=output,
+        content_addressed_media=True,
+        quiet=True
+    )
+
+    first_files = stored_files()
+    assert len(first_files) == 2
+    assert path.join('media', 'image.png') not in first_files
+    with open(nested_page) as nested_file:
+        nested_html = nested_file.read()
+    for filename in first_files:
+        assert '../../media/' + filename in nested_html
+
+    # Changed media is stored under a new name, and pages linking to it
+    # are rebuilt, without keeping the old file
+    with open(path.join(base, 'media', 'image.png'), 'a') as image_file:
+        image_file.write('changed')
+    Builder(
+        base_directory=base,
+        output_path=output,
+        content_addressed_media=True,
+        quiet=True
+    )
+
+    second_files = stored_files()
+    assert len(second_files) == 2
+    assert len(set(first_files) & set(second_files)) == 1
+    with open(nested_page) as nested_file:
+        nested_html = nested_file.read()
+    for filename in second_files:
+        assert '../../media/' + filename in nested_html
+
+    rmtree(output)
+    rmtree(base)
+
+
+def test_fingerprinted_media():
+    fixtures = path.join(fixtures_base, 'builder')
+    base = path.join(fixtures, 'base')
+    output = path.join(fixtures, 'output')
+    if path.exists(output):
+        rmtree(output)
+
+    Builder(
+        base_directory=base,
+        output_path=output,
+        fingerprinted_media=True,
+        quiet=True
+    )
+
+    media_files = glob(path.join(output, 'media', '**', '*.*'), recursive=True)
+    assert len(media_files) == 2
+    for filepath in media_files:
+        assert re.search(r'\.[0-9a-f]{12}\.(png|pdf)$', filepath)
+
+    with open(path.join(output, 'en', 'subfolder', 'nested.html')) as nested:
+        nested_html = nested.read()
+    assert re.search(r'"../../media/image\.[0-9a-f]{12}\.png"', nested_html)
+    assert re.search(
+        r'"../../media/subfolder/document\.[0-9a-f]{12}\.pdf"', nested_html
+    )
+
+    rmtree(output)
+
+
+def test_media_mode_changes():
+    fixtures = path.join(fixtures_base, 'builder')
+    base = path.join(fixtures, 'base')
+    output = path.join(fixtures, 'output')
+    if path.exists(output):
+        rmtree(output)
+
+    def build(**options):
+        Builder(
+            base_directory=base,
+            output_path=output,
+            quiet=True,
+            **options
+        )
+
+        return sorted(
+            path.relpath(filepath, path.join(output, 'media'))
+            for filepath in glob(
+                path.join(output, 'media', '**', '*.*'), recursive=True
+            )
+        )
+
+    original_files = ['image.png', 'subfolder/document.pdf']
+
+    assert build() == original_files
+    assert build(fingerprinted_media=True) != original_files
+
+    # Going back to the original names restores them,
+    # and removes the fingerprinted copies
+    assert build() == original_files
+    with open(path.join(output, 'en', 'subfolder', 'nested.html')) as nested:
+        assert '"../../media/image.png"' in nested.read()
+
+    rmtree(output)
+
+
+def test_image_variants():
+    Image = pytest.importorskip('PIL.Image')
+    fixtures = path.join(fixtures_base, 'builder')
+    base = path.join(fixtures, 'base-copy')
+    output = path.join(fixtures, 'output')
+    cache = path.join(fixtures, 'image-cache')
+    for directory in [base, output, cache]:
+        if path.exists(directory):
+            rmtree(directory)
+    copytree(path.join(fixtures, 'base'), base)
+    image_path = path.join(base, 'media', 'image.png')
+    nested_page = path.join(output, 'en', 'subfolder', 'nested.html')
+    Image.new('RGB', (1000, 600), 'blue').save(image_path)
+
+    def build():
+        Builder(
+            base_directory=base,
+            output_path=output,
+            image_widths=[500, 2000],
+            image_cache_path=cache,
+            quiet=True
+        )
+
+    build()
+
+    assert sorted(listdir(path.join(output, 'media'))) == [
+        'image.1000w.webp',
+        'image.500w.png',
+        'image.500w.webp',
+        'image.png',
+        'subfolder',
+    ]
+    with open(nested_page) as nested_file:
+        image_tag = BeautifulSoup(nested_file.read(), 'html.parser').img
+    assert image_tag['width'] == '1000'
+    assert image_tag['height'] == '600'
+    assert image_tag['loading'] == 'lazy'
+    assert image_tag['srcset'] == (
+        '../../media/image.500w.png 500w, ../../media/image.png 1000w'
+    )
+    assert image_tag.parent.name == 'picture'
+
+    # Pages are rebuilt when an image's size changes,
+    # and unused variants are removed
+    Image.new('RGB', (400, 300), 'blue').save(image_path)
+    build()
+
+    assert sorted(listdir(path.join(output, 'media'))) == [
+        'image.400w.webp',
+        'image.png',
+        'subfolder',
+    ]
+    with open(nested_page) as nested_file:
+        image_tag = BeautifulSoup(nested_file.read(), 'html.parser').img
+    assert image_tag['width'] == '400'
+
+    for directory in [base, output, cache]:
+        rmtree(directory)
+
+
+def test_content_addressed_media_outside_versions():
+    fixtures = path.join(fixtures_base, 'builder')
+    workspace = path.join(fixtures, 'workspace')
+    base = path.join(workspace, 'repository')
+    media = path.join(workspace, 'media')
+    output = path.join(fixtures, 'output')
+    for directory in [workspace, output]:
+        if path.exists(directory):
+            rmtree(directory)
+    copytree(path.join(fixtures, 'base', 'media'), media)
+    copytree(path.join(fixtures, 'base', 'en'), path.join(base, 'en'))
+    copyfile(
+        path.join(fixtures, 'base', 'metadata.yaml'),
+        path.join(base, 'metadata.yaml')
+    )
+    with open(path.join(base, 'en', 'index.md'), 'a') as page:
+        page.write('\n![Image](../../media/image.png)\n')
+    with open(path.join(base, 'versions'), 'w') as versions:
+        versions.write('latest\n')
+    repo = Repo.init(base)
+    repo.git.add(A=True)
+    repo.index.commit('Documentation')
+    repo.git.branch('latest')
+
+    # Media outside the repository is hashed from the files themselves
+    Builder(
+        base_directory=base,
+        output_path=output,
+        media_path=media,
+        build_version_branches=True,
+        content_addressed_media=True,
+        quiet=True
+    )
+
+    page = path.join(output, 'latest', 'en', 'index.html')
+    with open(page) as page_file:
+        sources = [
+            image['src'] for image in
+            BeautifulSoup(page_file.read(), 'html.parser').select('main img')
+        ]
+    assert sources
+    for source in sources:
+        assert source != '../../media/image.png'
+        assert path.isfile(path.join(path.dirname(page), source))
+
+    rmtree(workspace)
+    rmtree(output)
+
+
+def test_shared_stylesheet():
+    fixtures = path.join(fixtures_base, 'builder')
+    base = path.join(fixtures, 'base')
+    output = path.join(fixtures, 'output')
+    stylesheet = asset_path(default_stylesheet, 'css')
+    if path.exists(output):
+        rmtree(output)
+
+    def stylesheet_links(page):
+        with open(path.join(output, page)) as page_file:
+            soup = BeautifulSoup(page_file.read(), 'html.parser')
+
+        return [link['href'] for link in soup.select('link[rel=stylesheet]')]
+
+    # The stylesheet is written once, and linked relatively from each page
+    Builder(base_directory=base, output_path=output, quiet=True)
+
+    assert path.getsize(path.join(output, stylesheet)) > 100000
+    assert path.getsize(path.join(output, 'en', 'index.html')) < 20000
+    assert stylesheet_links('en/index.html') == ['../' + stylesheet]
+    assert stylesheet_links('en/subfolder/nested.html') == [
+        '../../' + stylesheet
+    ]
+
+    # Or from the site root
+    Builder(
+        base_directory=base,
+        output_path=output,
+        site_root='/docs/',
+        force=True,
+        quiet=True
+    )
+
+    assert stylesheet_links('en/index.html') == ['/docs/' + stylesheet]
+
+    rmtree(output)
+
+
+def test_changed_stylesheet(monkeypatch):
+    fixtures = path.join(fixtures_base, 'builder')
+    output = path.join(fixtures, 'output')
+    stylesheet = path.join(fixtures, 'template-copy.css')
+    if path.exists(output):
+        rmtree(output)
+    copyfile(default_stylesheet, stylesheet)
+    monkeypatch.setattr(
+        'ubuntudesign.documentation_builder.builder.default_stylesheet',
+        stylesheet
+    )
+
+    def build():
+        Builder(
+            base_directory=path.join(fixtures, 'base'),
+            output_path=output,
+            quiet=True
+        )
+
+    build()
+
+    with open(stylesheet, 'a') as stylesheet_file:
+        stylesheet_file.write('\n.new-rule {}\n')
+
+    # Unmodified pages are rebuilt to link to the new stylesheet
+    build()
+
+    stylesheets = glob(path.join(output, 'css', '*.css'))
+    assert len(stylesheets) == 1
+    for page in ['en/index.html', 'en/subfolder/nested.html']:
+        with open(path.join(output, page)) as page_file:
+            link = BeautifulSoup(page_file.read(), 'html.parser').select_one(
+                'link[rel=stylesheet]'
+            )
+        assert path.normpath(
+            path.join(output, path.dirname(page), link['href'])
+        ) == path.normpath(stylesheets[0])
+
+    remove(stylesheet)
+    rmtree(output)
+
+
+def test_shared_navigation():
+    fixtures = path.join(fixtures_base, 'builder')
+    base = path.join(fixtures, 'base')
+    output = path.join(fixtures, 'output')
+    if path.exists(output):
+        rmtree(output)
+
+    Builder(
+        base_directory=base,
+        output_path=output,
+        shared_navigation=True,
+        quiet=True
+    )
+
+    # The navigation is written once for each metadata.yaml defining it
+    navigation_files = glob(path.join(output, 'en', 'navigation.*.json'))
+    assert len(navigation_files) == 1
+    with open(navigation_files[0]) as navigation_file:
+        assert json.load(navigation_file) == [
+            {'title': 'Home', 'location': 'index.html'},
+            {'title': 'Nested', 'location': 'subfolder/nested.html'},
+        ]
+
+    # Pages link to it instead of containing it
+    with open(path.join(output, 'en', 'subfolder', 'nested.html')) as nested:
+        soup = BeautifulSoup(nested.read(), 'html.parser')
+    assert soup.select('.p-sidebar-nav a') == []
+    assert soup.select('.p-sidebar-nav')[0]['data-navigation'] == (
+        '../' + path.basename(navigation_files[0])
+    )
+
+    # Outdated navigation files are removed
+    with open(path.join(output, 'en', 'navigation.old.json'), 'w') as old:
+        old.write('[]')
+    state_path = path.join(output, '.documentation-builder', 'state.json')
+    with open(state_path) as state_file:
+        state = json.load(state_file)
+    state['outputs']['en/navigation.old.json'] = dict(
+        state['outputs']['en/index.html'],
+        kind='navigation',
+        source='en/navigation.old.json'
+    )
+    with open(state_path, 'w') as state_file:
+        json.dump(state, state_file)
+    Builder(
+        base_directory=base,
+        output_path=output,
+        shared_navigation=True,
+        force=True,
+        quiet=True
+    )
+
+    assert not path.exists(path.join(output, 'en', 'navigation.old.json'))
+
+    # Without shared navigation, pages contain it again
+    Builder(base_directory=base, output_path=output, quiet=True)
+
+    assert glob(path.join(output, 'en', 'navigation.*.json')) == []
+    with open(path.join(output, 'en', 'subfolder', 'nested.html')) as nested:
+        soup = BeautifulSoup(nested.read(), 'html.parser')
+    assert len(soup.select('.p-sidebar-nav a')) == 2
+    assert not soup.select('[data-navigation]')
+
+    rmtree(output)
+
+
+def test_search_index():
+    fixtures = path.join(fixtures_base, 'builder')
+    base = path.join(fixtures, 'base-copy')
+    output = path.join(fixtures, 'output')
+    for directory in [base, output]:
+        if path.exists(directory):
+            rmtree(directory)
+    copytree(path.join(fixtures, 'base'), base)
+    search_path = path.join(output, 'en', 'search')
+
+    def build(**options):
+        Builder(
+            base_directory=base,
+            output_path=output,
+            quiet=True,
+            **options
+        )
+
+    def load_index():
+        with open(path.join(search_path, 'index.json')) as index_file:
+            index = json.load(index_file)
+        shards = {}
+        for key, filename in index['shards'].items():
+            with open(path.join(search_path, filename)) as shard_file:
+                shards[key] = json.load(shard_file)
+        return index, shards
+
+    # One index for each language, linked to from its pages
+    build(search_index=True)
+
+    index, shards = load_index()
+    assert index['pages'] == [
+        ['../index.html', 'A title'],
+        ['../subfolder/nested.html', 'Nested page'],
+    ]
+    assert shards['n']['nested'] == [[0, 1], [1, 10]]
+    assert path.isfile(path.join(output, 'fr', 'search', 'index.json'))
+    with open(path.join(output, 'en', 'subfolder', 'nested.html')) as page:
+        soup = BeautifulSoup(page.read(), 'html.parser')
+    assert soup.select('#search')[0]['data-search-index'] == (
+        '../search/index.json'
+    )
+
+    # Changing a page only changes the shards of its terms
+    shard_filenames = dict(index['shards'])
+    with open(path.join(base, 'en', 'subfolder', 'nested.md'), 'a') as page:
+        page.write('\nZebra\n')
+    build(search_index=True)
+
+    index, shards = load_index()
+    assert shards['z']['zebra'] == [[1, 1]]
+    assert index['shards']['n'] == shard_filenames['n']
+    assert sorted(glob(path.join(search_path, 'z.*.json'))) == [
+        path.join(search_path, index['shards']['z'])
+    ]
+
+    # Removed pages, and shards no longer used, are dropped
+    remove(path.join(base, 'en', 'subfolder', 'nested.md'))
+    build(search_index=True)
+
+    index, shards = load_index()
+    assert index['pages'] == [['../index.html', 'A title']]
+    assert 'z' not in index['shards']
+    assert glob(path.join(search_path, 'z.*.json')) == []
+
+    # The index is removed when it's no longer wanted,
+    # and pages no longer link to it
+    build()
+
+    assert not path.exists(search_path)
+    with open(path.join(output, 'en', 'index.html')) as page:
+        soup = BeautifulSoup(page.read(), 'html.parser')
+    assert not soup.select('[data-search-index]')
+
+    rmtree(base)
+    rmtree(output)
+
+
+def test_sitemap(monkeypatch):
+    fixtures = path.join(fixtures_base, 'builder')
+    base = path.join(fixtures, 'base-copy')
+    output = path.join(fixtures, 'output')
+    for directory in [base, output]:
+        if path.exists(directory):
+            rmtree(directory)
+    copytree(path.join(fixtures, 'base'), base)
+    copyfile(
+        path.join(base, 'en', 'index.md'),
+        path.join(base, 'en', 'reindexing.md')
+    )
+    sitemap_path = path.join(output, 'sitemap.xml')
+
+    def build(**options):
+        Builder(
+            base_directory=base,
+            output_path=output,
+            sitemap_url='https://docs.example.com',
+            quiet=True,
+            **options
+        )
+
+    def load_sitemap(filepath=sitemap_path):
+        with open(filepath) as sitemap_file:
+            return dict(
+                re.findall(
+                    r'<loc>([^<]+)</loc><lastmod>([^<]+)</lastmod>',
+                    sitemap_file.read()
+                )
+            )
+
+    build()
+
+    sitemap = load_sitemap()
+    assert sorted(sitemap) == [
+        'https://docs.example.com/en/',
+        'https://docs.example.com/en/reindexing',
+        'https://docs.example.com/en/subfolder/nested',
+        'https://docs.example.com/fr/',
+    ]
+
+    # Only pages whose content changes get a new lastmod
+    state_path = path.join(output, '.documentation-builder', 'state.json')
+    with open(state_path) as state_file:
+        state = json.load(state_file)
+    for record in state['outputs'].values():
+        if 'modified' in record:
+            record['modified'] = 0
+    with open(state_path, 'w') as state_file:
+        json.dump(state, state_file)
+    with open(path.join(base, 'en', 'index.md'), 'a') as page:
+        page.write('\nMore text\n')
+    build(force=True)
+
+    sitemap = load_sitemap()
+    assert sitemap['https://docs.example.com/fr/'] == '1970-01-01T00:00:00Z'
+    assert sitemap['https://docs.example.com/en/'] != '1970-01-01T00:00:00Z'
+
+    # Large sitemaps are split, and listed in a sitemap index
+    monkeypatch.setattr(
+        'ubuntudesign.documentation_builder.builder.sitemap_limit', 2
+    )
+    build(force=True)
+
+    assert sorted(load_sitemap()) == [
+        'https://docs.example.com/sitemap-1.xml',
+        'https://docs.example.com/sitemap-2.xml',
+    ]
+    assert sorted(
+        list(load_sitemap(path.join(output, 'sitemap-1.xml'))) +
+        list(load_sitemap(path.join(output, 'sitemap-2.xml')))
+    ) == sorted(sitemap)
+
+    # Sitemaps are removed when they're no longer wanted
+    monkeypatch.undo()
+    build(force=True)
+
+    assert sorted(load_sitemap()) == sorted(sitemap)
+    assert not path.exists(path.join(output, 'sitemap-1.xml'))
+
+    Builder(base_directory=base, output_path=output, quiet=True)
+
+    assert not path.exists(sitemap_path)
+
+    rmtree(base)
+    rmtree(output)
+
+
+def test_check_links():
+    fixtures = path.join(fixtures_base, 'builder')
+    base = path.join(fixtures, 'base-copy')
+    output = path.join(fixtures, 'output')
+    for directory in [base, output]:
+        if path.exists(directory):
+            rmtree(directory)
+    copytree(path.join(fixtures, 'base'), base)
+    with open(path.join(base, 'en', 'subfolder', 'nested.md'), 'a') as page:
+        page.write(
+            '\n[Subheading](../index.md#subheading)\n'
+            '[Top](#top)\n'
+        )
+
+    def build():
+        mock_err = StringIO()
+        mock_out = StringIO()
+        Builder(
+            base_directory=base,
+            output_path=output,
+            check_links=True,
+            out=mock_out,
+            err=mock_err
+        )
+        return mock_out.getvalue(), mock_err.getvalue()
+
+    out, err = build()
+
+    assert 'Checked 8 links in 3 pages' in out
+    assert err == (
+        'Notice: Found 2 broken links:\n'
+        '- en/index.md:13: missing.md (no such page)\n'
+        '- en/subfolder/nested.md:13: #top (no such anchor)\n'
+    )
+
+    # Links in unchanged pages are still checked against changed pages
+    with open(path.join(base, 'en', 'index.md')) as page:
+        content = page.read()
+    with open(path.join(base, 'en', 'index.md'), 'w') as page:
+        page.write(content.replace('## Subheading', '## Heading'))
+
+    out, err = build()
+
+    assert 'Skipping unmodified files' in out
+    assert 'Checked 8 links in 3 pages' in out
+    assert (
+        '- en/subfolder/nested.md:12: ../index.md#subheading '
+        '(no such anchor)\n'
+    ) in err
+
+    rmtree(base)
+    rmtree(output)
+
+
+def test_trace():
+    fixtures = path.join(fixtures_base, 'builder')
+    output = path.join(fixtures, 'output')
+    trace_path = path.join(fixtures, 'trace.json')
+    if path.exists(output):
+        rmtree(output)
+
+    mock_out = StringIO()
+    Builder(
+        base_directory=path.join(fixtures, 'base'),
+        output_path=output,
+        trace_path=trace_path,
+        out=mock_out,
+        err=StringIO()
+    )
+
+    assert 'Saved a trace of the build to ' + trace_path in (
+        mock_out.getvalue()
+    )
+
+    with open(trace_path) as trace_file:
+        events = json.load(trace_file)['traceEvents']
+    spans = [event for event in events if event['ph'] == 'X']
+    names = set(span['name'] for span in spans)
+
+    for name in [
+        'build_branch', 'find_files', 'compile_metadata', 'parse_markdown',
+        'rewrite_links', 'write_page', 'wait for source', 'copy_media'
+    ]:
+        assert name in names
+
+    assert sorted(
+        span['args']['page'] for span in spans
+        if span['name'] == 'parse_markdown'
+    ) == ['en/index.md', 'en/subfolder/nested.md', 'fr/index.md']
+
+    # Pages are written on the I/O threads, which are named in the trace
+    build_thread = next(
+        span['tid'] for span in spans if span['name'] == 'build_branch'
+    )
+    write_threads = set(
+        span['tid'] for span in spans if span['name'] == 'write_page'
+    )
+    assert build_thread not in write_threads
+    assert set(
+        event['tid'] for event in events if event['ph'] == 'M'
+    ) >= write_threads
+
+    remove(trace_path)
+    rmtree(output)
+
+
+def test_page_costs():
+    fixtures = path.join(fixtures_base, 'builder')
+    base = path.join(fixtures, 'base-copy')
+    output = path.join(fixtures, 'output')
+    for directory in [base, output]:
+        if path.exists(directory):
+            rmtree(directory)
+    copytree(path.join(fixtures, 'base'), base)
+    with open(path.join(base, 'en', 'subfolder', 'nested.md'), 'a') as page:
+        page.write(
+            '\n``` python\nprint("one")\n```\n'
+            '\n``` python\nprint("two")\n```\n'
+        )
+
+    def build(**budgets):
+        mock_err = StringIO()
+        mock_out = StringIO()
+        builder = Builder(
+            base_directory=base,
+            output_path=output,
+            out=mock_out,
+            err=mock_err,
+            **budgets
+        )
+        return mock_out.getvalue(), builder.result['over_budget']
+
+    out, err = build(cost_report=3)
+
+    with open(
+        path.join(output, '.documentation-builder', 'state.json')
+    ) as state_file:
+        outputs = json.load(state_file)['outputs']
+
+    nested_cost = outputs['en/subfolder/nested.html']['cost']
+    assert nested_cost['code_blocks'] == 2
+    assert 0 < nested_cost['highlight_ms'] <= nested_cost['render_ms']
+    assert outputs['en/index.html']['cost']['code_blocks'] == 0
+
+    report = out.split('Most expensive pages:\n')[1].splitlines()
+    assert len(report) == 3
+    assert any(
+        line.startswith('- en/subfolder/nested.md: ') and
+        'highlighting 2 code blocks), {:,} bytes'.format(
+            outputs['en/subfolder/nested.html']['size']
+        ) in line
+        for line in report
+    )
+
+    # Budgets which aren't exceeded don't fail the build
+    assert build(max_page_bytes=1000000, max_build_seconds=60)[1] == []
+
+    # Exceeded budgets fail the build, even when nothing has changed
+    for attempt in range(2):
+        assert build(max_page_bytes=10, max_page_ms=0.001)[1]
+
+    index_size = outputs['en/index.html']['size']
+    mock_err = StringIO()
+    result = Builder(
+        base_directory=base,
+        output_path=output,
+        max_page_bytes=index_size - 1,
+        max_build_seconds=0.001,
+        out=StringIO(),
+        err=mock_err,
+        defer_build=True
+    ).build()
+
+    assert 'en/index.md: {:,} bytes (max {:,} bytes)'.format(
+        index_size, index_size - 1
+    ) in result['over_budget']
+    assert result['over_budget'][-1].startswith('The build took ')
+    errors = mock_err.getvalue()
+    assert errors.startswith('Error: The build is over budget:\n')
+    assert '- en/index.md: {:,} bytes (max {:,} bytes)\n'.format(
+        index_size, index_size - 1
+    ) in errors
+    assert 'to render' not in errors
+    assert '(max 0.001 seconds)' in errors
+
+    rmtree(base)
+    rmtree(output)
+
+
+def test_memory_profile(monkeypatch):
+    fixtures = path.join(fixtures_base, 'builder')
+    output = path.join(fixtures, 'output')
+    if path.exists(output):
+        rmtree(output)
+
+    mock_out = StringIO()
+    builder = Builder(
+        base_directory=path.join(fixtures, 'base'),
+        output_path=output,
+        memory_profile=True,
+        out=mock_out,
+        err=StringIO()
+    )
+
+    assert [
+        stage['name'] for stage in builder.memory_profiler.stages
+    ] == [
+        'fingerprint', 'build_branch', 'prune', 'copy_media',
+        'compress_outputs'
+    ]
+
+    build_branch = builder.memory_profiler.stages[1]
+    assert build_branch['peak'] >= build_branch['retained']
+    assert build_branch['peak_rss'] > 0
+
+    profile = mock_out.getvalue().split('Memory profile:\n')[1]
+    assert re.search(
+        r'^- build_branch: peak [0-9.,]+ [kM]B, retained -?[0-9.,]+ [kM]B '
+        r'\(peak RSS [0-9.,]+ MB\)$',
+        profile,
+        re.MULTILINE
+    )
+    assert re.search(
+        r'^Top allocating sites:\n- .+:[0-9]+: [0-9.,]+ [kM]B '
+        r'in [0-9,]+ blocks \(',
+        profile,
+        re.MULTILINE
+    )
+
+    # Allocations are no longer traced once the build is done
+    assert not tracemalloc.is_tracing()
+
+    # Without tracemalloc.reset_peak (before Python 3.9), stages' peaks
+    # are still at least what they kept
+    monkeypatch.delattr(tracemalloc, 'reset_peak')
+    builder = Builder(
+        base_directory=path.join(fixtures, 'base'),
+        output_path=output,
+        force=True,
+        memory_profile=True,
+        out=StringIO(),
+        err=StringIO()
+    )
+
+    for stage in builder.memory_profiler.stages:
+        assert stage['peak'] >= max(stage['retained'], 0)
+    assert not tracemalloc.is_tracing()
+
+    rmtree(output)
+
+
+def test_precompress():
+    fixtures = path.join(fixtures_base, 'builder')
+    base = path.join(fixtures, 'base-copy')
+    output = path.join(fixtures, 'output')
+    for directory in [base, output]:
+        if path.exists(directory):
+            rmtree(directory)
+    copytree(path.join(fixtures, 'base'), base)
+    page = path.join(output, 'en', 'index.html')
+
+    def build(**options):
+        Builder(
+            base_directory=base,
+            output_path=output,
+            quiet=True,
+            **options
+        )
+
+    # Pages and stylesheets are compressed, but not media
+    build(precompress=True)
+
+    with open(page, 'rb') as page_file:
+        with open(page + '.gz', 'rb') as gzip_file:
+            assert gzip.decompress(gzip_file.read()) == page_file.read()
+    assert glob(path.join(output, 'css', '*.css.gz'))
+    assert not path.exists(path.join(output, 'media', 'image.png.gz'))
+
+    # Only changed files are compressed again
+    gzip_modified = path.getmtime(page + '.gz')
+    with open(path.join(base, 'fr', 'index.md'), 'a') as source:
+        source.write('\nMore')
+    mock_out = StringIO()
+    Builder(
+        base_directory=base,
+        output_path=output,
+        precompress=True,
+        out=mock_out
+    )
+
+    assert 'Compressed 1 changed files' in mock_out.getvalue()
+    assert path.getmtime(page + '.gz') == gzip_modified
+
+    # Compressed copies are removed along with their pages,
+    # or when no longer wanted
+    remove(path.join(base, 'fr', 'index.md'))
+    build(precompress=True)
+    assert not path.exists(path.join(output, 'fr'))
+
+    build()
+    assert not glob(path.join(output, '**', '*.gz'), recursive=True)
+
+    rmtree(output)
+    rmtree(base)
+
+
+def test_minify():
+    fixtures = path.join(fixtures_base, 'builder')
+    base = path.join(fixtures, 'base')
+    output = path.join(fixtures, 'output')
+    plain_output = path.join(fixtures, 'output_plain')
+    for directory in [output, plain_output]:
+        if path.exists(directory):
+            rmtree(directory)
+
+    Builder(base_directory=base, output_path=plain_output, quiet=True)
+    mock_out = StringIO()
+    Builder(
+        base_directory=base,
+        output_path=output,
+        minify=True,
+        out=mock_out
+    )
+
+    assert re.search(
+        r'Minified 3 pages from [\d,]+ to [\d,]+ bytes, saving [\d,]+',
+        mock_out.getvalue()
+    )
+    _compare_trees(output, plain_output)
+
+    for filepath in glob(path.join(output, '**/*.html'), recursive=True):
+        plain_filepath = path.join(
+            plain_output, path.relpath(filepath, output)
+        )
+        with open(filepath, encoding="utf-8") as page_file:
+            page_html = page_file.read()
+        with open(plain_filepath, encoding="utf-8") as plain_file:
+            plain_html = plain_file.read()
+
+        assert len(page_html) < len(plain_html)
+        body = page_html.split('<body>')[1].split('<script>')[0]
+        assert '\n  ' not in body
+
+        page_soup = BeautifulSoup(page_html, 'html.parser')
+        plain_soup = BeautifulSoup(plain_html, 'html.parser')
+        assert (
+            page_soup.body.get_text(" ").split() ==
+            plain_soup.body.get_text(" ").split()
+        )
+        assert (
+            [str(pre) for pre in page_soup.select('pre')] ==
+            [str(pre) for pre in plain_soup.select('pre')]
+        )
+
+    rmtree(output)
+    rmtree(plain_output)
+
+
+def test_io_threads():
+    fixtures = path.join(fixtures_base, 'builder')
+    base = path.join(fixtures, 'base')
+    output = path.join(fixtures, 'output')
+    expected_output = path.join(fixtures, 'output_basic')
+    if path.exists(output):
+        rmtree(output)
+
+    # A single I/O thread still reads ahead and writes behind
+    Builder(
+        base_directory=base,
+        output_path=output,
+        io_threads=1,
+        quiet=True
+    )
+
+    _compare_trees(output, expected_output)
+    _compare_html_parts(output, expected_output)
+
+    rmtree(output)
+
+
 def test_no_media():
     fixtures = path.join(fixtures_base, 'builder')
     base = path.join(fixtures, 'base-no-media')
@@ -242,6 +1538,71 @@ def test_versions():
     rmtree(base)
 
 
+def test_shared_versions():
+    fixtures = path.join(fixtures_base, 'builder')
+    base = path.join(fixtures, 'base-copy')
+    output = path.join(fixtures, 'output')
+    for directory in [base, output]:
+        if path.exists(directory):
+            rmtree(directory)
+
+    # A local repository, where 1.0 doesn't have the nested page
+    copytree(path.join(fixtures, 'base'), base)
+    repo = Repo.init(base)
+    with repo.config_writer() as config:
+        config.set_value('user', 'name', 'Tester')
+        config.set_value('user', 'email', 'tester@example.com')
+    repo.git.add(all=True)
+    repo.index.commit('Latest')
+    repo.create_head('latest')
+    repo.git.rm(path.join('en', 'subfolder', 'nested.md'))
+    repo.index.commit('Old')
+    repo.create_head('1.0')
+
+    Builder(
+        base_directory=base,
+        output_path=output,
+        build_version_branches=True,
+        shared_versions=True,
+        quiet=True
+    )
+
+    # One version map is shared by all pages
+    versions_files = glob(path.join(output, 'versions.*.json'))
+    assert len(versions_files) == 1
+    with open(versions_files[0]) as versions_file:
+        assert json.load(versions_file) == {
+            'versions': ['1.0', 'latest'],
+            'extension': '.html',
+            'pages': {
+                'en/index': '11',
+                'en/subfolder/nested': '01',
+                'fr/index': '11',
+            },
+        }
+
+    with open(path.join(output, '1.0', 'en', 'index.html')) as page_file:
+        soup = BeautifulSoup(page_file.read(), 'html.parser')
+    version_select = soup.select('#version-select')[0]
+    assert version_select.select('option') == []
+    assert version_select['data-versions'] == path.relpath(
+        versions_files[0], path.join(output, '1.0', 'en')
+    )
+    assert version_select['data-version'] == '1.0'
+    assert version_select['data-version-page'] == 'en/index'
+
+    # The first version is the canonical one
+    assert soup.select('link[rel=canonical]') == []
+    with open(path.join(output, 'latest', 'en', 'index.html')) as page_file:
+        soup = BeautifulSoup(page_file.read(), 'html.parser')
+    assert soup.select('link[rel=canonical]')[0]['href'] == (
+        '../../1.0/en/index.html'
+    )
+
+    rmtree(output)
+    rmtree(base)
+
+
 def test_output_media_path():
     base = path.join(fixtures_base, 'builder', 'base')
     output = path.join(fixtures_base, 'builder', 'output')
@@ -365,12 +1726,18 @@ def test_tag_manager():
 
 
 def _compare_trees(directory_a, directory_b):
+    # The stylesheet's name includes a hash of its content
+    def normalise(filepath):
+        return re.sub(
+            r'^css/template\.\w+\.css$', 'css/template.css', filepath
+        )
+
     a_files = []
     b_files = []
     for filepath in glob(path.join(directory_a, '**'), recursive=True):
-        a_files.append(path.relpath(filepath, directory_a))
+        a_files.append(normalise(path.relpath(filepath, directory_a)))
     for filepath in glob(path.join(directory_b, '**'), recursive=True):
-        b_files.append(path.relpath(filepath, directory_b))
+        b_files.append(normalise(path.relpath(filepath, directory_b)))
 
     assert sorted(a_files) == sorted(b_files)
 
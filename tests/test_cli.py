@@ -1,7 +1,15 @@
 # System
+import json
+import subprocess
+import sys
+from os import environ, path, remove
 from shutil import rmtree
 
+# Third party modules
+from pytest import raises
+
 # Local modules
+from ubuntudesign.documentation_builder import __version__
 from ubuntudesign.documentation_builder.cli import main, parse_arguments
 
 
@@ -19,5 +27,143 @@ def test_main():
              'doesnt/matter'
         ]
     )
+
+    # Exceeded budgets make the command fail
+    with raises(SystemExit) as exit:
+        main(
+            [
+                '--base-directory',
+                'tests/fixtures/builder/base/',
+                '--output-path',
+                'doesnt/matter',
+                '--max-page-bytes',
+                '10',
+                '--quiet'
+            ]
+        )
+    assert exit.value.code == 1
     rmtree('doesnt')
 
+
+def test_bench(capsys):
+    results_path = 'bench.json'
+
+    main(
+        [
+            'bench',
+            '--pages', '5',
+            '--depth', '1',
+            '--repeat', '2',
+            '--save', results_path
+        ]
+    )
+
+    assert path.isfile(results_path)
+
+    # Stages much slower than the baseline are regressions
+    with open(results_path) as results_file:
+        baseline = json.load(results_file)
+    for summary in baseline['stages'].values():
+        summary['times'] = [seconds / 10 for seconds in summary['times']]
+    baseline['options']['pages'] = 10
+    with open(results_path, 'w') as results_file:
+        json.dump(baseline, results_file)
+    capsys.readouterr()
+
+    with raises(SystemExit) as exit:
+        main(
+            [
+                'bench',
+                '--pages', '5',
+                '--depth', '1',
+                '--repeat', '2',
+                '--compare', results_path
+            ]
+        )
+
+    output = capsys.readouterr()
+    assert exit.value.code == 1
+    assert 'Regressed:\n- find_metadata +' in output.out
+    assert 'different options: pages=10' in output.err
+
+    remove(results_path)
+
+
+def test_bench_versions(capsys):
+    # A generated repository gets version branches to build
+    main(
+        [
+            'bench',
+            '--pages', '3',
+            '--depth', '0',
+            '--repeat', '1',
+            '--build-version-branches',
+            '--versions', '3'
+        ]
+    )
+
+    output = capsys.readouterr().out
+    assert 'build_warm' in output
+    assert 'build_one_changed' not in output
+
+
+fixtures_base = path.join(path.dirname(__file__), 'fixtures')
+
+
+def _run_python(code, directory):
+    # Run from another directory, importing this copy of the package
+    environment = dict(
+        environ, PYTHONPATH=path.dirname(path.dirname(path.abspath(__file__)))
+    )
+    output = subprocess.check_output(
+        [sys.executable, '-c', code], cwd=directory, env=environment
+    )
+
+    return output.decode('utf-8')
+
+
+def test_startup(tmpdir):
+    heavy_modules = [
+        'bs4', 'frontmatter', 'git', 'jinja2', 'markdown', 'pkg_resources',
+        'pygments', 'yaml'
+    ]
+
+    # --help and --version don't import the builder's dependencies
+    output = _run_python(
+        'import sys\n'
+        'from ubuntudesign.documentation_builder import cli\n'
+        'cli.parse_arguments(["--base-directory", "."])\n'
+        'print(sorted(name for name in {} if name in sys.modules))'.format(
+            heavy_modules
+        ),
+        str(tmpdir)
+    )
+    assert output.strip() == '[]'
+
+    # Nor the builder itself
+    output = _run_python(
+        'import sys\n'
+        'from ubuntudesign.documentation_builder import cli\n'
+        'try:\n'
+        '    cli.main(["--version"])\n'
+        'finally:\n'
+        '    print("ubuntudesign.documentation_builder.builder" '
+        'in sys.modules)',
+        str(tmpdir)
+    )
+    assert output.split() == [__version__, 'False']
+
+    # GitPython is only imported to build version branches
+    output = _run_python(
+        'import sys\n'
+        'from ubuntudesign.documentation_builder import cli\n'
+        'cli.main(["--base-directory", {!r}, '
+        '"--output-path", {!r}, "--quiet"])\n'
+        'print("git" in sys.modules)'.format(
+            path.join(fixtures_base, 'builder', 'base'),
+            str(tmpdir.join('output'))
+        ),
+        str(tmpdir)
+    )
+    assert output.strip() == 'False'
+    assert tmpdir.join('output', 'en', 'index.html').check(file=True)
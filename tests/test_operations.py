@@ -1,6 +1,8 @@
 # Core modules
+import gzip
 from copy import deepcopy
-from os import path, utime
+from hashlib import sha1
+from os import listdir, makedirs, path, remove, stat, umask, utime
 from shutil import rmtree
 
 # Third party modules
@@ -13,21 +15,49 @@ from jinja2 import Template
 
 # Local modules
 from ubuntudesign.documentation_builder.operations import (
+    build_fingerprint,
+    build_search_index,
     compile_metadata,
+    compress_file,
+    compression_formats,
+    content_addressed_filenames,
     convert_path_to_html,
     copy_media,
+    find_broken_links,
     find_files,
     find_metadata,
+    fingerprinted_filenames,
+    generate_image_variants,
+    git_media_hashes,
+    hash_media,
+    image_sizes,
+    load_build_state,
+    minify_html,
+    navigation_index,
+    navigation_json,
+    navigation_scope,
+    page_anchors,
     parse_markdown,
     prepare_version_branches,
     relativize_paths,
     replace_internal_links,
     replace_media_links,
+    responsive_images,
+    save_build_state,
+    search_document,
     set_active_navigation_items,
+    sitemap_location,
+    sitemap_xml,
+    source_lines,
+    store_media,
+    sync_media,
+    version_branch_commits,
     version_paths,
     write_html,
 )
 from ubuntudesign.documentation_builder.builder import markdown_extensions
+from ubuntudesign.documentation_builder.extensions import HighlightTimer
+from ubuntudesign.documentation_builder import utilities
 from ubuntudesign.documentation_builder.utilities import cache_dir
 
 
@@ -44,6 +74,41 @@ example_dictionary = {
 fixtures_path = path.join(path.dirname(__file__), "fixtures")
 
 
+def test_build_fingerprint():
+    source_dir = path.join(fixtures_path, "find_files", "source_dir")
+    output_dir = path.join(fixtures_path, "find_files", "output_dir")
+    unchanged = path.join(source_dir, "unchanged.md")
+    readme = path.join(source_dir, "subdir", "README.md")
+
+    def fingerprint(options={}, exclude=[]):
+        return build_fingerprint(
+            options, [source_dir], [readme], exclude=exclude
+        )
+
+    original = fingerprint()
+
+    assert fingerprint() == original
+    assert fingerprint({"force": True}) != original
+
+    # Modified files change the fingerprint
+    mtime = path.getmtime(unchanged)
+    utime(unchanged, (mtime + 10, mtime + 10))
+    assert fingerprint() != original
+    utime(unchanged, (mtime, mtime))
+    assert fingerprint() == original
+
+    # Unless they're excluded
+    utime(unchanged, (mtime + 10, mtime + 10))
+    assert fingerprint(exclude=[unchanged]) == fingerprint(
+        exclude=[unchanged]
+    )
+    assert fingerprint(exclude=[unchanged]) != fingerprint()
+    utime(unchanged, (mtime, mtime))
+
+    # Other directories aren't included
+    assert build_fingerprint({}, [output_dir], [readme]) != original
+
+
 def test_compile_metadata():
     metadata_items = {
         ".": {"content": {"site_title": "root title"}},
@@ -139,6 +204,168 @@ def test_copy_media():
     )
 
 
+def test_sync_media():
+    source_path = path.join(fixtures_path, "copy_media", "source_dir")
+    output_path = path.join(fixtures_path, "copy_media", "output_dir")
+    rmtree(output_path, ignore_errors=True)
+
+    # The same directory copies nothing
+    assert sync_media(source_path, source_path) is None
+
+    # Copied files are listed
+    assert sorted(sync_media(source_path, output_path)) == [
+        path.join(output_path, "medium.png"),
+        path.join(output_path, "subfolder", "medium.png"),
+        path.join(output_path, "subfolder", "medium2.png"),
+    ]
+
+    # Unchanged files aren't copied again
+    assert sync_media(source_path, output_path) == []
+
+    rmtree(output_path)
+
+    # With a manifest, unchanged files are skipped without looking
+    # at the output at all
+    manifest = {}
+    assert len(sync_media(source_path, output_path, manifest)) == 3
+    assert sorted(manifest.keys()) == [
+        "medium.png",
+        path.join("subfolder", "medium.png"),
+        path.join("subfolder", "medium2.png"),
+    ]
+    rmtree(path.join(output_path, "subfolder"))
+    assert sync_media(source_path, output_path, manifest) == []
+    assert len(sync_media(source_path, output_path, manifest, force=True)) == 3
+
+    # Deleted source files are dropped from the manifest
+    manifest["deleted.png"] = [1, 1]
+    sync_media(source_path, output_path, manifest)
+    assert "deleted.png" not in manifest
+
+    # Changing how files are copied copies them again
+    assert len(sync_media(source_path, output_path, manifest, "hardlink")) == 3
+    assert path.samefile(
+        path.join(output_path, "medium.png"),
+        path.join(source_path, "medium.png"),
+    )
+    assert sync_media(source_path, output_path, manifest, "hardlink") == []
+
+    rmtree(output_path)
+
+    # Files can be hard linked or cloned instead of copied
+    for mode in ["hardlink", "reflink"]:
+        sync_media(source_path, output_path, mode=mode, force=True)
+        sync_media(source_path, output_path, mode=mode, force=True)
+        assert sorted(listdir(output_path)) == ["medium.png", "subfolder"]
+
+        output_file = path.join(output_path, "subfolder", "medium2.png")
+        source_file = path.join(source_path, "subfolder", "medium2.png")
+        assert path.samefile(output_file, source_file) == (mode == "hardlink")
+        with open(output_file, "rb") as output:
+            with open(source_file, "rb") as source:
+                assert output.read() == source.read()
+
+        rmtree(output_path)
+
+
+def test_compress_file():
+    function_fixtures = path.join(fixtures_path, "compress_file")
+    filepath = path.join(function_fixtures, "page.html")
+    rmtree(function_fixtures, ignore_errors=True)
+    makedirs(function_fixtures)
+    with open(filepath, "w") as page_file:
+        page_file.write("<p>Hello world</p>" * 100)
+
+    compressed = compress_file(filepath, compression_formats())
+
+    with open(filepath + ".gz", "rb") as gzip_file:
+        assert gzip.decompress(gzip_file.read()) == b"<p>Hello world</p>" * 100
+    assert compressed["gz"][1] == path.getsize(filepath + ".gz")
+
+    if "br" in compression_formats():
+        brotli = pytest.importorskip("brotli")
+        with open(filepath + ".br", "rb") as brotli_file:
+            assert brotli.decompress(brotli_file.read()) == (
+                b"<p>Hello world</p>" * 100
+            )
+
+    # Compressed files are the same every time
+    assert compress_file(filepath, ["gz"])["gz"] == compressed["gz"]
+
+    rmtree(function_fixtures)
+
+
+def test_store_media():
+    source_path = path.join(fixtures_path, "copy_media", "source_dir")
+    output_path = path.join(fixtures_path, "copy_media", "output_dir")
+    rmtree(output_path, ignore_errors=True)
+
+    # Files are hashed as git would, and cached
+    cache = {"deleted.png": [1, 1, "abcd"]}
+    media_hashes = hash_media(source_path, cache)
+    assert sorted(media_hashes.keys()) == [
+        "medium.png",
+        path.join("subfolder", "medium.png"),
+        path.join("subfolder", "medium2.png"),
+    ]
+    assert "deleted.png" not in cache
+    with open(path.join(source_path, "medium.png"), "rb") as medium_file:
+        medium = medium_file.read()
+    assert (
+        media_hashes["medium.png"] ==
+        sha1(b"blob %d\0" % len(medium) + medium).hexdigest()
+    )
+
+    cache["medium.png"][2] = "cached"
+    assert hash_media(source_path, cache)["medium.png"] == "cached"
+    cache["medium.png"][2] = media_hashes["medium.png"]
+
+    # Files are named by their hash
+    filenames = content_addressed_filenames(media_hashes)
+    medium_hash = media_hashes["medium.png"]
+    assert filenames["medium.png"] == "{}/{}.png".format(
+        medium_hash[:2], medium_hash[2:]
+    )
+
+    # Or given fingerprinted names
+    fingerprinted = fingerprinted_filenames(media_hashes)
+    assert fingerprinted[path.join("subfolder", "medium2.png")] == (
+        path.join("subfolder", "medium2.{}.png").format(
+            media_hashes[path.join("subfolder", "medium2.png")][:12]
+        )
+    )
+
+    # Files with the same content are only stored once
+    stored_files = store_media(source_path, output_path, filenames)
+    assert stored_files == sorted(
+        set(path.join(output_path, name) for name in filenames.values())
+    )
+    assert store_media(source_path, output_path, filenames) == []
+
+    rmtree(output_path)
+
+
+def test_git_media_hashes():
+    repo_path = path.join(fixtures_path, "git_media_hashes", "repo")
+
+    if path.exists(repo_path):
+        rmtree(repo_path)
+
+    repo = Repo.init(repo_path)
+    makedirs(path.join(repo_path, "media", "subfolder"))
+    for filepath in ["README.md", "media/image.png", "media/subfolder/a.pdf"]:
+        with open(path.join(repo_path, filepath), "w") as media_file:
+            media_file.write(filepath)
+    repo.index.add(["README.md", "media/image.png", "media/subfolder/a.pdf"])
+
+    media_path = path.join(repo_path, "media")
+    assert git_media_hashes(repo_path, media_path) == hash_media(
+        media_path, {}
+    )
+
+    rmtree(path.dirname(repo_path))
+
+
 def test_find_files():
     source_dir = path.join(fixtures_path, "find_files", "source_dir")
     output_dir = path.join(fixtures_path, "find_files", "output_dir")
@@ -224,6 +451,23 @@ def test_find_files():
     assert unmodified_files == [paths["unchanged_md"]]
     assert uppercase_files == [paths["readme"]]
 
+    # Check it honours recorded build times for outputs left untouched
+    files = find_files(
+        source_dir,
+        output_dir,
+        {},
+        {path.normpath(paths["modified_html"]): new},
+    )
+
+    assert files[1] == []
+    assert sorted(files[2]) == sorted(
+        [
+            paths["unchanged_md"],
+            paths["unchanged_sub_md"],
+            paths["modified_md"],
+        ]
+    )
+
 
 def test_find_metadata():
     source_dir = path.join(fixtures_path, "find_metadata", "source_dir")
@@ -246,6 +490,59 @@ def test_find_metadata():
         find_metadata(empty_dir)
 
 
+def test_load_and_save_build_state():
+    output_dir = path.join(fixtures_path, "build_state", "output")
+
+    if path.exists(output_dir):
+        rmtree(output_dir)
+
+    # No previous build gives an empty state
+    assert load_build_state(output_dir) == {"outputs": {}}
+
+    state = {"outputs": {"en/index.html": {"hash": "abc", "size": 3}}}
+    save_build_state(output_dir, state)
+
+    assert load_build_state(output_dir) == state
+
+    # A corrupted state is treated as no state
+    state_path = path.join(output_dir, ".documentation-builder", "state.json")
+    with open(state_path, "w") as state_file:
+        state_file.write("{not json")
+
+    assert load_build_state(output_dir) == {"outputs": {}}
+
+    rmtree(path.dirname(output_dir))
+
+
+def test_highlight_timer():
+    parser = markdown.Markdown(markdown_extensions)
+    content = (
+        "``` python\nprint('fenced')\n```\n\n"
+        "Text\n\n"
+        "    :::python\n    print('indented')\n"
+    )
+
+    with HighlightTimer(parser) as highlighting:
+        html = parser.convert(content)
+
+    assert html.count('class="codehilite"') == 2
+    assert highlighting.blocks == 2
+    assert highlighting.seconds > 0
+
+    # Highlighting isn't counted outside the with block,
+    # or by other parsers
+    other_parser = markdown.Markdown(markdown_extensions)
+
+    with HighlightTimer(parser) as other_highlighting:
+        other_parser.convert(content)
+
+    assert other_highlighting.blocks == 0
+    parser.reset()
+    parser.convert(content)
+    assert highlighting.blocks == 2
+    assert "run" not in vars(parser.treeprocessors["hilite"])
+
+
 def test_parse_markdown():
     function_fixtures = path.join(fixtures_path, "parse_markdown")
     metadata_path = path.join(function_fixtures, "metadata.yaml")
@@ -278,11 +575,16 @@ def test_parse_markdown():
     plain_html_error = parse_markdown(
         parser, template, plain_error_path, metadata
     )
+    with open(plain_path, encoding="utf-8") as plain_file:
+        preread_html = parse_markdown(
+            parser, template, "unread.md", metadata, plain_file.read()
+        )
 
     with open(plain_output_path, encoding="utf-8") as plain_output_file:
         expected_plain_html = plain_output_file.read().strip()
         assert plain_html == expected_plain_html
         assert plain_html_error == expected_plain_html
+        assert preread_html == plain_html
 
     with open(metadata_output_path, encoding="utf-8") as metadata_output_file:
         expected_metadata_html = metadata_output_file.read().strip()
@@ -450,6 +752,62 @@ def test_replace_internal_links():
     )
     assert output_no_extensions == expected_output_no_extensions
 
+    # Links to pages and anchors can be collected
+    links = []
+    replace_internal_links(
+        input_html + '<a href="#top">top</a><a href="img.png">image</a>',
+        links=links
+    )
+    assert links == [
+        "page1.md", "../page2.md", "subfolder/page3.md", "#top"
+    ]
+
+
+def test_find_broken_links():
+    pages = {
+        "en/index.html": {
+            "anchors": ["top"],
+            "links": [
+                ["#top", 1],
+                ["#bottom", 2],
+                ["sub/page.md#part%201", 3],
+                ["sub/page.md?q=1#part-2", 4],
+                ["missing.md", 5],
+            ],
+        },
+        "en/sub/page.html": {
+            "anchors": ["part 1"],
+            "links": [["../index.html", 1], ["../../fr/index.md", 2]],
+        },
+    }
+
+    assert find_broken_links(pages) == [
+        ("en/index.html", "#bottom", 2, "no such anchor"),
+        ("en/index.html", "sub/page.md?q=1#part-2", 4, "no such anchor"),
+        ("en/index.html", "missing.md", 5, "no such page"),
+        ("en/sub/page.html", "../../fr/index.md", 2, "no such page"),
+    ]
+
+
+def test_page_anchors():
+    html = (
+        '<h2 id="intro">Intro</h2><a name="old"></a>'
+        "<div id='intro'><p data-id=\"no\">Text</p></div>"
+    )
+
+    assert page_anchors(html) == ["intro", "old"]
+
+
+def test_source_lines():
+    content = "[a](a.md)\n\n[b](b.md) [a](a.md)\n"
+
+    assert source_lines(content, ["a.md", "b.md", "a.md", "a.md", "c"]) == [
+        1, 3, 3, None, None
+    ]
+
+    # Strings found out of order still get their own lines
+    assert source_lines(content, ["b.md", "a.md", "a.md"]) == [3, 1, 3]
+
 
 def test_replace_media_links():
     html = (
@@ -473,6 +831,303 @@ def test_replace_media_links():
     )
     assert output_absolute == expected_output_absolute
 
+    # Linked media files can be collected
+    references = set()
+    html = (
+        '<img src="../media/some%20image.png" />'
+        '<a href="../media/sub/doc.pdf#page=2">doc</a>'
+    )
+    output_references = replace_media_links(
+        html, "media", "static", "en", references
+    )
+    assert output_references == (
+        '<img src="../static/some%20image.png" />'
+        '<a href="../static/sub/doc.pdf#page=2">doc</a>'
+    )
+    assert references == {"some image.png", "sub/doc.pdf"}
+
+    # Media files can also be renamed
+    output_renamed = replace_media_links(
+        html,
+        "media",
+        "static",
+        "en",
+        filenames={"some image.png": "ab/cdef.png"},
+    )
+    assert output_renamed == (
+        '<img src="../static/ab/cdef.png" />'
+        '<a href="../static/sub/doc.pdf#page=2">doc</a>'
+    )
+
+
+def test_responsive_images():
+    images = responsive_images(
+        {"shot.png": [1000, 500], "small.jpg": [300, 200]},
+        [480, 960, 1440],
+        {"shot.png": "shot.0123456789ab.png"},
+    )
+    assert images["shot.png"] == {
+        "width": 1000,
+        "height": 500,
+        "srcset": [
+            ["shot.0123456789ab.480w.png", 480],
+            ["shot.0123456789ab.960w.png", 960],
+            ["shot.0123456789ab.png", 1000],
+        ],
+        "webp": [
+            ["shot.0123456789ab.480w.webp", 480],
+            ["shot.0123456789ab.960w.webp", 960],
+            ["shot.0123456789ab.1000w.webp", 1000],
+        ],
+        "variants": [
+            ["shot.0123456789ab.480w.png", 480],
+            ["shot.0123456789ab.960w.png", 960],
+            ["shot.0123456789ab.480w.webp", 480],
+            ["shot.0123456789ab.960w.webp", 960],
+            ["shot.0123456789ab.1000w.webp", 1000],
+        ],
+    }
+    assert images["small.jpg"]["variants"] == [["small.300w.webp", 300]]
+
+    # Image tags get their attributes through replace_media_links
+    html = (
+        '<p><img alt="Shot" src="../media/shot.png" /></p>'
+        '<p><img src="../media/other.png" width="10"></p>'
+    )
+    output = replace_media_links(
+        html, "media", "static", "en", images=images
+    )
+    assert output == (
+        '<p><picture><source type="image/webp" srcset="'
+        "../static/shot.0123456789ab.480w.webp 480w, "
+        "../static/shot.0123456789ab.960w.webp 960w, "
+        '../static/shot.0123456789ab.1000w.webp 1000w" '
+        'sizes="(max-width: 1000px) 100vw, 1000px" />'
+        '<img alt="Shot" src="../static/shot.png" width="1000" '
+        'height="500" loading="lazy" srcset="'
+        "../static/shot.0123456789ab.480w.png 480w, "
+        "../static/shot.0123456789ab.960w.png 960w, "
+        '../static/shot.0123456789ab.png 1000w" '
+        'sizes="(max-width: 1000px) 100vw, 1000px" /></picture></p>'
+        '<p><img src="../static/other.png" width="10"></p>'
+    )
+
+
+def test_generate_image_variants():
+    Image = pytest.importorskip("PIL.Image")
+    function_fixtures = path.join(fixtures_path, "generate_image_variants")
+    media_path = path.join(function_fixtures, "media")
+    output_path = path.join(function_fixtures, "output")
+    cache_path = path.join(function_fixtures, "cache")
+    rmtree(function_fixtures, ignore_errors=True)
+    makedirs(media_path)
+
+    Image.new("RGB", (800, 400), "red").save(
+        path.join(media_path, "shot.png")
+    )
+    with open(path.join(media_path, "broken.png"), "w") as broken_file:
+        broken_file.write("not an image")
+    media_hashes = hash_media(media_path, {})
+
+    # Files which aren't images are ignored
+    sizes_cache = {}
+    sizes = image_sizes(media_path, media_hashes, sizes_cache)
+    assert sizes == {"shot.png": [800, 400]}
+    assert sizes_cache[media_hashes["broken.png"]] is None
+
+    images = responsive_images(sizes, [400])
+    variants = generate_image_variants(
+        media_path, output_path, images, media_hashes, cache_path
+    )
+    assert variants == [
+        path.join(output_path, "shot.400w.png"),
+        path.join(output_path, "shot.400w.webp"),
+        path.join(output_path, "shot.800w.webp"),
+    ]
+    with Image.open(variants[0]) as resized:
+        assert resized.size == (400, 200)
+    with Image.open(variants[1]) as webp:
+        assert webp.format == "WEBP"
+
+    # Variants are cached by the image's hash
+    rmtree(output_path)
+    remove(path.join(media_path, "shot.png"))
+    generate_image_variants(
+        media_path, output_path, images, media_hashes, cache_path
+    )
+    assert path.isfile(variants[2])
+
+    rmtree(function_fixtures)
+
+
+def test_minify_html():
+    html = (
+        "<!doctype html>\n<html>\n  <head>\n    <!-- Comment -->\n"
+        "    <title> Title </title>\n"
+        "    <script>\n      var a  =  1;\n    </script>\n"
+        "  </head>\n  <body>\n"
+        "    <p>Some   <strong>bold</strong>  text<!-- x -->here</p>\n"
+        "    <pre><code>  keep\n     this  </code></pre>\n"
+        '    <a  href="x"   title="a  b"\n       class="c" >one</a>\n'
+        '    <a href="y">two</a>\n'
+        "    <p>Inline <code>a  b</code> <img src='a.png' /></p>\n"
+        "    <textarea>  typed\n  text</textarea>\n"
+        "    <!--[if IE]><p>IE</p><![endif]-->\n"
+        "  </body>\n</html>\n"
+    )
+
+    assert minify_html(html) == (
+        "<!doctype html><html><head><title>Title</title>"
+        "<script>\n      var a  =  1;\n    </script></head><body>"
+        "<p>Some <strong>bold</strong> texthere</p>"
+        "<pre><code>  keep\n     this  </code></pre>"
+        '<a href="x" title="a  b" class="c">one</a> <a href="y">two</a>'
+        "<p>Inline <code>a  b</code> <img src='a.png'/></p>"
+        "<textarea>  typed\n  text</textarea> "
+        "<!--[if IE]><p>IE</p><![endif]--></body></html>"
+    )
+
+    # A ">" in a quoted attribute value doesn't end the tag
+    assert minify_html('<div title="a > b">\n  x </div>') == (
+        '<div title="a > b">x</div>'
+    )
+    assert minify_html("<p><span  title='>'   class=\"a\"> x </span></p>") == (
+        "<p><span title='>' class=\"a\"> x </span></p>"
+    )
+
+    # Non-breaking spaces are text, not whitespace to collapse or strip
+    assert minify_html("<p>\xa0Bonjour\xa0:  &nbsp;x\xa0</p>") == (
+        "<p>\xa0Bonjour\xa0: &nbsp;x\xa0</p>"
+    )
+
+
+def test_search_document():
+    html = (
+        "<html><head><title>Page | Site</title></head><body>"
+        "<nav>Navigation links</nav>"
+        "<main><h1>Install  guide</h1><p>Install the snap.</p>"
+        "<h2>Snap channels</h2><pre><code>snap install a</code></pre>"
+        "<footer>Copyright</footer></main>"
+        "</body></html>"
+    )
+
+    assert search_document(html) == {
+        "title": "Install guide",
+        "terms": {
+            "install": 16,
+            "guide": 14,
+            "snap": 6,
+            "channels": 4,
+            "the": 1,
+        },
+    }
+
+    # Without a heading, the page title is used
+    assert search_document(
+        "<title>Page | Site</title><main><p>Text</p></main>"
+    )["title"] == "Page"
+
+
+def test_build_search_index():
+    documents = {
+        "a.html": {"title": "A", "terms": {"apple": 2, "banana": 1}},
+        "b.html": {"title": "B", "terms": {"apple": 1, "_x": 1}},
+    }
+
+    urls, pages, shards = build_search_index(documents)
+
+    assert urls == ["a.html", "b.html"]
+    assert pages == [["a.html", "A"], ["b.html", "B"]]
+    assert shards == {
+        "a": {"apple": [[0, 2], [1, 1]]},
+        "b": {"banana": [[0, 1]]},
+        "_": {"_x": [[1, 1]]},
+    }
+
+    # Pages keep their numbers, with new pages filling gaps
+    del documents["a.html"]
+    documents["c.html"] = {"title": "C", "terms": {"cherry": 1}}
+    documents["d.html"] = {"title": "D", "terms": {"apple": 3}}
+
+    urls, pages, shards = build_search_index(documents, urls)
+
+    assert urls == ["c.html", "b.html", "d.html"]
+    assert shards["a"] == {"apple": [[1, 1], [2, 3]]}
+    assert shards["_"] == {"_x": [[1, 1]]}
+
+    # Unused numbers at the end are dropped
+    urls, pages, shards = build_search_index(
+        {"b.html": documents["b.html"]}, urls
+    )
+
+    assert urls == [None, "b.html"]
+    assert pages == [None, ["b.html", "B"]]
+
+
+def test_sitemap_xml():
+    entries = [("https://example.com/a&b", 0), ("https://example.com/", 60)]
+
+    assert sitemap_xml(entries) == (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+        "<url><loc>https://example.com/a&amp;b</loc>"
+        "<lastmod>1970-01-01T00:00:00Z</lastmod></url>\n"
+        "<url><loc>https://example.com/</loc>"
+        "<lastmod>1970-01-01T00:01:00Z</lastmod></url>\n"
+        "</urlset>\n"
+    )
+    assert sitemap_xml(entries[1:], index=True) == (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">'
+        "\n<sitemap><loc>https://example.com/</loc>"
+        "<lastmod>1970-01-01T00:01:00Z</lastmod></sitemap>\n"
+        "</sitemapindex>\n"
+    )
+
+
+def test_shared_navigation():
+    navigation = [
+        {"title": "Home", "location": "index.md"},
+        {
+            "title": "Guides",
+            "children": [
+                {"title": "Install", "location": "guides/install.md#snap"},
+                {"title": "Elsewhere", "location": "https://example.com/a.md"},
+            ],
+        },
+    ]
+
+    # Internal links are converted as in pages
+    assert navigation_json(navigation) == (
+        '[{"location":"index.html","title":"Home"},'
+        '{"children":[{"location":"guides/install.html#snap",'
+        '"title":"Install"},{"location":"https://example.com/a.md",'
+        '"title":"Elsewhere"}],"title":"Guides"}]'
+    )
+    assert '"guides/install#snap"' in navigation_json(navigation, False)
+
+    # Each location leads to its trail of items
+    index = navigation_index(navigation)
+    assert sorted(index.keys()) == [
+        path.join("guides", "install"),
+        "https:/example.com/a",
+        "index",
+    ]
+    assert [item["title"] for item in index["guides/install"]] == [
+        "Guides",
+        "Install",
+    ]
+
+    # The navigation comes from the closest metadata that defines it
+    metadata_items = {
+        ".": {"content": {"navigation": navigation}},
+        "en": {"content": {"navigation": navigation}},
+        "en/guides": {"content": {"title": "Guides"}},
+    }
+    assert navigation_scope(metadata_items, "en/guides") == "en"
+    assert navigation_scope(metadata_items, "fr") == "."
+    assert navigation_scope({".": {"content": {}}}, "fr") is None
+
 
 def test_set_active_navigation_items():
     navigation_items = [
@@ -528,6 +1183,37 @@ def test_set_active_navigation_items():
     assert navigation_items[1]["children"][0]["children"][1].get("active")
 
 
+def test_version_branch_commits():
+    repo_path = path.join(fixtures_path, "version_branch_commits", "repo")
+
+    if path.exists(repo_path):
+        rmtree(repo_path)
+
+    repo = Repo.init(repo_path)
+    with repo.config_writer() as config:
+        config.set_value("user", "name", "Tester")
+        config.set_value("user", "email", "tester@example.com")
+    with open(path.join(repo_path, "versions"), "w") as versions_file:
+        versions_file.write("1.0\n\nlatest\n")
+    repo.index.add(["versions"])
+    first_commit = repo.index.commit("First")
+    repo.create_head("1.0", first_commit)
+    second_commit = repo.index.commit("Second")
+    repo.create_head("latest", second_commit)
+
+    assert version_branch_commits(repo_path) == {
+        "1.0": first_commit.hexsha,
+        "latest": second_commit.hexsha,
+    }
+
+    # A missing branch means there's no reliable set of commits
+    with open(path.join(repo_path, "versions"), "a") as versions_file:
+        versions_file.write("2.0\n")
+    assert version_branch_commits(repo_path) is None
+
+    rmtree(path.dirname(repo_path))
+
+
 def test_version_paths():
     function_fixtures = path.join(fixtures_path, "version_paths")
     version_branches = {
@@ -582,7 +1268,16 @@ def test_convert_path_to_html():
     assert new_path == "path/to/toto"
 
 
-def test_write_html():
+def test_sitemap_location():
+    assert sitemap_location("index.md") == ""
+    assert sitemap_location("en/index.md") == "en/"
+    assert sitemap_location("en/page.html") == "en/page"
+    # Only a whole "index" file name is left out
+    assert sitemap_location("en/reindexing.md") == "en/reindexing"
+    assert sitemap_location("index/page.md") == "index/page"
+
+
+def test_write_html(monkeypatch):
     html_content = "<html>\n<body>\n<h1>Hello</h1>\n<body>\n</html>"
     html_dir = path.join(fixtures_path, "write_html", "subdir")
     md_filepath = path.join(html_dir, "file.md")
@@ -599,5 +1294,33 @@ def test_write_html():
     with open(html_filepath, encoding="utf-8") as html_file:
         assert html_file.read() == html_content
 
+    # Overwriting is atomic, leaving no temporary files behind
+    write_html("<p>Updated</p>", md_filepath)
+    assert listdir(html_dir) == ["file.html"]
+    with open(html_filepath, encoding="utf-8") as html_file:
+        assert html_file.read() == "<p>Updated</p>"
+
+    # Files get the permissions of the umask when they're first written
+    monkeypatch.setattr(utilities, "_umask", None)
+    original_umask = umask(0o027)
+    try:
+        write_html("<p>Private</p>", md_filepath)
+    finally:
+        umask(original_umask)
+    assert stat(html_filepath).st_mode & 0o777 == 0o640
+
+    # Without /proc, the umask is read by setting it and back again
+    def no_proc(filepath, *args, **kwargs):
+        raise FileNotFoundError(filepath)
+
+    monkeypatch.setattr(utilities, "_umask", None)
+    monkeypatch.setattr(utilities, "open", no_proc, raising=False)
+    original_umask = umask(0o027)
+    try:
+        assert utilities.process_umask() == 0o027
+        assert umask(0o027) == 0o027
+    finally:
+        umask(original_umask)
+
     # Delete it again
     rmtree(html_dir)
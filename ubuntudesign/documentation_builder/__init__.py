@@ -1,5 +1,10 @@
-import pkg_resources
+try:
+    from importlib.metadata import version
+except ImportError:
+    # Python < 3.8, where pkg_resources is much slower to import
+    from pkg_resources import get_distribution
 
-__version__ = pkg_resources.get_distribution(
-    "ubuntudesign.documentation_builder"
-).version
+    def version(distribution_name):
+        return get_distribution(distribution_name).version
+
+__version__ = version("ubuntudesign.documentation_builder")
@@ -0,0 +1,531 @@
+# Core modules
+import json
+import platform
+import random
+import statistics
+import struct
+import tempfile
+import time
+import zlib
+from os import makedirs, path
+from shutil import copytree, rmtree
+
+# Third party modules
+import markdown
+from jinja2 import Template
+
+# Local modules
+from . import __version__
+from .builder import Builder, default_template, markdown_extensions
+from .operations import (
+    compile_metadata,
+    copy_media,
+    find_files,
+    find_metadata,
+    parse_markdown,
+    replace_internal_links,
+    replace_media_links,
+    write_html,
+)
+
+
+# How many times the relative spread of a stage's times a change
+# has to be to count as more than noise
+noise_factor = 3
+# The stages run_benchmarks times, in order
+stages = [
+    "find_metadata",
+    "find_files",
+    "compile_metadata",
+    "parse_markdown",
+    "rewrite_links",
+    "write_html",
+    "copy_media",
+    "build_cold",
+    "build_warm",
+    "build_one_changed",
+]
+words = (
+    "build snap charm model machine unit relation config deploy network "
+    "storage cloud controller release channel bundle application cluster "
+    "service instance image kernel package install upgrade documentation"
+).split()
+
+
+def _sentence(rng, length=12):
+    text = " ".join(rng.choice(words) for index in range(length))
+
+    return text.capitalize() + "."
+
+
+def _png(width, height, shade):
+    """
+    A minimal valid PNG image of a single grey shade
+    """
+
+    def chunk(kind, data):
+        return (
+            struct.pack(">I", len(data)) +
+            kind +
+            data +
+            struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+        )
+
+    rows = b"".join(b"\x00" + bytes([shade]) * width for row in range(height))
+
+    return (
+        b"\x89PNG\r\n\x1a\n" +
+        chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0)) +
+        chunk(b"IDAT", zlib.compress(rows)) +
+        chunk(b"IEND", b"")
+    )
+
+
+def generate_corpus(
+    base_directory,
+    pages=100,
+    depth=2,
+    folder_metadata=True,
+    navigation_size=20,
+    code_blocks=2,
+    frontmatter=0.5,
+    media=10,
+    versions=None,
+    seed=0,
+):
+    """
+    Generate a synthetic documentation repository in base_directory:
+    - `pages` markdown files, spread over an `en` folder and
+      three subfolders in each folder, `depth` levels deep
+    - A metadata.yaml in each subfolder, if `folder_metadata`
+    - A navigation of `navigation_size` items
+    - `code_blocks` highlighted code blocks in each page
+    - Frontmatter in a `frontmatter` fraction of the pages
+    - `media` images, each linked to from some pages
+    - If a list of `versions` is given, a git repository
+      with a branch for each, and a versions file listing them
+    The same `seed` always generates the same corpus.
+    """
+
+    rng = random.Random(seed)
+    folders = ["en"]
+    level_folders = ["en"]
+
+    for level in range(depth):
+        level_folders = [
+            path.join(folder, "topic-{}".format(number))
+            for folder in level_folders
+            for number in range(3)
+        ]
+        folders.extend(level_folders)
+
+    page_paths = ["en/index.md"] + [
+        path.join(folders[number % len(folders)], "page-{}.md".format(number))
+        for number in range(1, pages)
+    ]
+
+    for folder in folders:
+        makedirs(path.join(base_directory, folder), exist_ok=True)
+
+        if folder_metadata and folder != "en":
+            metadata_filepath = path.join(
+                base_directory, folder, "metadata.yaml"
+            )
+
+            with open(metadata_filepath, "w") as metadata_file:
+                metadata_file.write(
+                    'site_footer_text: "{}"\n'.format(_sentence(rng, 4))
+                )
+
+    with open(path.join(base_directory, "metadata.yaml"), "w") as site_file:
+        site_file.write('site_title: "Synthetic documentation"\n')
+
+    navigation_filepath = path.join(base_directory, "en", "metadata.yaml")
+
+    with open(navigation_filepath, "w") as navigation_file:
+        navigation_file.write("navigation:\n")
+
+        for page_path in page_paths[:navigation_size]:
+            navigation_file.write(
+                "    - title: {}\n      location: {}\n".format(
+                    _sentence(rng, 3).rstrip("."),
+                    path.relpath(page_path, "en"),
+                )
+            )
+
+    media_directory = path.join(base_directory, "media")
+    makedirs(media_directory, exist_ok=True)
+
+    for number in range(media):
+        with open(
+            path.join(media_directory, "image-{}.png".format(number)), "wb"
+        ) as image_file:
+            image_file.write(_png(32 + number % 32, 24, number % 256))
+
+    for number, page_path in enumerate(page_paths):
+        title = _sentence(rng, 4).rstrip(".")
+        folder = path.dirname(page_path)
+        lines = []
+
+        if rng.random() < frontmatter:
+            lines.extend(["---", 'title: "{}"'.format(title), "---", ""])
+
+        lines.extend(["# " + title, "", _sentence(rng, 30), ""])
+
+        for section in range(3):
+            lines.extend(
+                [
+                    "## " + _sentence(rng, 3).rstrip("."),
+                    "",
+                    _sentence(rng, 40),
+                    "",
+                    "See [{}]({}) or [the start](#{}).".format(
+                        _sentence(rng, 2).rstrip("."),
+                        path.relpath(rng.choice(page_paths), folder),
+                        title.lower().replace(" ", "-"),
+                    ),
+                    "",
+                ]
+            )
+
+        for block in range(code_blocks):
+            lines.extend(["``` python"])
+            lines.extend(
+                "{} = {}('{}')".format(
+                    rng.choice(words), rng.choice(words), rng.choice(words)
+                )
+                for line in range(10)
+            )
+            lines.extend(["```", ""])
+
+        if media:
+            lines.extend(
+                [
+                    "![{}]({})".format(
+                        title,
+                        path.relpath(
+                            path.join(
+                                "media",
+                                "image-{}.png".format(number % media),
+                            ),
+                            folder,
+                        ),
+                    ),
+                    "",
+                ]
+            )
+
+        with open(path.join(base_directory, page_path), "w") as page_file:
+            page_file.write("\n".join(lines))
+
+    if versions:
+        from git import Repo
+
+        with open(path.join(base_directory, "versions"), "w") as versions_file:
+            versions_file.write("\n".join(versions) + "\n")
+
+        repo = Repo.init(base_directory)
+        repo.git.add(A=True)
+        repo.index.commit("Synthetic documentation")
+        index_filepath = path.join(base_directory, "en", "index.md")
+
+        for version in versions:
+            repo.git.checkout("-B", version, repo.heads[0].name)
+
+            with open(index_filepath, "a") as page:
+                page.write("\nThis is version {}.\n".format(version))
+
+            repo.git.add(A=True)
+            repo.index.commit("Version {}".format(version))
+
+        repo.git.checkout(versions[0])
+
+    return page_paths
+
+
+def _time(function):
+    start = time.perf_counter()
+    function()
+
+    return time.perf_counter() - start
+
+
+def run_benchmarks(
+    base_directory,
+    repeat=5,
+    source_folder=".",
+    build_version_branches=False,
+    out=None,
+):
+    """
+    Time each of the stages of building the documentation
+    in base_directory, `repeat` times.
+    The Builder is run on a copy of base_directory,
+    which the "build_one_changed" stage changes one page in
+    (it's skipped when building version branches).
+    Return the times in seconds, as {stage: [seconds, ...]}
+    """
+
+    work_directory = tempfile.mkdtemp()
+    base = path.join(work_directory, "base")
+    output = path.join(work_directory, "build")
+    # Version branches are cloned in here too, so they're removed with it
+    clone_path = path.join(work_directory, "clones")
+    copytree(base_directory, base, symlinks=True)
+
+    source_path = path.normpath(path.join(base, source_folder))
+    media_path = path.join(source_path, "media")
+    metadata_items = find_metadata(source_path)
+    # The pages the Builder builds, leaving out files like README.md
+    new_files, modified_files, unmodified_files, uppercase_files = find_files(
+        source_path, output, metadata_items
+    )
+    filepaths = sorted(new_files + modified_files + unmodified_files)
+
+    parser = markdown.Markdown(extensions=markdown_extensions)
+
+    with open(default_template, encoding="utf-8") as template_file:
+        template = Template(template_file.read())
+
+    def build(output_path=output):
+        Builder(
+            base_directory=base,
+            source_folder=source_folder,
+            output_path=output_path,
+            build_version_branches=build_version_branches,
+            clone_path=clone_path,
+            quiet=True,
+        )
+
+    # An initial build, for the stages to compare against
+    build()
+
+    directories = sorted(
+        set(
+            path.relpath(path.dirname(filepath), source_path)
+            for filepath in filepaths
+        )
+    )
+    metadata = {
+        directory: compile_metadata(metadata_items, directory)
+        for directory in directories
+    }
+    rendered = []
+
+    def render():
+        del rendered[:]
+
+        for filepath in filepaths:
+            directory = path.relpath(path.dirname(filepath), source_path)
+            rendered.append(
+                (
+                    filepath,
+                    directory,
+                    parse_markdown(
+                        parser, template, filepath, metadata[directory]
+                    ),
+                )
+            )
+
+    def rewrite_links():
+        for filepath, directory, html in rendered:
+            html = replace_media_links(
+                html,
+                old_path="media",
+                new_path="media",
+                context_directory=directory,
+                references=set(),
+            )
+            replace_internal_links(html, links=[])
+
+    def write_pages():
+        write_path = tempfile.mkdtemp(dir=work_directory)
+
+        for filepath, directory, html in rendered:
+            write_html(
+                html,
+                path.join(write_path, path.relpath(filepath, source_path)),
+            )
+
+    def copy():
+        copy_media(media_path, tempfile.mkdtemp(dir=work_directory))
+
+    def build_cold():
+        build(tempfile.mkdtemp(dir=work_directory))
+
+    changes = [0]
+
+    def build_one_changed():
+        changes[0] += 1
+
+        with open(filepaths[0], "a") as page_file:
+            page_file.write("\nChange {}.\n".format(changes[0]))
+
+        build()
+
+    benchmarks = {
+        "find_metadata": lambda: find_metadata(source_path),
+        "find_files": lambda: find_files(
+            source_path, output, metadata_items
+        ),
+        "compile_metadata": lambda: [
+            compile_metadata(metadata_items, directory)
+            for directory in directories
+        ],
+        "parse_markdown": render,
+        "rewrite_links": rewrite_links,
+        "write_html": write_pages,
+        "copy_media": copy,
+        "build_cold": build_cold,
+        "build_warm": build,
+        "build_one_changed": build_one_changed,
+    }
+
+    if build_version_branches:
+        del benchmarks["build_one_changed"]
+
+    if not path.isdir(media_path):
+        del benchmarks["copy_media"]
+
+    results = {}
+
+    try:
+        for stage in stages:
+            if stage not in benchmarks:
+                continue
+
+            results[stage] = [
+                _time(benchmarks[stage]) for iteration in range(repeat)
+            ]
+
+            if out:
+                print(
+                    "{:<20} {:>10.2f} ms median".format(
+                        stage, statistics.median(results[stage]) * 1000
+                    ),
+                    file=out,
+                )
+    finally:
+        rmtree(work_directory)
+
+    return results
+
+
+def summarise(times):
+    """
+    The median, minimum and maximum of a list of times,
+    and their median absolute deviation, as a measure of noise
+    """
+
+    median = statistics.median(times)
+
+    return {
+        "median": median,
+        "min": min(times),
+        "max": max(times),
+        "mad": statistics.median(abs(seconds - median) for seconds in times),
+    }
+
+
+def save_results(filepath, results, options={}):
+    """
+    Save benchmark results (from run_benchmarks) as a JSON baseline,
+    along with the options used and what they were run with
+    """
+
+    with open(filepath, "w") as results_file:
+        json.dump(
+            {
+                "builder_version": __version__,
+                "python_version": platform.python_version(),
+                "options": options,
+                "stages": {
+                    stage: dict(summarise(times), times=times)
+                    for stage, times in results.items()
+                },
+            },
+            results_file,
+            indent=2,
+            sort_keys=True,
+        )
+
+
+def load_results(filepath):
+    """
+    Load benchmark results saved by save_results.
+    Return them as {stage: [seconds, ...]}, and the options they used
+    """
+
+    with open(filepath) as results_file:
+        baseline = json.load(results_file)
+
+    results = {
+        stage: summary["times"]
+        for stage, summary in baseline["stages"].items()
+    }
+
+    return results, baseline.get("options", {})
+
+
+def compare_results(baseline, results, threshold=0.1):
+    """
+    Compare the median time of each stage in the results with a baseline
+    (both as {stage: [seconds, ...]}).
+    A change counts if it's more than the threshold (as a fraction),
+    and more than the noise: `noise_factor` times the relative median
+    absolute deviation of the noisier of the two runs.
+    Return a list of comparisons, with the status of each stage:
+    "regressed", "improved" or "unchanged"
+    """
+
+    comparisons = []
+
+    for stage in stages:
+        if stage not in baseline or stage not in results:
+            continue
+
+        before = summarise(baseline[stage])
+        after = summarise(results[stage])
+
+        if not before["median"]:
+            continue
+
+        change = after["median"] / before["median"] - 1
+        noise = noise_factor * max(
+            before["mad"] / before["median"],
+            after["mad"] / after["median"] if after["median"] else 0,
+        )
+        status = "unchanged"
+
+        if abs(change) > max(threshold, noise):
+            status = "regressed" if change > 0 else "improved"
+
+        comparisons.append(
+            {
+                "stage": stage,
+                "before": before["median"],
+                "after": after["median"],
+                "change": change,
+                "noise": noise,
+                "status": status,
+            }
+        )
+
+    return comparisons
+
+
+def format_comparison(comparison):
+    """
+    Describe a comparison from compare_results,
+    e.g. "parse_markdown +18% median (1200.00 to 1416.00 ms, noise ±3%)"
+    """
+
+    return (
+        "{} {:+.0%} median ({:.2f} to {:.2f} ms, noise \u00b1{:.0%})"
+    ).format(
+        comparison["stage"],
+        comparison["change"],
+        comparison["before"] * 1000,
+        comparison["after"] * 1000,
+        comparison["noise"],
+    )
@@ -1,6 +1,11 @@
 # Core modules
+import json
 import sys
-from os import path
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from os import makedirs, path
+from urllib.parse import quote
 
 # Third party modules
 import markdown
@@ -16,21 +21,71 @@ from mdx_anchors_away import AnchorsAwayExtension
 from mdx_foldouts import makeExtension as FoldoutsExtension
 
 # Local modules
+from . import __version__
 from .operations import (
+    asset_path,
+    build_fingerprint,
+    build_search_index,
     compile_metadata,
-    copy_media,
+    compress_file,
+    compressible_extensions,
+    compression_formats,
+    content_addressed_filenames,
+    find_broken_links,
     find_files,
     find_metadata,
+    fingerprinted_filenames,
+    generate_image_variants,
+    git_media_hashes,
+    hash_media,
+    image_sizes,
+    load_build_fingerprint,
+    load_build_state,
+    minify_html,
+    navigation_index,
+    navigation_json,
+    navigation_scope,
+    page_anchors,
     replace_internal_links,
     replace_media_links,
     parse_markdown,
     prepare_version_branches,
+    responsive_images,
+    save_build_state,
+    search_document,
     set_active_navigation_items,
+    sitemap_limit,
+    sitemap_location,
+    sitemap_xml,
+    source_lines,
+    state_folder,
+    store_media,
+    sync_media,
+    version_branch_commits,
+    version_map,
     version_paths,
+    write_asset,
+    write_change_manifest,
     write_html,
     convert_path_to_html
 )
-from .extensions import NotificationsExtension
+from .extensions import HighlightTimer, NotificationsExtension
+from .utilities import (
+    BoundedExecutor,
+    MemoryProfiler,
+    Tracer,
+    atomic_write,
+    cache_dir,
+    content_hash,
+    file_hash,
+    is_inside,
+    process_umask,
+    read_ahead,
+    read_file,
+    relativize,
+    remove_file,
+    walk_files,
+)
 
 
 # Defaults
@@ -39,6 +94,11 @@ default_template = path.join(
     'resources',
     'template.html'
 )
+default_stylesheet = path.join(
+    path.dirname(__file__),
+    'resources',
+    'template.css'
+)
 markdown_extensions = [
     MetaExtension(),
     TableExtension(),
@@ -54,6 +114,21 @@ markdown_extensions = [
 
 
 class Builder():
+    """
+    Build documentation from markdown files into HTML.
+    Creating a Builder builds the documentation straight away,
+    with the results in `builder.result`.
+    With `defer_build=True` it's only set up, and keeps its markdown parser,
+    compiled template and the records of its last build between builds,
+    so it can be reused to build the same documentation again cheaply:
+
+        builder = Builder(
+            base_directory='docs', output_path='build', defer_build=True
+        )
+        result = builder.build()
+        result = builder.build(files=['en/index.md'])
+    """
+
     def __init__(
         self,
         base_directory='.',
@@ -72,6 +147,30 @@ class Builder():
         tag_manager_code=None,
         no_link_extensions=False,
         no_cleanup=False,
+        io_threads=4,
+        manifest_path=None,
+        media_copy_mode='copy',
+        referenced_media_only=False,
+        content_addressed_media=False,
+        fingerprinted_media=False,
+        image_widths=None,
+        image_cache_path=None,
+        shared_navigation=False,
+        shared_versions=False,
+        precompress=False,
+        compress_workers=None,
+        minify=False,
+        search_index=False,
+        sitemap_url=None,
+        check_links=False,
+        trace_path=None,
+        cost_report=0,
+        max_page_ms=None,
+        max_page_bytes=None,
+        max_build_seconds=None,
+        memory_profile=False,
+        clone_path=None,
+        defer_build=False,
         quiet=False,
         out=sys.stdout,
         err=sys.stderr,
@@ -82,6 +181,9 @@ class Builder():
         # Properties
         self.quiet = quiet
         self.force = force
+        self.build_version_branches = build_version_branches
+        self.template_path = template_path
+        self.manifest_path = manifest_path
         self.site_root = site_root
         self.source_folder = source_folder
         self.base_directory = base_directory
@@ -91,6 +193,34 @@ class Builder():
         self.search_placeholder = search_placeholder
         self.search_domains = search_domains
         self.no_link_extensions = no_link_extensions
+        self.io_threads = max(1, io_threads)
+        self.media_copy_mode = media_copy_mode
+        self.referenced_media_only = referenced_media_only
+        self.content_addressed_media = content_addressed_media
+        self.fingerprinted_media = fingerprinted_media
+        self.rename_media = content_addressed_media or fingerprinted_media
+        self.image_widths = image_widths
+        self.image_cache_path = image_cache_path
+        self.clone_path = clone_path
+        self.shared_navigation = shared_navigation
+        self.shared_versions = shared_versions
+        self.precompress = precompress
+        self.minify = minify
+        self.search_index = search_index
+        self.sitemap_url = sitemap_url
+        self.check_links = check_links
+        self.trace_path = trace_path
+        self.tracer = Tracer(enabled=False)
+        self.cost_report = cost_report
+        self.max_page_ms = max_page_ms
+        self.max_page_bytes = max_page_bytes
+        self.max_build_seconds = max_build_seconds
+        self.page_costs = bool(
+            cost_report or max_page_ms or max_page_bytes
+        )
+        self.memory_profile = memory_profile
+        self.memory_profiler = None
+        self.compress_workers = compress_workers
         self.parser = markdown.Markdown(extensions=markdown_extensions)
         with open(template_path, encoding="utf-8") as template_file:
             self.template = Template(template_file.read())
@@ -98,53 +228,379 @@ class Builder():
             output_path, 'media'
         )
         self.media_path = media_path or path.join(source_path, 'media')
+        self.output_path = output_path
         self._out = out
         self._err = err
 
-        built_files = []
+        # The records of the last build, once loaded
+        self.state = None
+
+        if image_widths:
+            try:
+                import PIL  # noqa: F401
+            except ImportError:
+                self._fail(
+                    "Generating image variants needs Pillow:\n\n"
+                    "    pip install Pillow\n"
+                )
+
+            if not image_cache_path:
+                self.image_cache_path = path.join(
+                    cache_dir('documentation-builder'), 'images'
+                )
+
+        if not defer_build:
+            self.build()
+
+    def build(self, files=None):
+        """
+        Build the documentation, or if `files` is given (as paths relative
+        to the source folder), only rebuild those of its pages
+        which need rebuilding.
+        Return a dictionary of what the build did:
+        {
+            'built': [pages written, relative to the output folder],
+            'identical': [pages rebuilt identically, so not rewritten],
+            'skipped': [pages which didn't need rebuilding, or weren't
+                        among the files asked for],
+            'removed': [pages removed as their source files were deleted],
+            'over_budget': [descriptions of each budget exceeded],
+            'timings': {stage: seconds, ..., 'total': seconds},
+            'cache': {
+                'fingerprint': 'hit' (nothing had changed), 'miss' or None,
+                'state': 'memory' (kept from the last build) or 'disk',
+            },
+        }
+        When nothing has changed since the last build, the build stops
+        before looking at any pages, so none are listed.
+        """
+
+        try:
+            return self._build(files)
+        finally:
+            # Stop tracing allocations, even if the build failed
+            if self.memory_profiler:
+                self.memory_profiler.stop()
+
+    def _build(self, files):
+        """
+        Build the documentation, as described in build()
+        """
+
+        start_time = time.perf_counter()
+        base_directory = self.base_directory
+        output_path = self.output_path
+        manifest_path = self.manifest_path
+        build_version_branches = self.build_version_branches
 
         if not path.isdir(base_directory):
             raise FileNotFoundError(
                 'Base directory not found: {}'.format(base_directory)
             )
 
-        if build_version_branches:
-            version_branches = prepare_version_branches(
-                base_directory,
-                output_path
+        # Read before any threads are writing files, as it may mean
+        # briefly changing it
+        process_umask()
+
+        self.tracer = Tracer(enabled=bool(self.trace_path))
+        self.memory_profiler = (
+            MemoryProfiler() if self.memory_profile else None
+        )
+        self.files = None if files is None else set(
+            path.normpath(filepath) for filepath in files
+        )
+        # The records kept from the last build only hold while they're
+        # still in the output folder, which may have been deleted since
+        if not path.isfile(path.join(output_path, state_folder, 'state.json')):
+            self.state = None
+
+        # Total original size, minified size and count of minified pages
+        self.minified_sizes = [0, 0, 0]
+        self.changes = {'added': [], 'changed': [], 'removed': []}
+        self.result = {
+            'built': [],
+            'identical': [],
+            'skipped': [],
+            'removed': [],
+            'over_budget': [],
+            'timings': {},
+            'cache': {
+                'fingerprint': None,
+                'state': 'disk' if self.state is None else 'memory',
+            },
+        }
+
+        # Stop early if none of the inputs have changed since the last build
+        with self._stage('fingerprint'):
+            fingerprint = self.fingerprint(
+                path.normpath(
+                    path.join(base_directory, self.source_folder)
+                ),
+                self.template_path,
+                build_version_branches
+            )
+            unchanged = (
+                not self.force and
+                fingerprint and
+                fingerprint == load_build_fingerprint(output_path)
             )
 
-            for version_name, version_info in version_branches.items():
-                built_files = self.build_branch(
-                    version_info['base_directory'],
-                    version_info['output_path'],
-                    version_branches
+            # Outputs deleted since the last build still need building
+            if unchanged:
+                if self.state is None:
+                    self.state = load_build_state(output_path)
+
+                unchanged = all(
+                    path.exists(path.join(output_path, output))
+                    for output in self.state['outputs']
                 )
+
+        if fingerprint:
+            self.result['cache']['fingerprint'] = (
+                'hit' if unchanged else 'miss'
+            )
+
+        if unchanged:
+            self._print(
+                "Nothing has changed since the last build into {}".format(
+                    output_path
+                )
+            )
+
+            if manifest_path:
+                write_change_manifest(manifest_path, self.changes)
+
+            return self._finish(start_time)
+
+        if self.state is None:
+            self.state = load_build_state(output_path)
+
+        self.stored_media = set()
+        self.image_variants = set()
+        self.shared_files = set()
+        self.versions_filepath = None
+
+        # The default template's stylesheet is shared by all pages
+        self.stylesheet_filepath = None
+
+        if self.template_path == default_template:
+            self.stylesheet_filepath = asset_path(
+                default_stylesheet, path.join(output_path, 'css')
+            )
+
+        # The shared files built pages link to, recorded with each page,
+        # so pages linking to files which are no longer written
+        # (e.g. an older version of the stylesheet, media under names
+        # it's no longer given, or shared navigation or a search index
+        # which are no longer wanted) are rebuilt
+        self.shared_links = {
+            'stylesheet': self.stylesheet_filepath and path.relpath(
+                self.stylesheet_filepath, output_path
+            ),
+            'content_addressed_media': self.content_addressed_media,
+            'fingerprinted_media': self.fingerprinted_media,
+            'navigation': self.shared_navigation,
+            'search_index': self.search_index,
+        }
+
+        if build_version_branches:
+            with self._stage('prepare_version_branches', 'git'):
+                version_branches = prepare_version_branches(
+                    base_directory,
+                    output_path,
+                    tracer=self.tracer,
+                    clone_path=self.clone_path
+                )
+
+            if self.shared_versions:
+                self.version_map = version_map(
+                    version_branches,
+                    self.source_folder,
+                    extensions=(not self.no_link_extensions)
+                )
+                self.versions_filepath = self._write_shared_file(
+                    output_path,
+                    'versions',
+                    json.dumps(self.version_map, separators=(',', ':')),
+                    'versions'
+                )
+
+            for version_name, version_info in version_branches.items():
+                with self._stage('build_branch', version=version_name):
+                    built_files = self.build_branch(
+                        version_info['base_directory'],
+                        version_info['output_path'],
+                        version_branches
+                    )
                 if built_files:
                     self._print("Built:\n- {}".format(
                         '\n- '.join(built_files))
                     )
         else:
-            built_files = self.build_branch(base_directory, output_path)
+            with self._stage('build_branch'):
+                built_files = self.build_branch(base_directory, output_path)
 
             if built_files:
                 self._print("Built:\n- {}".format('\n- '.join(built_files)))
 
-        if path.isdir(self.media_path):
-            copy_media(self.media_path, self.output_media_path)
+        if self.minified_sizes[2]:
+            self.report_minified_sizes()
+
+        if self.check_links:
+            with self._stage('check_links'):
+                self.report_broken_links()
+
+        if self.stylesheet_filepath:
+            self.write_stylesheet(default_stylesheet)
+
+        if self.search_index:
+            with self._stage('write_search_indexes'):
+                self.write_search_indexes()
+        else:
+            self.state.pop('search_pages', None)
+
+        if self.sitemap_url:
+            self.write_sitemap()
+
+        if self.rename_media:
+            # Media was stored along with each branch, so remove
+            # anything copied by builds which kept the original names
+            self.media_references = set()
+        elif self.referenced_media_only:
+            self.media_references = self.find_media_references()
+        else:
+            self.media_references = None
+
+        with self._stage('prune'):
+            self.prune_media()
+            self.prune_image_variants()
+            self.prune_shared_files()
+
+        # Stored media no branch links to is removed,
+        # which is all of it once media is no longer renamed
+        self.prune_media_store()
+
+        if not self.rename_media and path.isdir(self.media_path):
+            with self._stage('copy_media', 'media'):
+                self.copy_media()
             self._print(
                 "Copied {} to {}".format(
                     self.media_path,
                     self.output_media_path
                 )
             )
-        else:
+        elif not self.rename_media:
             self._note(
                 "No folder found at '{}' - not copying media".format(
                     self.media_path
                 )
             )
 
+        with self._stage('compress_outputs'):
+            self.compress_outputs()
+
+        if self.cost_report:
+            self.report_page_costs()
+
+        over_budget = self.over_budget(time.perf_counter() - start_time)
+
+        # Don't let the next build skip a build which failed its budgets,
+        # or which only built some of the files
+        save_build_state(
+            output_path,
+            self.state,
+            None if over_budget or self.files is not None else fingerprint
+        )
+
+        if manifest_path:
+            write_change_manifest(manifest_path, self.changes)
+
+        # It's up to the caller whether this fails the build
+        self.result['over_budget'] = over_budget
+
+        if over_budget:
+            self._print(
+                'Error: The build is over budget:\n- {}'.format(
+                    '\n- '.join(over_budget)
+                ),
+                channel=self._err
+            )
+
+        return self._finish(start_time)
+
+    def fingerprint(self, source_path, template_path, build_version_branches):
+        """
+        A hash of all the inputs to this build, to tell when nothing
+        has changed since the last one.
+        Return None if the inputs can't be fingerprinted.
+        """
+
+        options = {
+            'builder_version': __version__,
+            'source_folder': self.source_folder,
+            'media_path': self.media_path,
+            'output_media_path': self.output_media_path,
+            'media_copy_mode': self.media_copy_mode,
+            'template_path': template_path,
+            'search_url': self.search_url,
+            'search_placeholder': self.search_placeholder,
+            'search_domains': self.search_domains,
+            'site_root': self.site_root,
+            'media_url': self.media_url,
+            'tag_manager_code': self.tag_manager_code,
+            'no_link_extensions': self.no_link_extensions,
+            'referenced_media_only': self.referenced_media_only,
+            'content_addressed_media': self.content_addressed_media,
+            'fingerprinted_media': self.fingerprinted_media,
+            'image_widths': self.image_widths,
+            'shared_navigation': self.shared_navigation,
+            'shared_versions': self.shared_versions,
+            'precompress': self.precompress,
+            'minify': self.minify,
+            'search_index': self.search_index,
+            'sitemap_url': self.sitemap_url,
+            'check_links': self.check_links,
+            'page_costs': self.page_costs,
+            # So a build with stricter budgets checks them again
+            'max_page_ms': self.max_page_ms,
+            'max_page_bytes': self.max_page_bytes,
+            'build_version_branches': build_version_branches,
+        }
+        directories = []
+        filepaths = [template_path]
+
+        if template_path == default_template:
+            filepaths.append(default_stylesheet)
+
+        if build_version_branches:
+            # Versions are built from the branches' commits,
+            # not from the files in the base directory
+            options['version_commits'] = version_branch_commits(
+                self.base_directory
+            )
+            filepaths.append(path.join(self.base_directory, 'versions'))
+
+            if options['version_commits'] is None:
+                return None
+        else:
+            directories.append(source_path)
+
+        if build_version_branches or not is_inside(
+            self.media_path, source_path
+        ):
+            directories.append(self.media_path)
+
+        return build_fingerprint(
+            options,
+            directories,
+            filepaths,
+            # Leaving out the files the build itself writes
+            exclude=[self.output_path, self.output_media_path] + [
+                filepath for filepath in [self.manifest_path, self.trace_path]
+                if filepath
+            ]
+        )
+
     def build_branch(
         self,
         branch_base,
@@ -172,10 +628,22 @@ class Builder():
                 )
             )
 
-        metadata_items = find_metadata(source_path)
+        with self.tracer.span('find_metadata'):
+            metadata_items = find_metadata(source_path)
+
+        build_time = time.time()
+        built_times = {
+            path.normpath(path.join(self.output_path, output)): record['built']
+            for output, record in self.state['outputs'].items()
+        }
 
         # Decide which files need changing
-        files = find_files(source_path, output_path, metadata_items)
+        with self.tracer.span('find_files'):
+            files = find_files(
+                source_path, output_path, metadata_items, built_times
+            )
+
+        self.prune_pages(source_path, output_path)
 
         new_files = files[0]
         if self.force:
@@ -184,8 +652,116 @@ class Builder():
         else:
             modified_files = files[1]
             unmodified_files = files[2]
+
+        media_filenames = None
+        images = None
+
+        if self.rename_media or self.image_widths:
+            # Renamed media is stored from each branch's own media folder,
+            # otherwise all branches link to the same media
+            if self.rename_media:
+                branch_media_path = self._branch_media_path(branch_base)
+            else:
+                branch_media_path = self.media_path
+
+            with self.tracer.span('media_hashes', 'media'):
+                media_hashes = self.media_hashes(
+                    branch_media_path,
+                    branch_base if self.rename_media and version_branches
+                    else None
+                )
+
+            if self.rename_media:
+                media_filenames = self.media_filenames(media_hashes)
+
+            if self.image_widths:
+                images = responsive_images(
+                    image_sizes(
+                        branch_media_path,
+                        media_hashes,
+                        self.state.setdefault('image_sizes', {})
+                    ),
+                    self.image_widths,
+                    media_filenames or {}
+                )
+
+            # Pages linking to media whose content has changed
+            # need rebuilding to link to its new name or size
+            stale_files = self._pages_linking_to(
+                self._changed_media_links(
+                    output_path, media_hashes, media_filenames, images
+                ),
+                unmodified_files,
+                source_path,
+                output_path
+            )
+            modified_files = modified_files + stale_files
+            stale_files = set(stale_files)
+            unmodified_files = [
+                filepath for filepath in unmodified_files
+                if filepath not in stale_files
+            ]
+
+        # Pages built without the details recorded for the search index,
+        # the sitemap, checking links or their costs
+        # need rebuilding to record them
+        required_keys = [
+            key for key, wanted in [
+                ('search', self.search_index),
+                ('location', self.sitemap_url),
+                ('links', self.check_links),
+                ('cost', self.page_costs),
+            ]
+            if wanted
+        ]
+
+        if required_keys:
+            unrecorded_files = [
+                filepath for filepath in unmodified_files
+                if not set(required_keys).issubset(
+                    self._page_record(filepath, source_path, output_path)
+                )
+            ]
+            modified_files = modified_files + unrecorded_files
+            unrecorded_files = set(unrecorded_files)
+            unmodified_files = [
+                filepath for filepath in unmodified_files
+                if filepath not in unrecorded_files
+            ]
+
+        outdated_files = [
+            filepath for filepath in unmodified_files
+            if self._page_record(
+                filepath, source_path, output_path
+            ).get('shared_links') != self.shared_links
+        ]
+
+        if outdated_files:
+            modified_files = modified_files + outdated_files
+            outdated_files = set(outdated_files)
+            unmodified_files = [
+                filepath for filepath in unmodified_files
+                if filepath not in outdated_files
+            ]
+
         uppercase_files = files[3]
         parse_files = new_files + modified_files
+        unrequested_files = []
+
+        if self.files is not None:
+            unrequested_files = [
+                filepath for filepath in parse_files
+                if path.relpath(filepath, source_path) not in self.files
+            ]
+            parse_files = [
+                filepath for filepath in parse_files
+                if path.relpath(filepath, source_path) in self.files
+            ]
+
+        self.result['skipped'].extend(
+            self._output_name(filepath, source_path, output_path)
+            for filepath in unmodified_files + unrequested_files
+        )
 
         if uppercase_files:
             self._print(
@@ -199,84 +775,1473 @@ class Builder():
                     '\n- '.join(unmodified_files)
                 )
             )
+        if unrequested_files:
+            self._print(
+                'Skipping files which weren\'t asked for:\n- {}'.format(
+                    '\n- '.join(unrequested_files)
+                )
+            )
 
-        built_files = []
+        version_name = None
 
-        # Create output files
-        for filepath in parse_files:
-            relative_filepath = path.relpath(filepath, source_path)
-            file_directory = path.normpath(path.dirname(filepath))
-            relative_directory = path.dirname(relative_filepath)
+        for name, info in version_branches.items():
+            if info['base_directory'] == branch_base:
+                version_name = name
 
-            metadata = compile_metadata(
-                metadata_items,
-                path.relpath(file_directory, source_path)
+        # Write the navigation once for each folder that defines it
+        navigations = None
+        directory_metadata = {}
+
+        if self.shared_navigation:
+            with self.tracer.span('write_navigation'):
+                navigations = {
+                    dirpath: self.write_navigation(
+                        metadata_items, dirpath, output_path
+                    )
+                    for dirpath, item in metadata_items.items()
+                    if 'navigation' in item['content']
+                }
+
+        write_futures = []
+
+        # Create output files
+        # Source files are read ahead, and built pages written behind,
+        # on I/O threads, so rendering only waits on the disk
+        # when the bounded queues are full
+        with ThreadPoolExecutor(self.io_threads) as read_pool, \
+                BoundedExecutor(
+                    self.io_threads, self.io_threads * 2
+                ) as write_pool:
+            sources = read_ahead(
+                read_pool,
+                self.tracer.wrap('read_file', read_file, 'io'),
+                parse_files,
+                self.io_threads * 2
             )
-            metadata['site_root'] = self.site_root
-            metadata['tag_manager_code'] = self.tag_manager_code
-            metadata['search_url'] = self.search_url
-            metadata['search_placeholder'] = self.search_placeholder
-            metadata['search_domains'] = self.search_domains
 
-            navigation = metadata.get('navigation')
+            sources = self.tracer.iterate('wait for source', sources)
+
+            for filepath, content in sources:
+                render_start = time.perf_counter()
+                relative_filepath = path.relpath(filepath, source_path)
+                file_directory = path.normpath(path.dirname(filepath))
+                relative_directory = path.dirname(relative_filepath)
 
-            # Breadcrumbs
-            if navigation:
-                metadata['breadcrumbs'] = set_active_navigation_items(
-                    path.basename(filepath),
-                    navigation
+                with self.tracer.span(
+                    'compile_metadata', page=relative_filepath
+                ):
+                    if navigations is None:
+                        metadata = compile_metadata(
+                            metadata_items,
+                            path.relpath(file_directory, source_path)
+                        )
+                    else:
+                        metadata = self._shared_navigation_metadata(
+                            metadata_items,
+                            path.relpath(file_directory, source_path),
+                            relative_filepath,
+                            output_path,
+                            directory_metadata,
+                            navigations
+                        )
+
+                metadata['site_root'] = self.site_root
+                metadata['tag_manager_code'] = self.tag_manager_code
+                metadata['search_url'] = self.search_url
+                metadata['search_placeholder'] = self.search_placeholder
+                metadata['search_domains'] = self.search_domains
+                metadata['stylesheet_url'] = self.stylesheet_url(
+                    path.join(output_path, relative_directory)
                 )
 
-            if version_branches:
-                metadata['versions'] = version_paths(
-                    version_branches,
-                    branch_base,
-                    self.source_folder,
-                    relative_filepath
+                if self.search_index:
+                    index_path = self._search_index_path(
+                        output_path, relative_filepath
+                    )
+                    metadata['search_index_url'] = path.relpath(
+                        path.join(index_path, 'index.json'),
+                        path.join(output_path, relative_directory)
+                    )
+
+                navigation = metadata.get('navigation')
+
+                # Breadcrumbs
+                if navigation:
+                    metadata['breadcrumbs'] = set_active_navigation_items(
+                        path.basename(filepath),
+                        navigation
+                    )
+
+                if version_branches and self.versions_filepath:
+                    metadata.update(
+                        self._shared_version_metadata(
+                            version_name,
+                            relative_filepath,
+                            path.join(output_path, relative_directory)
+                        )
+                    )
+                elif version_branches:
+                    metadata['versions'] = version_paths(
+                        version_branches,
+                        branch_base,
+                        self.source_folder,
+                        relative_filepath
+                    )
+
+                    for version in metadata['versions']:
+                        if version['latest']:
+                            metadata['relative_canonical'] = version['path']
+                            metadata['base_canonical'] = convert_path_to_html(
+                                version['name'] + '/' + relative_filepath)
+                else:
+                    metadata['base_canonical'] = convert_path_to_html(filepath)
+
+                location = None
+
+                if self.sitemap_url:
+                    site_filepath = path.relpath(
+                        path.join(output_path, relative_filepath),
+                        self.output_path
+                    )
+                    location = sitemap_location(site_filepath)
+
+                    # Only pages which are their own canonical page
+                    # belong in the sitemap
+                    if (
+                        version_branches and
+                        metadata.get('base_canonical') !=
+                        convert_path_to_html(site_filepath)
+                    ):
+                        location = None
+
+                with self.tracer.span(
+                    'parse_markdown', page=relative_filepath
+                ):
+                    with HighlightTimer(
+                        self.parser, enabled=self.page_costs
+                    ) as highlighting:
+                        html = parse_markdown(
+                            self.parser,
+                            self.template,
+                            filepath,
+                            metadata,
+                            content=content
+                        )
+
+                relative_media_path = path.relpath(
+                    self.media_path,
+                    path.join(self.base_directory, self.source_folder)
+                )
+                relative_output_media_path = path.relpath(
+                    self.output_media_path,
+                    output_path
                 )
 
-                for version in metadata['versions']:
-                    if version['latest']:
-                        metadata['relative_canonical'] = version['path']
-                        metadata['base_canonical'] = convert_path_to_html(
-                            version['name'] + '/' + relative_filepath)
+                media_references = set()
+                page_links = [] if self.check_links else None
+
+                with self.tracer.span('rewrite_links', page=relative_filepath):
+                    html = replace_media_links(
+                        html,
+                        old_path=relative_media_path,
+                        new_path=(
+                            self.media_url or relative_output_media_path
+                        ),
+                        context_directory=relative_directory,
+                        references=media_references,
+                        filenames=media_filenames,
+                        images=images
+                    )
+                    html = replace_internal_links(
+                        html,
+                        extensions=(not self.no_link_extensions),
+                        links=page_links
+                    )
+
+                details = {'shared_links': self.shared_links}
+
+                if self.search_index:
+                    with self.tracer.span(
+                        'search_document', page=relative_filepath
+                    ):
+                        details['search'] = search_document(html)
+                    details['search']['index'] = path.relpath(
+                        index_path, self.output_path
+                    )
+
+                if self.sitemap_url:
+                    details['location'] = location
+
+                if self.check_links:
+                    # Only check the links written in the source file,
+                    # not those from the template
+                    lines = source_lines(content, page_links)
+                    details['anchors'] = page_anchors(html)
+                    details['links'] = [
+                        [href, line]
+                        for href, line in zip(page_links, lines) if line
+                    ]
+
+                if self.minify:
+                    original_size = len(html.encode('utf-8'))
+
+                    with self.tracer.span('minify', page=relative_filepath):
+                        html = minify_html(html)
+
+                    self.minified_sizes[0] += original_size
+                    self.minified_sizes[1] += len(html.encode('utf-8'))
+                    self.minified_sizes[2] += 1
+
+                if self.page_costs:
+                    details['cost'] = {
+                        'render_ms': round(
+                            (time.perf_counter() - render_start) * 1000, 1
+                        ),
+                        'code_blocks': highlighting.blocks,
+                        'highlight_ms': round(
+                            highlighting.seconds * 1000, 1
+                        ),
+                    }
+
+                output_filepath = path.join(output_path, relative_filepath)
+
+                # Submitting blocks while the write queue is full
+                with self.tracer.span('wait for writer', 'wait'):
+                    write_futures.append(
+                        write_pool.submit(
+                            self.tracer.wrap(
+                                'write_page',
+                                self._write_page,
+                                'page',
+                                page=relative_filepath
+                            ),
+                            html,
+                            output_filepath,
+                            relative_filepath,
+                            media_references,
+                            build_time,
+                            details
+                        )
+                    )
+
+        built_files = []
+        identical_files = []
+
+        for future in write_futures:
+            built_filepath, record, written = future.result()
+            self._record_output(built_filepath, record)
+
+            output = path.relpath(built_filepath, self.output_path)
+
+            if written:
+                built_files.append(built_filepath)
+                self.result['built'].append(output)
             else:
-                metadata['base_canonical'] = convert_path_to_html(filepath)
+                identical_files.append(built_filepath)
+                self.result['identical'].append(output)
 
-            html = parse_markdown(
-                self.parser,
-                self.template,
-                filepath,
-                metadata
+        if identical_files:
+            self._print(
+                'Rebuilt files were identical, not rewritten:\n- {}'.format(
+                    '\n- '.join(identical_files)
+                )
             )
 
-            relative_media_path = path.relpath(
-                self.media_path,
-                path.join(self.base_directory, self.source_folder)
+        if media_filenames is not None:
+            with self.tracer.span('store_media', 'media'):
+                self.store_media(
+                    branch_media_path, output_path, media_filenames
+                )
+
+        if images is not None:
+            with self.tracer.span('generate_images', 'media'):
+                self.generate_images(branch_media_path, media_hashes, images)
+
+        return built_files
+
+    def copy_media(self):
+        """
+        Copy new and updated media into the output,
+        recording any changes in the output
+        """
+
+        # The manifest of media copied by the last build is only valid
+        # if it was copied between the same two folders
+        manifest = self.state.get('media', {})
+
+        if (
+            manifest.get('source') != self.media_path or
+            manifest.get('output') != self.output_media_path
+        ):
+            manifest = {
+                'source': self.media_path,
+                'output': self.output_media_path,
+                'files': {},
+            }
+            self.state['media'] = manifest
+
+        copied_files = sync_media(
+            self.media_path,
+            self.output_media_path,
+            manifest=manifest['files'],
+            mode=self.media_copy_mode,
+            threads=self.io_threads,
+            force=self.force,
+            include=self.media_references
+        ) or []
+        build_time = time.time()
+
+        with ThreadPoolExecutor(self.io_threads) as hash_pool:
+            hashes = hash_pool.map(file_hash, copied_files)
+
+            for copied_filepath, copied_hash in zip(copied_files, hashes):
+                self._record_output(
+                    copied_filepath,
+                    {
+                        'hash': copied_hash,
+                        'size': path.getsize(copied_filepath),
+                        'built': build_time,
+                        'kind': 'media',
+                        'source': path.relpath(
+                            copied_filepath, self.output_media_path
+                        ),
+                    }
+                )
+
+    def media_hashes(self, media_path, repository_path=None):
+        """
+        Find the content hashes of the files in a media folder,
+        reading them from git if it's inside a clean git checkout
+        at repository_path (as version branches are),
+        or from the files themselves (cached in the build state)
+        """
+
+        if not path.isdir(media_path):
+            return {}
+
+        if repository_path and is_inside(media_path, repository_path):
+            return git_media_hashes(repository_path, media_path)
+
+        return hash_media(
+            media_path,
+            self.state.setdefault('media_hashes', {}).setdefault(
+                media_path, {}
             )
-            relative_output_media_path = path.relpath(
-                self.output_media_path,
-                output_path
+        )
+
+    def media_filenames(self, media_hashes):
+        """
+        Map media files to their names in the content-addressed
+        media store (or their fingerprinted names,
+        with --fingerprinted-media)
+        """
+
+        if self.content_addressed_media:
+            return content_addressed_filenames(media_hashes)
+
+        return fingerprinted_filenames(media_hashes)
+
+    def store_media(self, media_path, output_path, filenames):
+        """
+        Copy a branch's media into the output media path under its
+        new names (only the media its pages link to,
+        with --referenced-media-only), recording any new files in the output
+        """
+
+        if self.referenced_media_only:
+            references = set()
+
+            for output, record in self.state['outputs'].items():
+                if record.get('kind') == 'page' and is_inside(
+                    path.join(self.output_path, output), output_path
+                ):
+                    references.update(record.get('media', []))
+
+            filenames = {
+                filepath: filename
+                for filepath, filename in filenames.items()
+                if filepath in references
+            }
+
+        self.stored_media.update(filenames.values())
+
+        stored_files = store_media(
+            media_path,
+            self.output_media_path,
+            filenames,
+            mode=self.media_copy_mode,
+            threads=self.io_threads
+        )
+        build_time = time.time()
+
+        with ThreadPoolExecutor(self.io_threads) as hash_pool:
+            hashes = hash_pool.map(file_hash, stored_files)
+
+            for stored_filepath, stored_hash in zip(stored_files, hashes):
+                self._record_output(
+                    stored_filepath,
+                    {
+                        'hash': stored_hash,
+                        'size': path.getsize(stored_filepath),
+                        'built': build_time,
+                        'kind': 'stored-media',
+                        'source': path.relpath(
+                            stored_filepath, self.output_media_path
+                        ),
+                    }
+                )
+
+        if stored_files:
+            self._print(
+                "Stored {} new media files from {} in {}".format(
+                    len(stored_files), media_path, self.output_media_path
+                )
             )
 
-            html = replace_media_links(
-                html,
-                old_path=relative_media_path,
-                new_path=self.media_url or relative_output_media_path,
-                context_directory=relative_directory
+    def generate_images(self, media_path, media_hashes, images):
+        """
+        Generate the resized and WebP variants of images
+        whose variants in the output are missing or out of date,
+        recording any new files in the output
+        """
+
+        outdated_images = {}
+
+        for filepath, image in images.items():
+            for filename, width in image['variants']:
+                self.image_variants.add(filename)
+                output_filepath = path.join(self.output_media_path, filename)
+                record = self.state['outputs'].get(
+                    path.relpath(output_filepath, self.output_path), {}
+                )
+
+                if (
+                    self.force or
+                    record.get('source_hash') != media_hashes[filepath] or
+                    not path.isfile(output_filepath)
+                ):
+                    outdated_images.setdefault(
+                        filepath, {'variants': []}
+                    )['variants'].append([filename, width])
+
+        generated_files = generate_image_variants(
+            media_path,
+            self.output_media_path,
+            outdated_images,
+            media_hashes,
+            self.image_cache_path,
+            threads=self.io_threads,
+            mode=self.media_copy_mode
+        )
+        build_time = time.time()
+
+        for filepath, image in sorted(outdated_images.items()):
+            for filename, width in image['variants']:
+                output_filepath = path.join(self.output_media_path, filename)
+                self._record_output(
+                    output_filepath,
+                    {
+                        'hash': file_hash(output_filepath),
+                        'size': path.getsize(output_filepath),
+                        'built': build_time,
+                        'kind': 'image-variant',
+                        'source': filename,
+                        'source_hash': media_hashes[filepath],
+                    }
+                )
+
+        if generated_files:
+            self._print(
+                "Generated {} image variants from {} in {}".format(
+                    len(generated_files), media_path, self.output_media_path
+                )
             )
 
-            html = replace_internal_links(
-                html,
-                extensions=(not self.no_link_extensions)
+    def write_stylesheet(self, stylesheet_path):
+        """
+        Write the shared stylesheet into the output once, under its
+        content-hashed name, removing any other version of it
+        from earlier builds
+        """
+
+        output_filepath = self.stylesheet_filepath
+        write_asset(stylesheet_path, output_filepath, force=self.force)
+        output = path.relpath(output_filepath, self.output_path)
+
+        self._prune('asset', lambda record: record['output'] != output)
+        self._record_output(
+            output_filepath,
+            {
+                'hash': file_hash(output_filepath),
+                'size': path.getsize(output_filepath),
+                'built': time.time(),
+                'kind': 'asset',
+                'source': path.basename(stylesheet_path),
+                'output': output,
+            }
+        )
+
+    def stylesheet_url(self, page_directory):
+        """
+        The URL of the shared stylesheet for pages in a directory:
+        under the site root, if one is set, or else relative to the page
+        """
+
+        if not self.stylesheet_filepath:
+            return None
+
+        stylesheet = path.relpath(self.stylesheet_filepath, self.output_path)
+
+        if self.site_root:
+            return self.site_root.rstrip('/') + '/' + stylesheet
+
+        return path.relpath(self.stylesheet_filepath, page_directory)
+
+    def write_navigation(self, metadata_items, scope, output_path):
+        """
+        Write the navigation defined in a folder into a content-hashed
+        JSON file in the matching output folder, for pages to load,
+        and record it in the output.
+        Return the path to the file, and an index of the navigation.
+        """
+
+        navigation = compile_metadata(metadata_items, scope)['navigation']
+        output_filepath = self._write_shared_file(
+            path.normpath(path.join(output_path, scope)),
+            'navigation',
+            navigation_json(
+                navigation, extensions=(not self.no_link_extensions)
+            ),
+            'navigation'
+        )
+
+        return output_filepath, navigation_index(navigation)
+
+    def write_search_indexes(self):
+        """
+        Write the search index for each folder of pages
+        from the search documents recorded for its pages:
+        shards of terms under content-hashed names,
+        which only change when the pages using their terms change,
+        and an index.json listing the pages and shards
+        """
+
+        indexes = {}
+
+        for output, record in self.state['outputs'].items():
+            if record.get('kind') != 'page' or 'search' not in record:
+                continue
+
+            index_path = record['search']['index']
+            url = path.relpath(output, index_path)
+
+            if self.no_link_extensions:
+                url = path.splitext(url)[0]
+
+            indexes.setdefault(index_path, {})[url] = record['search']
+
+        previous_indexes = self.state.get('search_pages', {})
+        self.state['search_pages'] = {}
+
+        for index_path, documents in sorted(indexes.items()):
+            output_directory = path.join(self.output_path, index_path)
+            urls, pages, shards = build_search_index(
+                documents, previous_indexes.get(index_path, [])
             )
+            self.state['search_pages'][index_path] = urls
 
-            output_filepath = path.join(output_path, relative_filepath)
+            shard_filenames = {
+                key: path.basename(
+                    self._write_shared_file(
+                        output_directory,
+                        key,
+                        json.dumps(
+                            shard, separators=(',', ':'), sort_keys=True
+                        ),
+                        'search'
+                    )
+                )
+                for key, shard in shards.items()
+            }
 
-            built_filepath = write_html(html, output_filepath)
-            built_files.append(built_filepath)
+            self._write_shared_file(
+                output_directory,
+                'index',
+                json.dumps(
+                    {'pages': pages, 'shards': shard_filenames},
+                    separators=(',', ':'),
+                    sort_keys=True
+                ),
+                'search',
+                hashed=False
+            )
 
-        return built_files
+    def write_sitemap(self):
+        """
+        Write a sitemap.xml of the pages which are their own canonical page,
+        from their records, with the time each one's content last changed.
+        Above the sitemap size limit, write the pages into numbered
+        sitemaps, listed in a sitemap index in sitemap.xml
+        """
+
+        base_url = self.sitemap_url.rstrip('/') + '/'
+        entries = sorted(
+            (
+                base_url + quote(record['location']),
+                record.get('modified', record['built'])
+            )
+            for record in self.state['outputs'].values()
+            if record.get('kind') == 'page' and
+            record.get('location') is not None
+        )
+
+        if len(entries) <= sitemap_limit:
+            self._write_shared_file(
+                self.output_path,
+                'sitemap',
+                sitemap_xml(entries),
+                'sitemap',
+                hashed=False,
+                extension='xml'
+            )
+
+            return
+
+        sitemaps = []
+
+        for number, start in enumerate(
+            range(0, len(entries), sitemap_limit), 1
+        ):
+            chunk = entries[start:start + sitemap_limit]
+            name = 'sitemap-{}'.format(number)
+            self._write_shared_file(
+                self.output_path,
+                name,
+                sitemap_xml(chunk),
+                'sitemap',
+                hashed=False,
+                extension='xml'
+            )
+            sitemaps.append(
+                (
+                    base_url + name + '.xml',
+                    max(modified for url, modified in chunk)
+                )
+            )
+
+        self._write_shared_file(
+            self.output_path,
+            'sitemap',
+            sitemap_xml(sitemaps, index=True),
+            'sitemap',
+            hashed=False,
+            extension='xml'
+        )
+
+    def compress_outputs(self):
+        """
+        Write gzip (and brotli, if available) copies of text outputs
+        which have changed since they were last compressed,
+        in a pool of worker processes.
+        Without --precompress, remove any compressed copies.
+        """
+
+        formats = compression_formats() if self.precompress else []
+
+        if self.precompress and 'br' not in formats:
+            self._note(
+                "Install the brotli module to write .br files - "
+                "only writing .gz files"
+            )
+
+        changed_outputs = set(
+            change['path']
+            for change in self.changes['added'] + self.changes['changed']
+        )
+        outdated_outputs = []
+
+        for output, record in self.state['outputs'].items():
+            compressed = record.get('compressed', {})
+
+            for compression_format in set(compressed) - set(formats):
+                self._remove_compressed(output, record, compression_format)
+
+            if (
+                path.splitext(output)[1] in compressible_extensions and
+                formats and
+                (
+                    self.force or
+                    output in changed_outputs or
+                    sorted(compressed) != sorted(formats)
+                )
+            ):
+                outdated_outputs.append(output)
+
+        if not outdated_outputs:
+            return
+
+        with ProcessPoolExecutor(self.compress_workers) as compress_pool:
+            results = compress_pool.map(
+                compress_file,
+                [
+                    path.join(self.output_path, output)
+                    for output in outdated_outputs
+                ],
+                [formats] * len(outdated_outputs),
+                chunksize=16
+            )
+
+            for output, compressed in zip(outdated_outputs, results):
+                record = self.state['outputs'][output]
+                previous = record.get('compressed', {})
+
+                for compression_format, info in compressed.items():
+                    change = {
+                        'path': output + '.' + compression_format,
+                        'hash': info[0],
+                        'size': info[1],
+                    }
+
+                    if compression_format not in previous:
+                        self.changes['added'].append(change)
+                    elif previous[compression_format][0] != info[0]:
+                        self.changes['changed'].append(change)
+
+                record['compressed'] = compressed
+
+        self._print(
+            "Compressed {} changed files as {}".format(
+                len(outdated_outputs),
+                ', '.join('.' + name for name in formats)
+            )
+        )
+
+    def report_minified_sizes(self):
+        """
+        Report how many bytes minifying built pages saved
+        """
+
+        original_size, minified_size, count = self.minified_sizes
+        saved_size = original_size - minified_size
+
+        self._print(
+            (
+                "Minified {} pages from {:,} to {:,} bytes, "
+                "saving {:,} bytes ({:.1%})"
+            ).format(
+                count,
+                original_size,
+                minified_size,
+                saved_size,
+                saved_size / original_size if original_size else 0
+            )
+        )
+
+    def report_page_costs(self):
+        """
+        Report the pages which took longest to render when they were
+        last built, with their size and the code blocks they highlighted
+        """
+
+        costs = sorted(
+            (
+                (output, record)
+                for output, record in self.state['outputs'].items()
+                if record.get('kind') == 'page' and 'cost' in record
+            ),
+            key=lambda item: item[1]['cost']['render_ms'],
+            reverse=True
+        )[:self.cost_report]
+
+        if not costs:
+            return
+
+        self._print(
+            'Most expensive pages:\n- {}'.format(
+                '\n- '.join(
+                    (
+                        '{}: {:,.1f} ms ({:,.1f} ms highlighting '
+                        '{} code blocks), {:,} bytes'
+                    ).format(
+                        self._page_location(output),
+                        record['cost']['render_ms'],
+                        record['cost']['highlight_ms'],
+                        record['cost']['code_blocks'],
+                        record['size']
+                    )
+                    for output, record in costs
+                )
+            )
+        )
+
+    def over_budget(self, build_seconds):
+        """
+        Describe each way the build went over its budgets:
+        pages which took too long to render or are too big,
+        and a build which took too long
+        """
+
+        descriptions = []
+
+        for output, record in sorted(self.state['outputs'].items()):
+            if record.get('kind') != 'page' or 'cost' not in record:
+                continue
+
+            render_ms = record['cost']['render_ms']
+
+            if self.max_page_ms and render_ms > self.max_page_ms:
+                descriptions.append(
+                    '{}: took {:,.1f} ms to render (max {:,} ms)'.format(
+                        self._page_location(output),
+                        render_ms,
+                        self.max_page_ms
+                    )
+                )
+
+            if self.max_page_bytes and record['size'] > self.max_page_bytes:
+                descriptions.append(
+                    '{}: {:,} bytes (max {:,} bytes)'.format(
+                        self._page_location(output),
+                        record['size'],
+                        self.max_page_bytes
+                    )
+                )
+
+        if self.max_build_seconds and build_seconds > self.max_build_seconds:
+            descriptions.append(
+                'The build took {:,.1f} seconds (max {:,} seconds)'.format(
+                    build_seconds, self.max_build_seconds
+                )
+            )
+
+        return descriptions
+
+    def report_memory_profile(self):
+        """
+        Report the memory each stage of the build used,
+        and the call sites which allocated the most of it
+        """
+
+        def megabytes(size):
+            if size is None:
+                return 'unknown'
+            elif abs(size) < 1000000:
+                return '{:,.1f} kB'.format(size / 1000)
+
+            return '{:,.1f} MB'.format(size / 1000000)
+
+        stages = [
+            '{}: peak {}, retained {} (peak RSS {})'.format(
+                ' '.join([stage['name']] + list(stage['args'].values())),
+                megabytes(stage['peak']),
+                megabytes(stage['retained']),
+                megabytes(stage['peak_rss'])
+            )
+            for stage in self.memory_profiler.stages
+        ]
+        sites = [
+            '{}: {} in {:,} blocks ({})'.format(
+                site['site'],
+                megabytes(site['size']),
+                site['count'],
+                ' '.join(
+                    [site['stage']['name']] +
+                    list(site['stage']['args'].values())
+                )
+            )
+            for site in self.memory_profiler.top_sites()
+        ]
+
+        self._print('Memory profile:\n- {}'.format('\n- '.join(stages)))
+
+        if sites:
+            self._print(
+                'Top allocating sites:\n- {}'.format('\n- '.join(sites))
+            )
+
+    def report_broken_links(self):
+        """
+        Check the links in all built pages against the pages and anchors
+        recorded for them, and report any broken links
+        with the source file and line they're on
+        """
+
+        pages = {
+            output: {
+                'anchors': record.get('anchors', []),
+                'links': record.get('links', []),
+            }
+            for output, record in self.state['outputs'].items()
+            if record.get('kind') == 'page'
+        }
+        broken_links = find_broken_links(pages)
+        link_count = sum(len(page['links']) for page in pages.values())
+
+        self._print(
+            "Checked {} links in {} pages".format(link_count, len(pages))
+        )
+
+        if not broken_links:
+            return
+
+        descriptions = []
+
+        for output, href, line, reason in broken_links:
+            descriptions.append(
+                '{}: {} ({})'.format(
+                    self._page_location(output, line), href, reason
+                )
+            )
+
+        self._note(
+            'Found {} broken links:\n- {}'.format(
+                len(broken_links), '\n- '.join(descriptions)
+            )
+        )
+
+    def find_media_references(self):
+        """
+        Gather the media files linked to from all built pages,
+        and report any media files which aren't linked to,
+        or links to media files which don't exist
+        """
+
+        references = set()
+
+        for record in self.state['outputs'].values():
+            if record.get('kind') == 'page':
+                references.update(record.get('media', []))
+
+        unreferenced_files = [
+            path.join(self.media_path, filepath)
+            for filepath, stats in walk_files(self.media_path, hidden=True)
+            if filepath not in references
+        ]
+        missing_files = [
+            path.join(self.media_path, filepath)
+            for filepath in sorted(references)
+            if not path.isfile(path.join(self.media_path, filepath))
+        ]
+
+        if unreferenced_files:
+            self._print(
+                'Skipping media not linked to from any page:\n- {}'.format(
+                    '\n- '.join(unreferenced_files)
+                )
+            )
+        if missing_files:
+            self._note(
+                'Pages link to missing media files:\n- {}'.format(
+                    '\n- '.join(missing_files)
+                )
+            )
+
+        return references
+
+    def prune_pages(self, source_path, output_path):
+        """
+        Remove pages built into output_path from source files
+        which no longer exist in source_path
+        """
+
+        self._prune(
+            'page',
+            lambda record: not path.isfile(
+                path.join(source_path, record['source'])
+            ),
+            lambda output: is_inside(
+                path.join(self.output_path, output), output_path
+            )
+        )
+
+    def prune_media_store(self):
+        """
+        Remove media stored under content-hashed names
+        which no branch links to any more
+        """
+
+        self._prune(
+            'stored-media',
+            lambda record: record['source'] not in self.stored_media
+        )
+
+    def prune_image_variants(self):
+        """
+        Remove image variants generated from images
+        which no longer exist, or at widths no longer wanted
+        """
+
+        self._prune(
+            'image-variant',
+            lambda record: record['source'] not in self.image_variants
+        )
+
+    def prune_shared_files(self):
+        """
+        Remove shared navigation, version, search index and sitemap files
+        which are out of date
+        """
+
+        for kind in ['navigation', 'versions', 'search', 'sitemap']:
+            self._prune(
+                kind,
+                lambda record: record['source'] not in self.shared_files
+            )
+
+    def prune_media(self):
+        """
+        Remove media copied into the output from media files
+        which no longer exist (or are no longer linked to,
+        when only copying referenced media)
+        """
+
+        wanted = self.media_references
+        manifest = self.state.get('media', {}).get('files', {})
+
+        def orphaned(record):
+            if (
+                not path.isfile(path.join(self.media_path, record['source']))
+                or (wanted is not None and record['source'] not in wanted)
+            ):
+                # Forget it was copied, so it's copied again if wanted again
+                manifest.pop(record['source'], None)
+
+                return True
+
+            return False
+
+        self._prune('media', orphaned)
+
+    def _prune(self, kind, orphaned, belongs=lambda output: True):
+        removed_files = []
+
+        for output, record in list(self.state['outputs'].items()):
+            if record.get('kind') != kind or not belongs(output):
+                continue
+
+            if orphaned(record):
+                output_filepath = path.join(self.output_path, output)
+                remove_file(
+                    output_filepath,
+                    self.output_media_path
+                    if is_inside(output_filepath, self.output_media_path)
+                    else self.output_path
+                )
+                for compression_format in list(record.get('compressed', {})):
+                    self._remove_compressed(output, record, compression_format)
+
+                del self.state['outputs'][output]
+
+                if kind == 'page':
+                    self.result['removed'].append(output)
+
+                self.changes['removed'].append(
+                    {
+                        'path': output,
+                        'hash': record['hash'],
+                        'size': record['size'],
+                    }
+                )
+                removed_files.append(output_filepath)
+
+        if removed_files:
+            self._print(
+                'Removed outputs of deleted or unused sources:\n- {}'.format(
+                    '\n- '.join(removed_files)
+                )
+            )
+
+    def _remove_compressed(self, output, record, compression_format):
+        """
+        Remove a compressed copy of an output
+        """
+
+        compressed_hash, size = record['compressed'].pop(compression_format)
+        remove_file(
+            path.join(self.output_path, output + '.' + compression_format),
+            self.output_path
+        )
+        self.changes['removed'].append(
+            {
+                'path': output + '.' + compression_format,
+                'hash': compressed_hash,
+                'size': size,
+            }
+        )
+
+        if not record['compressed']:
+            del record['compressed']
+
+    def _branch_media_path(self, branch_base):
+        """
+        The media folder in a branch's checkout, if the media path
+        is inside the base directory, or else the media path itself
+        """
+
+        if not is_inside(self.media_path, self.base_directory):
+            return self.media_path
+
+        return path.normpath(
+            path.join(
+                branch_base,
+                path.relpath(self.media_path, self.base_directory)
+            )
+        )
+
+    def _changed_media_links(
+        self, output_path, media_hashes, media_filenames, images
+    ):
+        """
+        Find the media files in a branch whose links in built pages
+        (their new names, or image sizes) have changed since the last build,
+        recording the new links
+        """
+
+        branch = path.relpath(output_path, self.output_path)
+        links = {
+            filepath: [
+                (media_filenames or {}).get(filepath),
+                [images[filepath]['width'], images[filepath]['height']]
+                if filepath in (images or {}) else None
+            ]
+            for filepath in media_hashes
+        }
+        previous = self.state.setdefault('media_links', {}).get(branch, {})
+        self.state['media_links'][branch] = links
+
+        return set(
+            filepath for filepath in set(previous) | set(links)
+            if previous.get(filepath) != links.get(filepath)
+        )
+
+    def _pages_linking_to(
+        self, media_files, filepaths, source_path, output_path
+    ):
+        """
+        Of the source filepaths, find those whose built pages
+        were recorded as linking to any of the media files
+        """
+
+        if not media_files:
+            return []
+
+        return [
+            filepath for filepath in filepaths
+            if media_files.intersection(
+                self._page_record(
+                    filepath, source_path, output_path
+                ).get('media', [])
+            )
+        ]
+
+    def _page_location(self, output, line=None):
+        """
+        Describe where a built page came from: its source file
+        (and line, if given), and the version branch it's in, if any
+        """
+
+        source = self.state['outputs'][output]['source']
+        # Pages are built into the output folder of their branch
+        branch = path.dirname(
+            output[:-len(path.splitext(source)[0] + '.html')]
+        )
+        location = path.normpath(path.join(self.source_folder, source))
+
+        if line:
+            location = '{}:{}'.format(location, line)
+
+        if branch:
+            location = '{} ({})'.format(location, branch)
+
+        return location
+
+    def _output_name(self, filepath, source_path, output_path):
+        """
+        The path, relative to the output folder, of the page
+        built from a source file
+        """
+
+        return path.relpath(
+            path.join(
+                output_path,
+                path.splitext(path.relpath(filepath, source_path))[0] +
+                '.html'
+            ),
+            self.output_path
+        )
+
+    def _page_record(self, filepath, source_path, output_path):
+        """
+        The record of the page built from a source file by the last build,
+        or an empty dictionary
+        """
+
+        return self.state['outputs'].get(
+            self._output_name(filepath, source_path, output_path), {}
+        )
+
+    def _search_index_path(self, output_path, relative_filepath):
+        """
+        The folder of the search index for a page: one for each top-level
+        folder (usually a language) of each branch
+        """
+
+        top_folder = relative_filepath.split(path.sep)[0]
+
+        if top_folder == relative_filepath:
+            return path.join(output_path, 'search')
+
+        return path.join(output_path, top_folder, 'search')
+
+    def _shared_version_metadata(
+        self, version_name, relative_filepath, page_directory
+    ):
+        """
+        The metadata for a page linking to the shared version map,
+        with its canonical links found from the map
+        """
+
+        page = path.splitext(relative_filepath)[0]
+        flags = self.version_map['pages'].get(page, '')
+        metadata = {
+            'versions_url': path.relpath(
+                self.versions_filepath, page_directory
+            ),
+            'version': version_name,
+            'version_page': page,
+        }
+
+        if '1' in flags:
+            latest = self.version_map['versions'][flags.index('1')]
+            metadata['base_canonical'] = convert_path_to_html(
+                latest + '/' + relative_filepath
+            )
+
+            if latest != version_name:
+                metadata['relative_canonical'] = path.relpath(
+                    path.join('..', latest, relative_filepath),
+                    path.dirname(relative_filepath)
+                )
+
+        return metadata
+
+    def _shared_navigation_metadata(
+        self,
+        metadata_items,
+        relative_directory,
+        relative_filepath,
+        output_path,
+        directory_metadata,
+        navigations
+    ):
+        """
+        The metadata for a page without its navigation, compiled once
+        per folder, linking instead to the shared navigation file
+        (from `write_navigation`), with breadcrumbs from its index
+        """
+
+        if relative_directory not in directory_metadata:
+            metadata = compile_metadata(metadata_items, relative_directory)
+            metadata.pop('navigation', None)
+            directory_metadata[relative_directory] = metadata
+
+        metadata = dict(directory_metadata[relative_directory])
+        scope = navigation_scope(metadata_items, relative_directory)
+
+        if scope is not None:
+            navigation_filepath, index = navigations[scope]
+            page = path.splitext(
+                path.relpath(relative_filepath, scope)
+            )[0]
+            metadata['navigation_url'] = path.relpath(
+                navigation_filepath,
+                path.join(output_path, relative_directory)
+            )
+            metadata['breadcrumbs'] = [
+                {
+                    'title': item.get('title'),
+                    'location': relativize(
+                        item['location'], scope, relative_directory
+                    ) if item.get('location') else None,
+                }
+                for item in index.get(page, [])
+            ]
+
+        return metadata
+
+    def _write_shared_file(
+        self,
+        output_directory,
+        name,
+        content,
+        kind,
+        hashed=True,
+        extension='json'
+    ):
+        """
+        Write a file shared by many pages (JSON, by default)
+        into output_directory, with a hash of its content in its name
+        (unless hashed=False), unless it's already there,
+        and record it in the output.
+        Return the path to the file.
+        """
+
+        content = content.encode('utf-8')
+
+        if hashed:
+            filename = '{}.{}.{}'.format(
+                name, content_hash(content)[:12], extension
+            )
+        else:
+            filename = '{}.{}'.format(name, extension)
+
+        output_filepath = path.join(output_directory, filename)
+        output = path.relpath(output_filepath, self.output_path)
+        previous = self.state['outputs'].get(output, {})
+        self.shared_files.add(output)
+
+        if (
+            self.force or
+            previous.get('hash') != content_hash(content) or
+            not path.isfile(output_filepath)
+        ):
+            makedirs(output_directory, exist_ok=True)
+            atomic_write(output_filepath, content)
+
+        self._record_output(
+            output_filepath,
+            {
+                'hash': content_hash(content),
+                'size': len(content),
+                'built': time.time(),
+                'kind': kind,
+                'source': output,
+            }
+        )
+
+        return output_filepath
+
+    def _record_output(self, output_filepath, record):
+        """
+        Store the record of an output file in the build state,
+        noting whether it was added or changed in this build
+        """
+
+        output = path.relpath(output_filepath, self.output_path)
+        previous = self.state['outputs'].get(output)
+        change = {
+            'path': output,
+            'hash': record['hash'],
+            'size': record['size'],
+        }
+
+        if previous is None:
+            self.changes['added'].append(change)
+        elif previous['hash'] != record['hash']:
+            self.changes['changed'].append(change)
+
+        if previous and 'compressed' in previous:
+            record['compressed'] = previous['compressed']
+
+        self.state['outputs'][output] = record
+
+    def _write_page(
+        self,
+        html,
+        output_filepath,
+        source,
+        media_references,
+        build_time,
+        details={}
+    ):
+        """
+        Write out a built page, unless (and --force wasn't used)
+        it's identical to the output recorded by the last build,
+        so unchanged files keep their modification times.
+        Its record notes when its content last changed, along with
+        any other details given (its search document, sitemap location,
+        anchors and links).
+        Return the output filepath, its new record and whether it was written
+        """
+
+        output_filepath = path.splitext(output_filepath)[0] + '.html'
+        content = html.encode('utf-8')
+        record = {
+            'hash': content_hash(content),
+            'size': len(content),
+            'built': build_time,
+            'kind': 'page',
+            'source': source,
+            'media': sorted(media_references),
+        }
+
+        record.update(details)
+        previous = self.state['outputs'].get(
+            path.relpath(output_filepath, self.output_path), {}
+        )
+
+        if previous.get('hash') == record['hash']:
+            record['modified'] = previous.get('modified', build_time)
+        else:
+            record['modified'] = build_time
+
+        identical = (
+            not self.force and
+            previous.get('hash') == record['hash'] and
+            path.isfile(output_filepath)
+        )
+
+        if not identical:
+            write_html(html, output_filepath)
+
+        return (output_filepath, record, not identical)
+
+    @contextmanager
+    def _stage(self, name, category='build', **args):
+        """
+        Time and trace a stage of the build and, if wanted,
+        profile its memory
+        """
+
+        label = ' '.join([name] + list(args.values()))
+        start = time.perf_counter()
+
+        try:
+            with self.tracer.span(name, category, **args):
+                if self.memory_profiler:
+                    with self.memory_profiler.stage(name, **args):
+                        yield
+                else:
+                    yield
+        finally:
+            timings = self.result['timings']
+            timings[label] = (
+                timings.get(label, 0) + time.perf_counter() - start
+            )
+
+    def _finish(self, start_time):
+        """
+        Save the trace and report the memory profile of a build, if wanted,
+        and return its result
+        """
+
+        self._save_trace()
+
+        if self.memory_profiler:
+            self.report_memory_profile()
+
+        self.result['timings']['total'] = time.perf_counter() - start_time
+
+        return self.result
+
+    def _save_trace(self):
+        """
+        Save the spans recorded in this build to the trace file, if wanted
+        """
+
+        if self.trace_path:
+            self.tracer.save(self.trace_path)
+            self._print("Saved a trace of the build to " + self.trace_path)
 
     def _print(self, message, channel=None):
         if not self.quiet:
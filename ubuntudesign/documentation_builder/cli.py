@@ -1,10 +1,15 @@
 # Core modules
 import argparse
 import sys
-import pkg_resources
+import tempfile
+from shutil import rmtree
 
 # Local modules
-from .builder import Builder
+from . import __version__
+
+# The builder and benchmarks, and the libraries they use,
+# are only imported when they're needed, so that `--help` and `--version`
+# start quickly
 
 
 def parse_arguments(arguments):
@@ -83,7 +88,10 @@ def parse_arguments(arguments):
     parser.add_argument(
         '--force',
         action="store_true",
-        help=("Rebuild all files (assume all files have changed)")
+        help=(
+            "Rebuild all files (assume all files have changed), and "
+            "rewrite outputs even if they're identical to the last build"
+        )
     )
     parser.add_argument(
         '--build-version-branches',
@@ -127,6 +135,182 @@ def parse_arguments(arguments):
         action='store_true',
         help="Don't clean up temporary directory after cloning repository"
     )
+    parser.add_argument(
+        '--io-threads',
+        type=int,
+        help=(
+            "How many threads to use for reading source files ahead of, "
+            "and writing built files behind, the rendering (default: 4)"
+        )
+    )
+    parser.add_argument(
+        '--manifest-path',
+        help=(
+            "Write a JSON manifest of the output files added, changed or "
+            "removed by the build (with their hashes and sizes) to this path"
+        )
+    )
+    parser.add_argument(
+        '--media-copy-mode',
+        choices=['copy', 'hardlink', 'reflink'],
+        help=(
+            "How to put media files into the output: copy them (default), "
+            "hard link them, or clone them copy-on-write (reflink) where "
+            "the filesystem supports it"
+        )
+    )
+    parser.add_argument(
+        '--referenced-media-only',
+        action='store_true',
+        help=(
+            "Only copy media files which are linked to from built pages, "
+            "and list the ones which aren't"
+        )
+    )
+    parser.add_argument(
+        '--content-addressed-media',
+        action='store_true',
+        help=(
+            "Store media files in the output media path named by the "
+            "hash of their content, so files shared between version "
+            "branches are only stored once"
+        )
+    )
+    parser.add_argument(
+        '--fingerprinted-media',
+        action='store_true',
+        help=(
+            "Add a hash of each media file's content to its filename, "
+            "so it can be served with far-future cache headers"
+        )
+    )
+    parser.add_argument(
+        '--image-width',
+        dest='image_widths',
+        action='append',
+        type=int,
+        help=(
+            "Generate resized and WebP variants of PNG and JPEG images "
+            "at this width (if they're wider), and add them to <img> tags "
+            "with srcset. Use more than once for several widths. "
+            "Needs Pillow."
+        )
+    )
+    parser.add_argument(
+        '--image-cache-path',
+        help=(
+            "Where to cache generated image variants between builds "
+            "(default: ~/.cache/documentation-builder/images)"
+        )
+    )
+    parser.add_argument(
+        '--shared-navigation',
+        action='store_true',
+        help=(
+            "Write each navigation tree once, as a JSON file which pages "
+            "load, instead of rendering it into every page"
+        )
+    )
+    parser.add_argument(
+        '--shared-versions',
+        action='store_true',
+        help=(
+            "With --build-version-branches, write one map of which pages "
+            "exist in which versions, for pages to load, instead of "
+            "listing every version in every page"
+        )
+    )
+    parser.add_argument(
+        '--precompress',
+        action='store_true',
+        help=(
+            "Write .gz (and .br, if brotli is installed) copies of "
+            "built pages and other text files which have changed, "
+            "for web servers to serve directly"
+        )
+    )
+    parser.add_argument(
+        '--compress-workers',
+        type=int,
+        help=(
+            "How many processes to compress files with "
+            "(default: the number of CPUs)"
+        )
+    )
+    parser.add_argument(
+        '--search-index',
+        action='store_true',
+        help=(
+            "Build a sharded search index of the pages for each version and "
+            "language, for searching in the browser without --search-url"
+        )
+    )
+    parser.add_argument(
+        '--sitemap-url',
+        help=(
+            "The URL the output folder will be published at. If provided, "
+            "a sitemap.xml of the built pages will be written into it"
+        )
+    )
+    parser.add_argument(
+        '--check-links',
+        action='store_true',
+        help=(
+            "Check that links between pages, and to anchors in them, "
+            "lead somewhere, and report broken links with their source "
+            "file and line"
+        )
+    )
+    parser.add_argument(
+        '--minify',
+        action='store_true',
+        help=(
+            "Remove unneeded whitespace and comments from built pages "
+            "(leaving <pre>, <code>, <textarea>, <script> and <style> "
+            "content alone), and report the bytes saved"
+        )
+    )
+    parser.add_argument(
+        '--trace',
+        dest='trace_path',
+        metavar='FILE',
+        help=(
+            "Write a Chrome trace-event JSON timeline of the build "
+            "to this file"
+        )
+    )
+    parser.add_argument(
+        '--cost-report',
+        type=int,
+        metavar='N',
+        help=(
+            "Report the N pages which took longest to render, "
+            "with their size and how many code blocks they highlighted"
+        )
+    )
+    parser.add_argument(
+        '--max-page-ms',
+        type=float,
+        help="Fail the build if any page takes longer to render than this"
+    )
+    parser.add_argument(
+        '--max-page-bytes',
+        type=int,
+        help="Fail the build if any built page is bigger than this"
+    )
+    parser.add_argument(
+        '--max-build-seconds',
+        type=float,
+        help="Fail the build if it takes longer than this"
+    )
+    parser.add_argument(
+        '--memory-profile',
+        action='store_true',
+        help=(
+            "Report the memory each stage of the build used, "
+            "and the call sites which allocated the most"
+        )
+    )
     parser.add_argument(
         '--quiet',
         action='store_true',
@@ -141,11 +325,7 @@ def parse_arguments(arguments):
     arguments = vars(parser.parse_args(arguments))
 
     if arguments['version']:
-        print(
-            pkg_resources.get_distribution(
-                "ubuntudesign.documentation_builder"
-            ).version
-        )
+        print(__version__)
         sys.exit()
     else:
         del arguments['version']
@@ -154,14 +334,221 @@ def parse_arguments(arguments):
     return {name: value for name, value in arguments.items() if value}
 
 
+def parse_bench_arguments(arguments):
+    """
+    Parse command-line options for the `bench` subcommand
+    """
+
+    parser = argparse.ArgumentParser(
+        prog='documentation-builder bench',
+        description=(
+            "Time each stage of building documentation, either from a "
+            "repository or from a generated one, and compare the times "
+            "with a saved baseline."
+        )
+    )
+
+    parser.add_argument(
+        '--base-directory',
+        help=(
+            "The documentation repository to benchmark. Without this, "
+            "a synthetic repository is generated"
+        )
+    )
+    parser.add_argument(
+        '--source-folder',
+        default='.',
+        help="Path inside the base directory to the markdown files"
+    )
+    parser.add_argument(
+        '--build-version-branches',
+        action='store_true',
+        help="Build each branch mentioned in the `versions` file"
+    )
+    parser.add_argument(
+        '--pages',
+        type=int,
+        default=100,
+        help="Pages in the generated repository (default: 100)"
+    )
+    parser.add_argument(
+        '--depth',
+        type=int,
+        default=2,
+        help="Levels of folders in the generated repository (default: 2)"
+    )
+    parser.add_argument(
+        '--code-blocks',
+        type=int,
+        default=2,
+        help="Code blocks in each generated page (default: 2)"
+    )
+    parser.add_argument(
+        '--media',
+        type=int,
+        default=10,
+        help="Images in the generated repository (default: 10)"
+    )
+    parser.add_argument(
+        '--versions',
+        type=int,
+        default=2,
+        help=(
+            "Version branches in the generated repository, "
+            "with --build-version-branches (default: 2)"
+        )
+    )
+    parser.add_argument(
+        '--repeat',
+        type=int,
+        default=5,
+        help="How many times to time each stage (default: 5)"
+    )
+    parser.add_argument(
+        '--save',
+        help="Save the results as a JSON baseline to this file"
+    )
+    parser.add_argument(
+        '--compare',
+        help=(
+            "Compare the results with a JSON baseline, reporting stages "
+            "which have changed, and failing if any have regressed"
+        )
+    )
+    parser.add_argument(
+        '--threshold',
+        type=float,
+        default=10,
+        help=(
+            "The smallest change in a stage's median time to report, "
+            "as a percentage, if it's also above the noise (default: 10)"
+        )
+    )
+
+    return parser.parse_args(arguments)
+
+
+def bench(system_arguments):
+    """
+    Run the benchmarks, saving or comparing their results as asked
+    """
+
+    from .benchmarks import (
+        compare_results,
+        format_comparison,
+        generate_corpus,
+        load_results,
+        run_benchmarks,
+        save_results,
+    )
+
+    arguments = parse_bench_arguments(system_arguments)
+    corpus_directory = None
+    base_directory = arguments.base_directory
+
+    if not base_directory:
+        corpus_directory = tempfile.mkdtemp()
+        base_directory = corpus_directory
+        versions = None
+
+        if arguments.build_version_branches:
+            # "latest", then "1.0", "1.1" and so on
+            versions = ['latest'] + [
+                '1.{}'.format(number)
+                for number in range(max(arguments.versions, 1) - 1)
+            ]
+
+        generate_corpus(
+            base_directory,
+            pages=arguments.pages,
+            depth=arguments.depth,
+            code_blocks=arguments.code_blocks,
+            media=arguments.media,
+            versions=versions
+        )
+
+    try:
+        results = run_benchmarks(
+            base_directory,
+            repeat=arguments.repeat,
+            source_folder=arguments.source_folder,
+            build_version_branches=arguments.build_version_branches,
+            out=sys.stdout
+        )
+    finally:
+        if corpus_directory:
+            rmtree(corpus_directory)
+
+    options = {
+        name: value for name, value in vars(arguments).items()
+        if name not in ['save', 'compare', 'threshold']
+    }
+
+    if arguments.save:
+        save_results(arguments.save, results, options)
+        print("Saved results to {}".format(arguments.save))
+
+    if arguments.compare:
+        baseline, baseline_options = load_results(arguments.compare)
+
+        if baseline_options != options:
+            print(
+                "Notice: The baseline was run with different options: "
+                "{}".format(
+                    ', '.join(
+                        '{}={}'.format(name, baseline_options.get(name))
+                        for name in sorted(options)
+                        if baseline_options.get(name) != options[name]
+                    )
+                ),
+                file=sys.stderr
+            )
+
+        comparisons = compare_results(
+            baseline,
+            results,
+            threshold=arguments.threshold / 100
+        )
+        regressions = []
+
+        for status in ['regressed', 'improved', 'unchanged']:
+            descriptions = [
+                format_comparison(comparison)
+                for comparison in comparisons
+                if comparison['status'] == status
+            ]
+
+            if descriptions:
+                print(
+                    "{}:\n- {}".format(
+                        status.capitalize(), '\n- '.join(descriptions)
+                    )
+                )
+
+            if status == 'regressed':
+                regressions = descriptions
+
+        if regressions:
+            sys.exit(1)
+
+
 def main(system_arguments):
     """
     The starting point for the documentation-parser.
     Intended to be run through the command-line.
     """
 
+    if system_arguments[:1] == ['bench']:
+        return bench(system_arguments[1:])
+
     arguments = parse_arguments(system_arguments)
-    Builder(**arguments)
+
+    from .builder import Builder
+
+    builder = Builder(**arguments)
+
+    if builder.result['over_budget']:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -6,6 +6,7 @@ Custom markdown extensions for the documentation builder
 from __future__ import absolute_import
 from __future__ import unicode_literals
 import re
+import time
 import jinja2
 
 # Local
@@ -159,3 +160,70 @@ class NotificationsProcessor(BlockProcessor):
             # `p-notification__status` title `span`
             title = None
         return notification_type, title
+
+
+class HighlightTimer():
+    """
+    Count the code blocks a markdown parser highlights with Pygments,
+    and the seconds spent highlighting them, while in a with block.
+
+    The codehilite and fenced_code extensions highlight in their own
+    processors, each storing one block of HTML per code block, so only
+    this parser's processors are timed, and only for the duration.
+    Like the parser itself, it shouldn't be shared between threads.
+    A HighlightTimer which isn't enabled times nothing.
+
+    Usage:
+
+        with HighlightTimer(parser) as highlighting:
+            html = parser.convert(content)
+
+        print(highlighting.blocks, highlighting.seconds)
+    """
+
+    processors = [
+        ('preprocessors', 'fenced_code_block'),
+        ('treeprocessors', 'hilite'),
+    ]
+
+    def __init__(self, parser, enabled=True):
+        self.parser = parser
+        self.enabled = enabled
+        self.blocks = 0
+        self.seconds = 0
+        self._timed = []
+
+    def _time(self, run):
+        def timed_run(*args, **kwargs):
+            stash = self.parser.htmlStash
+            blocks = stash.html_counter
+            start = time.perf_counter()
+
+            try:
+                return run(*args, **kwargs)
+            finally:
+                self.seconds += time.perf_counter() - start
+                self.blocks += stash.html_counter - blocks
+
+        return timed_run
+
+    def __enter__(self):
+        if not self.enabled:
+            return self
+
+        for kind, name in self.processors:
+            processors = getattr(self.parser, kind)
+
+            if name in processors:
+                processor = processors[name]
+                processor.run = self._time(processor.run)
+                self._timed.append(processor)
+
+        return self
+
+    def __exit__(self, *exception):
+        # Back to the processor's own run method
+        for processor in self._timed:
+            del processor.run
+
+        self._timed = []
@@ -1,30 +1,162 @@
 # Core modules
+import gzip
+import hashlib
+import json
 import re
 import tempfile
+import time
 from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 from glob import glob, iglob
-from os import makedirs, path
+from io import BytesIO
+from os import makedirs, path, remove, stat
+from urllib.parse import unquote
+from xml.sax.saxutils import escape
 
 # Third party modules
 import frontmatter
 import yaml
 from bs4 import BeautifulSoup
-from git import Repo
 from yaml.scanner import ScannerError
 from yaml.parser import ParserError
 from xml.etree.ElementTree import ParseError
 
 # Local modules
 from .utilities import (
+    Tracer,
+    atomic_write,
+    blob_hash,
     cache_dir,
+    clone_file,
+    content_hash,
+    file_hash,
+    is_inside,
     matching_metadata,
-    mergetree,
+    read_file,
     relativize,
     replace_link_paths,
+    responsive_image_tags,
+    walk_files,
 )
 
 
+# Where the builder keeps its records of previous builds,
+# inside the output folder
+state_folder = ".documentation-builder"
+image_extensions = [".jpeg", ".jpg", ".png"]
+block_tag_match = (
+    r"</?(address|article|aside|blockquote|body|br|dd|div|dl|dt|fieldset|"
+    r"figcaption|figure|footer|form|h[1-6]|head|header|hr|html|li|link|"
+    r"main|meta|nav|noscript|ol|p|picture|pre|script|section|source|style|"
+    r"table|tbody|td|tfoot|th|thead|title|tr|ul|!doctype)\b"
+)
+# The characters HTML treats as whitespace (not including "\xa0")
+html_whitespace = " \t\n\r\f"
+# The most URLs a sitemap can list
+sitemap_limit = 50000
+# How much more a term counts in a page's title or headings
+search_weights = {"title": 10, "heading": 3, "text": 1}
+compressible_extensions = [
+    ".css",
+    ".html",
+    ".js",
+    ".json",
+    ".svg",
+    ".txt",
+    ".xml",
+]
+
+
+def asset_path(source_filepath, output_directory):
+    """
+    The output path for an asset (e.g. a stylesheet) in output_directory,
+    with a hash of its content in its name
+    (e.g. "template.css" becomes "template.0123456789ab.css"),
+    so it can be shared by all pages and cached for as long as it exists
+    """
+
+    name, extension = path.splitext(path.basename(source_filepath))
+
+    return path.join(
+        output_directory,
+        "{}.{}{}".format(name, file_hash(source_filepath)[:12], extension),
+    )
+
+
+def build_fingerprint(options, directories, filepaths, exclude=[]):
+    """
+    Summarise all the inputs to a build into a single hash:
+    the build options, the path, size and modification time of every
+    file inside the input directories, and the contents of input files
+    """
+
+    fingerprint = hashlib.sha256()
+    fingerprint.update(
+        json.dumps(options, sort_keys=True, default=str).encode("utf-8")
+    )
+
+    for directory in directories:
+        fingerprint.update(b"\0directory\0" + directory.encode("utf-8"))
+
+        for filepath, stats in walk_files(directory, exclude):
+            fingerprint.update(
+                "{}\0{}\0{}\n".format(
+                    filepath, stats.st_size, stats.st_mtime_ns
+                ).encode("utf-8")
+            )
+
+    for filepath in filepaths:
+        fingerprint.update(b"\0file\0" + filepath.encode("utf-8"))
+
+        if path.isfile(filepath):
+            fingerprint.update(file_hash(filepath).encode("utf-8"))
+
+    return fingerprint.hexdigest()
+
+
+def build_search_index(documents, previous_urls=[]):
+    """
+    Build an inverted index of search documents (from `search_document`),
+    keyed by their URLs, sharded by the first character of each term.
+
+    Pages keep their numbers from the previous index (previous_urls),
+    with new pages taking the places of removed ones,
+    so changing one page only changes the shards of its own terms.
+
+    Return the list of page URLs (None for unused numbers),
+    the pages as [url, title] (or None),
+    and the shards as {key: {term: [[page number, weight], ...]}}
+    """
+
+    urls = [url if url in documents else None for url in previous_urls]
+    gaps = iter([number for number, url in enumerate(urls) if url is None])
+
+    for url in sorted(set(documents) - set(urls)):
+        number = next(gaps, None)
+
+        if number is None:
+            urls.append(url)
+        else:
+            urls[number] = url
+
+    while urls and urls[-1] is None:
+        urls.pop()
+
+    pages = [[url, documents[url]["title"]] if url else None for url in urls]
+    shards = {}
+
+    for number, url in enumerate(urls):
+        if url is None:
+            continue
+
+        for term, weight in sorted(documents[url]["terms"].items()):
+            shard = shards.setdefault(search_shard_key(term), {})
+            shard.setdefault(term, []).append([number, weight])
+
+    return urls, pages, shards
+
+
 def compile_metadata(metadata_items, context_path):
     metadata = {}
 
@@ -36,24 +168,117 @@ def compile_metadata(metadata_items, context_path):
     return metadata
 
 
+def compress_file(filepath, formats):
+    """
+    Write compressed copies of a file alongside it
+    (e.g. "index.html.gz" and "index.html.br"),
+    for web servers to serve without compressing each response.
+    Return the hash and size of each compressed copy, by format.
+    """
+
+    with open(filepath, "rb") as source_file:
+        content = source_file.read()
+
+    compressed_files = {}
+
+    for compression_format in formats:
+        if compression_format == "br":
+            import brotli
+
+            compressed = brotli.compress(content)
+        else:
+            compressed = gzip.compress(content, compresslevel=9, mtime=0)
+
+        atomic_write(filepath + "." + compression_format, compressed)
+        compressed_files[compression_format] = [
+            content_hash(compressed),
+            len(compressed),
+        ]
+
+    return compressed_files
+
+
+def compression_formats():
+    """
+    The formats to compress files in: gzip,
+    and brotli if the brotli module is installed
+    """
+
+    try:
+        import brotli  # noqa: F401
+    except ImportError:
+        return ["gz"]
+
+    return ["gz", "br"]
+
+
+def content_addressed_filenames(media_hashes):
+    """
+    Given the content hashes of media files, map each file to a path
+    in a content-addressed store, named by its hash (keeping the extension)
+    """
+
+    filenames = {}
+
+    for filepath, media_hash in media_hashes.items():
+        extension = path.splitext(filepath)[1].lower()
+        filenames[filepath] = "{}/{}{}".format(
+            media_hash[:2], media_hash[2:], extension
+        )
+
+    return filenames
+
+
 def copy_media(media_path, output_media_path):
     """
     Copy media files from source_media_path to output_media_path
     """
 
-    media_paths_match = path.relpath(media_path, output_media_path) == "."
+    if sync_media(media_path, output_media_path) is not None:
+        return True
 
-    if not media_paths_match:
-        mergetree(media_path, output_media_path)
 
-        return True
+def find_broken_links(pages):
+    """
+    Check the links recorded from built pages, in a single pass,
+    against an index of the pages and the anchors in them.
+    `pages` maps each page's output path to its "anchors" (IDs)
+    and "links" (as [href, line]) records.
+    Return the broken links as (output path, href, line, reason)
+    """
 
+    anchors = {output: set(page["anchors"]) for output, page in pages.items()}
+    broken = []
+
+    for output, page in sorted(pages.items()):
+        for href, line in page["links"]:
+            link_path, _, fragment = href.partition("#")
+            link_path = unquote(link_path.split("?")[0])
+            target = output
+
+            if link_path:
+                target = path.normpath(
+                    path.join(
+                        path.dirname(output),
+                        path.splitext(link_path)[0] + ".html",
+                    )
+                )
+
+            if target not in anchors:
+                broken.append((output, href, line, "no such page"))
+            elif fragment and unquote(fragment) not in anchors[target]:
+                broken.append((output, href, line, "no such anchor"))
+
+    return broken
 
-def find_files(source_path, output_path, metadata_items):
+
+def find_files(source_path, output_path, metadata_items, built_times={}):
     """
     Find all markdown files in the source_path,
     check if they have built versions in the output_path. Check which is newer
     and if the metadata contains any relevant changes.
+    `built_times` can map output filepaths to when they were last
+    built, for outputs which weren't rewritten because they were unchanged.
     Return four lists:
         (new_files, modified_files, unmodified_files, uppercase_files)
     """
@@ -87,7 +312,11 @@ def find_files(source_path, output_path, metadata_items):
 
             # Check if the file is modified
             modified = max(metadata_modified, path.getmtime(filepath))
-            if path.getmtime(output_filepath) < modified:
+            built = max(
+                path.getmtime(output_filepath),
+                built_times.get(path.normpath(output_filepath), 0),
+            )
+            if built < modified:
                 modified_files.append(filepath)
             else:
                 unmodified_files.append(filepath)
@@ -133,35 +362,380 @@ def find_metadata(directory_path):
     return metadata_items
 
 
-def parse_markdown(parser, template, filepath, metadata):
+def fingerprinted_filenames(media_hashes, length=12):
+    """
+    Given the content hashes of media files, add the start of each hash
+    to its filename (e.g. "image.png" becomes "image.0123456789ab.png"),
+    so the files can be cached for as long as their names exist
+    """
+
+    filenames = {}
+
+    for filepath, media_hash in media_hashes.items():
+        name, extension = path.splitext(filepath)
+        filenames[filepath] = "{}.{}{}".format(
+            name, media_hash[:length], extension
+        )
+
+    return filenames
+
+
+def generate_image_variants(
+    media_path,
+    output_media_path,
+    images,
+    media_hashes,
+    cache_path,
+    threads=4,
+    mode="copy",
+):
+    """
+    Write the resized and WebP variants of images into output_media_path.
+    Each variant is generated into cache_path once per source hash,
+    so later builds (and other version branches) only need to copy it.
+    Return a list of the variant files written.
+    """
+
+    jobs = {}
+
+    for filepath, image in sorted(images.items()):
+        media_hash = media_hashes[filepath]
+
+        for filename, width in image["variants"]:
+            jobs[path.join(output_media_path, filename)] = (
+                path.join(media_path, filepath),
+                path.join(
+                    cache_path,
+                    media_hash[:2],
+                    media_hash,
+                    "{}{}".format(width, path.splitext(filename)[1]),
+                ),
+                width,
+            )
+
+    def generate(output_filepath):
+        source_filepath, cached_filepath, width = jobs[output_filepath]
+
+        if not path.isfile(cached_filepath):
+            resize_image(source_filepath, cached_filepath, width)
+
+        makedirs(path.dirname(output_filepath), exist_ok=True)
+        clone_file(cached_filepath, output_filepath, mode)
+
+    with ThreadPoolExecutor(max(1, threads)) as image_pool:
+        list(image_pool.map(generate, jobs))
+
+    return sorted(jobs)
+
+
+def git_media_hashes(repository_path, media_path):
+    """
+    Read the git blob hashes of the files in a media folder inside a
+    clean git checkout from its index, without reading any files.
+    Return them mapped by path relative to the media folder.
+    """
+
+    # GitPython is slow to import, and only needed for version branches
+    from git import Repo
+
+    repo = Repo(repository_path)
+    media_folder = path.relpath(media_path, repository_path)
+    media_hashes = {}
+
+    for (filepath, stage), entry in repo.index.entries.items():
+        filepath = path.normpath(filepath)
+
+        if is_inside(filepath, media_folder):
+            media_hashes[path.relpath(filepath, media_folder)] = entry.hexsha
+
+    return media_hashes
+
+
+def hash_media(media_path, cache):
+    """
+    Find the git blob hashes of all files in a media folder.
+    The cache dictionary records the size, modification time and hash
+    of each file, and is updated, so unchanged files aren't read again.
+    Return the hashes mapped by path relative to the media folder.
+    """
+
+    media_hashes = {}
+
+    for filepath, stats in walk_files(media_path, hidden=True):
+        signature = [stats.st_size, stats.st_mtime_ns]
+        cached = cache.get(filepath)
+
+        if cached and cached[:2] == signature:
+            media_hashes[filepath] = cached[2]
+        else:
+            media_hashes[filepath] = blob_hash(path.join(media_path, filepath))
+            cache[filepath] = signature + [media_hashes[filepath]]
+
+    for filepath in set(cache) - set(media_hashes):
+        del cache[filepath]
+
+    return media_hashes
+
+
+def image_sizes(media_path, media_hashes, cache):
+    """
+    Find the width and height of each image among the media files.
+    Sizes are cached by content hash in the cache dictionary,
+    so each image is only opened once.
+    Files which can't be read as images are left out.
+    """
+
+    from PIL import Image
+
+    sizes = {}
+
+    for filepath, media_hash in sorted(media_hashes.items()):
+        if path.splitext(filepath)[1].lower() not in image_extensions:
+            continue
+
+        if media_hash not in cache:
+            try:
+                with Image.open(path.join(media_path, filepath)) as image:
+                    cache[media_hash] = list(image.size)
+            except (IOError, SyntaxError):
+                cache[media_hash] = None
+
+        if cache[media_hash]:
+            sizes[filepath] = cache[media_hash]
+
+    return sizes
+
+
+def load_build_fingerprint(output_path):
+    """
+    Load the fingerprint of the inputs to the last build into output_path,
+    if there was one
+    """
+
+    fingerprint_path = path.join(output_path, state_folder, "fingerprint")
+
+    if path.isfile(fingerprint_path):
+        with open(fingerprint_path, encoding="utf-8") as fingerprint_file:
+            return fingerprint_file.read().strip()
+
+
+def load_build_state(output_path):
+    """
+    Load the records the builder kept about the last build into output_path.
+    Return them in the format:
+    {
+        'outputs': {
+            'relative/output/file.html': {
+                'hash': [content hash],
+                'size': [bytes],
+                'built': [time of last build],
+                'kind': ['page' or 'media'],
+                'source': [source file, relative to the source or media folder]
+            },
+            ...
+        },
+        'media': {
+            'source': [media folder],
+            'output': [output media folder],
+            'files': {
+                'relative/media/file.png': [
+                    size, modification time, copy mode
+                ],
+                ...
+            }
+        }
+    }
+    """
+
+    state = {}
+    state_path = path.join(output_path, state_folder, "state.json")
+
+    if path.isfile(state_path):
+        with open(state_path, encoding="utf-8") as state_file:
+            try:
+                state = json.load(state_file)
+            except ValueError:
+                # A corrupted state just means a full rebuild
+                state = {}
+
+    state.setdefault("outputs", {})
+
+    return state
+
+
+def minify_html(html):
+    """
+    Safely remove unneeded whitespace and comments from HTML:
+    - Leave the content of <pre>, <code>, <textarea>, <script> and <style>
+      elements exactly as it is
+    - Collapse runs of whitespace to single spaces (outside attribute values)
+    - Remove whitespace next to block-level tags, where it isn't shown
+    - Remove comments, except conditional comments
+    Only HTML's own (ASCII) whitespace counts, so non-breaking spaces
+    are left as they are.
+    """
+
+    tokens = re.split(
+        r"(<(pre|code|textarea|script|style)\b.*?</\2[ \t\n\r\f]*>"
+        r"|<!--.*?-->|<(?:\"[^\"]*\"|'[^']*'|[^'\">])*>)",
+        html,
+        flags=re.DOTALL | re.IGNORECASE,
+    )
+    minified = []
+    strip_next = True
+    text = ""
+
+    # re.split yields text, then the whole match and its group, in turn
+    for index in range(0, len(tokens), 3):
+        text = re.sub(r"[ \t\n\r\f]+", " ", text + tokens[index])
+
+        if strip_next:
+            text = text.lstrip(html_whitespace)
+
+        if index + 1 == len(tokens):
+            minified.append(text.rstrip(html_whitespace))
+            break
+
+        tag = tokens[index + 1]
+        block = re.match(block_tag_match, tag, flags=re.IGNORECASE)
+
+        if tag.startswith("<!--") and not tag.startswith("<!--[if"):
+            # Join the text either side of the comment
+            continue
+
+        if block:
+            text = text.rstrip(html_whitespace)
+        elif not tokens[index + 2]:
+            tag = re.sub(
+                r"(\"[^\"]*\"|'[^']*')|[ \t\n\r\f]+",
+                lambda match: match.group(1) or " ",
+                tag,
+            )
+            tag = re.sub(r"[ \t\n\r\f]+(/?>)$", r"\1", tag)
+
+        minified.append(text + tag)
+        strip_next = bool(block)
+        text = ""
+
+    return "".join(minified)
+
+
+def navigation_index(items, parents=[]):
+    """
+    Index a navigation tree by the location of each item (without its
+    extension), mapping each location to the list of items that lead to it,
+    so the breadcrumbs for any page can be looked up directly
+    """
+
+    index = {}
+
+    for item in items:
+        location = item.get("location")
+        trail = parents + [item]
+
+        if location:
+            index.setdefault(
+                path.splitext(path.normpath(location))[0], trail
+            )
+
+        for name, child_trail in navigation_index(
+            item.get("children") or [], trail
+        ).items():
+            index.setdefault(name, child_trail)
+
+    return index
+
+
+def navigation_json(items, extensions=True):
+    """
+    Convert a navigation tree into compact JSON for pages to load,
+    converting links to markdown files as `replace_internal_links` would
+    """
+
+    def convert(items):
+        converted = []
+
+        for item in items:
+            item = dict(item)
+
+            if item.get("location"):
+                item["location"] = re.sub(
+                    r"^((?:[^ \"'/]|(?<!/)/)+)\.md\b",
+                    r"\1.html" if extensions else r"\1",
+                    item["location"],
+                )
+
+            if item.get("children"):
+                item["children"] = convert(item["children"])
+
+            converted.append(item)
+
+        return converted
+
+    return json.dumps(convert(items), separators=(",", ":"), sort_keys=True)
+
+
+def navigation_scope(metadata_items, context_path):
+    """
+    Find the folder of the metadata.yaml which defines the navigation
+    for pages in a folder, or None if there's no navigation
+    """
+
+    scope = None
+
+    for dirpath, item in matching_metadata(metadata_items, context_path):
+        if "navigation" in item["content"]:
+            scope = dirpath
+
+    return scope
+
+
+def page_anchors(html):
+    """
+    Find the IDs (and names) of the elements in a page which links to it
+    can point to, including its headings
+    """
+
+    return sorted(
+        set(re.findall(r'\s(?:id|name)=["\']([^"\']+)["\']', html))
+    )
+
+
+def parse_markdown(parser, template, filepath, metadata, content=None):
+    """
+    Render a markdown file into the template.
+    If the file's content has already been read (e.g. by a read-ahead
+    thread) it can be passed in as `content` to avoid reading it again.
+    """
+
     parser.reset()
     metadata = deepcopy(metadata)
 
+    if content is None:
+        content = read_file(filepath)
+
     # Try to extract frontmatter metadata
-    with open(filepath, encoding="utf-8") as markdown_file:
-        file_content = markdown_file.read()
-
-        try:
-            file_parts = frontmatter.loads(file_content)
-            metadata.update(file_parts.metadata)
-            metadata["content"] = parser.convert(file_parts.content)
-        except (ScannerError, ParserError):
-            """
-            If there's a parsererror, it's because frontmatter had to parse
-            the entire file (not finding frontmatter at the top)
-            and encountered an unexpected format somewhere in it.
-            This means the file has no frontmatter, so we can simply continue.
-            """
-
-            metadata["content"] = parser.convert(file_content)
-        except ParseError:
-            """
-            If there is a parse error in a file, it is useful to know
-            which file it is
-            """
-
-            print("Error parsing file: {}".format(filepath))
-            raise
+    try:
+        file_parts = frontmatter.loads(content)
+        metadata.update(file_parts.metadata)
+        metadata["content"] = parser.convert(file_parts.content)
+    except (ScannerError, ParserError):
+        """
+        If there's a parsererror, it's because frontmatter had to parse
+        the entire file (not finding frontmatter at the top)
+        and encountered an unexpected format somewhere in it.
+        This means the file has no frontmatter, so we can simply continue.
+        """
+
+        metadata["content"] = parser.convert(content)
+    except ParseError:
+        """
+        If there is a parse error in a file, it is useful to know
+        which file it is
+        """
+
+        print("Error parsing file: {}".format(filepath))
+        raise
 
     # Now add on any multimarkdown-format metadata
     if hasattr(parser, "Meta"):
@@ -195,24 +769,33 @@ def parse_markdown(parser, template, filepath, metadata):
     return template.render(metadata)
 
 
-def prepare_version_branches(base_directory, output_base):
+def prepare_version_branches(
+    base_directory, output_base, tracer=None, clone_path=None
+):
     """
     If build_version_branches is true, look for a "versions" file in the
     base_directory and then pull each version branch.
     Otherwise, just return the base directory.
+    If a Tracer is provided, the time spent cloning each branch
+    is recorded in it.
+    Branches are cloned into clone_path, or the user's cache directory.
     """
 
-    version_branches = {}
+    from git import Repo
 
-    with open(path.join(base_directory, "versions")) as versions_file:
-        lines = versions_file.read().splitlines()
-        version_branch_names = list(filter(None, lines))
+    tracer = tracer or Tracer(enabled=False)
+
+    version_branches = {}
+    version_branch_names = read_versions(base_directory)
 
-    builder_cache = cache_dir("documentation-builder")
+    if clone_path:
+        makedirs(clone_path, exist_ok=True)
+    else:
+        clone_path = cache_dir("documentation-builder")
 
     order = 0
     for name in version_branch_names:
-        branch_base_directory = tempfile.mkdtemp(dir=builder_cache)
+        branch_base_directory = tempfile.mkdtemp(dir=clone_path)
 
         # Make sure remote branches are created locally before cloning
         base_repo = Repo(base_directory)
@@ -222,7 +805,11 @@ def prepare_version_branches(base_directory, output_base):
                     if ref.name.endswith("/" + name):
                         base_repo.create_head(name, ref.name)
 
-        Repo.clone_from(base_directory, branch_base_directory, branch=name)
+        with tracer.span("clone", "git", version=name):
+            Repo.clone_from(
+                base_directory, branch_base_directory, branch=name
+            )
+
         version_branches[name] = {
             "base_directory": branch_base_directory,
             "output_path": path.join(output_base, name),
@@ -234,6 +821,18 @@ def prepare_version_branches(base_directory, output_base):
     return version_branches
 
 
+def read_versions(base_directory):
+    """
+    Read the list of version branch names from the "versions" file
+    in the base_directory
+    """
+
+    with open(path.join(base_directory, "versions")) as versions_file:
+        lines = versions_file.read().splitlines()
+
+    return list(filter(None, lines))
+
+
 def relativize_paths(item, original_base_path, new_base_path):
     """
     Recursively search a dictionary for items that look like local markdown
@@ -261,13 +860,28 @@ def relativize_paths(item, original_base_path, new_base_path):
     return item
 
 
-def replace_internal_links(html, extensions=True):
+def replace_internal_links(html, extensions=True, links=None):
     """
     Replace internal links to .md files
     with .html extensions (if extensios is default of True)
-    or no extension otherwise
+    or no extension otherwise.
+    If a `links` list is provided, the href of each link to another page
+    (a relative link to a .md or .html file) or to an anchor
+    in this page is added to it, before it's replaced.
     """
 
+    if links is not None:
+        for href in re.findall(r'href=["\']([^"\']*)["\']', html):
+            link_path = re.split(r"[?#]", href)[0]
+
+            if re.match(r"^([a-zA-Z][a-zA-Z0-9+.-]*:|/)", href):
+                continue
+
+            if link_path.endswith((".md", ".html")) or (
+                not link_path and href.startswith("#")
+            ):
+                links.append(href)
+
     internal_link_match = re.compile(
         r'(?:(?<=src=["\'])|(?<=href=["\']))'
         r'((?:[^ "\'/]|(?<![/"\'])/)+)\.md\b'
@@ -282,10 +896,25 @@ def replace_internal_links(html, extensions=True):
     return html
 
 
-def replace_media_links(html, old_path, new_path, context_directory="."):
+def replace_media_links(
+    html,
+    old_path,
+    new_path,
+    context_directory=".",
+    references=None,
+    filenames=None,
+    images=None,
+):
     """
     Replace links to media with the new media location.
     Do this intelligently relative to the current directory of the file.
+    If a `references` set is provided, add the path of each
+    linked media file (relative to the media folder) to it.
+    If a `filenames` dictionary is provided, media files are also
+    renamed to their new paths (relative to the new media location).
+    If an `images` dictionary is provided (from `responsive_images`),
+    <img> tags for those images get srcset, width, height
+    and loading attributes, and a WebP <source>.
     """
 
     if old_path:
@@ -294,11 +923,344 @@ def replace_media_links(html, old_path, new_path, context_directory="."):
         if not path.isabs(new_path):
             new_path = path.relpath(new_path, context_directory)
 
-        html = replace_link_paths(html, old_path, new_path)
+        if images:
+            html = responsive_image_tags(html, old_path, new_path, images)
+
+        html = replace_link_paths(
+            html, old_path, new_path, references, filenames
+        )
 
     return html
 
 
+def resize_image(source_filepath, output_filepath, width):
+    """
+    Save a copy of an image resized to a width, keeping its aspect ratio,
+    in the format given by the output file's extension
+    """
+
+    from PIL import Image
+
+    extension = path.splitext(output_filepath)[1].lower()
+
+    with Image.open(source_filepath) as image:
+        image_format = "WEBP" if extension == ".webp" else image.format
+
+        if image.mode not in ("RGB", "RGBA", "L"):
+            image = image.convert("RGBA" if image_format != "JPEG" else "RGB")
+
+        if width != image.width:
+            image = image.resize(
+                (width, max(1, round(image.height * width / image.width))),
+                Image.LANCZOS,
+            )
+
+        output = BytesIO()
+
+        if image_format == "JPEG":
+            image.save(output, image_format, quality=85, progressive=True)
+        elif image_format == "WEBP":
+            image.save(output, image_format, quality=80)
+        else:
+            image.save(output, image_format)
+
+    makedirs(path.dirname(output_filepath), exist_ok=True)
+    atomic_write(output_filepath, output.getvalue())
+
+
+def responsive_images(sizes, widths, filenames={}):
+    """
+    Plan the variants of each image: a copy resized to each width
+    smaller than the image, and WebP versions of those and of the image.
+    Return, for each image, its width and height,
+    its "srcset" and "webp" candidates as [filename, width] pairs
+    and the "variants" which need generating.
+    Filenames are relative to the output media path.
+    """
+
+    images = {}
+
+    for filepath, (width, height) in sizes.items():
+        filename = filenames.get(filepath, filepath)
+        name, extension = path.splitext(filename)
+        smaller_widths = sorted(
+            variant_width for variant_width in set(widths)
+            if variant_width < width
+        )
+        resized = [
+            ["{}.{}w{}".format(name, variant_width, extension), variant_width]
+            for variant_width in smaller_widths
+        ]
+        webp = [
+            ["{}.{}w.webp".format(name, variant_width), variant_width]
+            for variant_width in smaller_widths + [width]
+        ]
+
+        images[filepath] = {
+            "width": width,
+            "height": height,
+            "srcset": resized + [[filename, width]],
+            "webp": webp,
+            "variants": resized + webp,
+        }
+
+    return images
+
+
+def save_build_state(output_path, state, fingerprint=None):
+    """
+    Save the records about this build for the next build into output_path,
+    along with the fingerprint of its inputs, if provided
+    (otherwise removing any previous fingerprint, so the next build
+    can't be skipped)
+    """
+
+    state_dir = path.join(output_path, state_folder)
+
+    makedirs(state_dir, exist_ok=True)
+
+    atomic_write(
+        path.join(state_dir, "state.json"),
+        json.dumps(state, separators=(",", ":")).encode("utf-8"),
+    )
+
+    fingerprint_path = path.join(state_dir, "fingerprint")
+
+    if fingerprint:
+        atomic_write(fingerprint_path, fingerprint.encode("utf-8"))
+    elif path.isfile(fingerprint_path):
+        remove(fingerprint_path)
+
+
+def search_document(html):
+    """
+    Extract what the search index needs from a built page:
+    its title, and the weighted terms in the title, headings and text
+    of its main content (excluding any footer)
+    """
+
+    soup = BeautifulSoup(html, "html.parser")
+    main = soup.main or soup.body or soup
+
+    for element in main(["footer", "script", "style"]):
+        element.decompose()
+
+    heading = main.find("h1")
+    title = heading.get_text() if heading else ""
+
+    if not title and soup.title:
+        title = soup.title.get_text().split(" | ")[0]
+
+    title = " ".join(title.split())
+    terms = {}
+    weighted_texts = [(title, search_weights["title"])]
+    weighted_texts.extend(
+        (heading.get_text(), search_weights["heading"])
+        for heading in main(re.compile(r"^h[1-6]$"))
+    )
+    weighted_texts.append((main.get_text(" "), search_weights["text"]))
+
+    for text, weight in weighted_texts:
+        for term in search_terms(text):
+            terms[term] = terms.get(term, 0) + weight
+
+    return {"title": title, "terms": terms}
+
+
+def search_shard_key(term):
+    """
+    The shard of the search index a term belongs in
+    """
+
+    key = term[0]
+
+    return key if key in "abcdefghijklmnopqrstuvwxyz0123456789" else "_"
+
+
+def search_terms(text):
+    """
+    Split text into the lowercase words the search index is made of,
+    ignoring single characters
+    """
+
+    return [word for word in re.findall(r"\w+", text.lower()) if len(word) > 1]
+
+
+def sitemap_xml(entries, index=False):
+    """
+    Render a sitemap of (URL, last modified time) entries,
+    or with index=True, a sitemap index of (sitemap URL, time) entries
+    """
+
+    if index:
+        root, element = "sitemapindex", "sitemap"
+    else:
+        root, element = "urlset", "url"
+
+    lines = [
+        '<?xml version="1.0" encoding="UTF-8"?>',
+        '<{} xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">'.format(
+            root
+        ),
+    ]
+
+    for url, modified in entries:
+        lines.append(
+            "<{0}><loc>{1}</loc><lastmod>{2}</lastmod></{0}>".format(
+                element,
+                escape(url),
+                time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(modified)),
+            )
+        )
+
+    lines.append("</{}>".format(root))
+
+    return "\n".join(lines) + "\n"
+
+
+def source_lines(content, strings):
+    """
+    Find the line number of each of a list of strings in the content
+    of a source file, in turn, so repeated strings are found at
+    each of their occurrences (or None where one isn't there)
+    """
+
+    lines = [None] * len(strings)
+    positions = {}
+    found = []
+
+    for index, string in enumerate(strings):
+        position = content.find(string, positions.get(string, 0))
+
+        if position >= 0:
+            positions[string] = position + len(string)
+            found.append((position, index))
+
+    # Count lines in order of position, so the content is only read once
+    line = 1
+    previous = 0
+
+    for position, index in sorted(found):
+        line += content.count("\n", previous, position)
+        previous = position
+        lines[index] = line
+
+    return lines
+
+
+def store_media(
+    media_path, output_media_path, filenames, mode="copy", threads=4
+):
+    """
+    Copy media files into output_media_path under their new,
+    content-hashed names from the filenames dictionary.
+    Files which already exist are skipped, as their names
+    mean they must already have the same content.
+    Return a list of the output files which were copied.
+    """
+
+    copies = {}
+
+    for filepath, filename in sorted(filenames.items()):
+        output_filepath = path.join(output_media_path, filename)
+
+        if output_filepath not in copies and not path.isfile(output_filepath):
+            copies[output_filepath] = path.join(media_path, filepath)
+
+    def copy(output_filepath):
+        makedirs(path.dirname(output_filepath), exist_ok=True)
+        clone_file(copies[output_filepath], output_filepath, mode)
+
+    with ThreadPoolExecutor(max(1, threads)) as copy_pool:
+        list(copy_pool.map(copy, copies))
+
+    return sorted(copies)
+
+
+def sync_media(
+    media_path,
+    output_media_path,
+    manifest=None,
+    mode="copy",
+    threads=4,
+    force=False,
+    include=None,
+):
+    """
+    Copy new or updated media files from media_path to output_media_path,
+    copying up to `threads` files at a time.
+    If an `include` set of file paths (relative to media_path) is provided,
+    only those files are copied, without looking at any others.
+
+    If a manifest is provided - a dictionary of the size, modification
+    time and copy mode of each media file when it was last copied,
+    which will be updated - files which haven't changed since, and were
+    copied the same way, are skipped without checking the output.
+    Otherwise, files are copied if they're newer than the output.
+    With force=True, all files are copied.
+
+    mode can be "copy", "hardlink" or "reflink" (see clone_file).
+
+    Return a list of the output files which were copied
+    (or None if the two paths are the same)
+    """
+
+    media_paths_match = path.relpath(media_path, output_media_path) == "."
+
+    if media_paths_match:
+        return None
+
+    if not path.isdir(media_path):
+        raise EnvironmentError("Source tree not found: " + media_path)
+
+    copies = []
+    found_files = set()
+
+    if include is None:
+        media_files = walk_files(media_path, hidden=True)
+    else:
+        media_files = (
+            (filepath, stat(path.join(media_path, filepath)))
+            for filepath in sorted(include)
+            if path.isfile(path.join(media_path, filepath))
+        )
+
+    for filepath, stats in media_files:
+        output_filepath = path.join(output_media_path, filepath)
+        signature = [stats.st_size, stats.st_mtime_ns, mode]
+        found_files.add(filepath)
+
+        if force:
+            changed = True
+        elif manifest is not None:
+            changed = manifest.get(filepath) != signature
+        else:
+            changed = (
+                not path.exists(output_filepath)
+                or stats.st_mtime - path.getmtime(output_filepath) > 1
+            )
+
+        if changed:
+            copies.append((path.join(media_path, filepath), output_filepath))
+
+            if manifest is not None:
+                manifest[filepath] = signature
+
+    if manifest is not None:
+        for filepath in set(manifest) - found_files:
+            del manifest[filepath]
+
+    def copy(files):
+        source, destination = files
+        makedirs(path.dirname(destination), exist_ok=True)
+        clone_file(source, destination, mode)
+
+    with ThreadPoolExecutor(max(1, threads)) as copy_pool:
+        list(copy_pool.map(copy, copies))
+
+    return [destination for source, destination in copies]
+
+
 def set_active_navigation_items(filename, items, parents=[]):
     """
     Given a list of navigation items and a filename,
@@ -330,6 +1292,76 @@ def set_active_navigation_items(filename, items, parents=[]):
     return active_items
 
 
+def version_branch_commits(base_directory):
+    """
+    Find the commit each branch in the "versions" file points to,
+    in the same way prepare_version_branches will look for them.
+    Return None if any of the branches can't be found.
+    """
+
+    from git import Repo
+
+    base_repo = Repo(base_directory)
+    local_branches = {branch.name: branch for branch in base_repo.branches}
+    commits = {}
+
+    for name in read_versions(base_directory):
+        if name in local_branches:
+            commits[name] = local_branches[name].commit.hexsha
+            continue
+
+        for remote in base_repo.remotes:
+            for ref in remote.refs:
+                if ref.name.endswith("/" + name):
+                    commits[name] = ref.commit.hexsha
+
+        if name not in commits:
+            return None
+
+    return commits
+
+
+def version_map(version_branches, source_folder, extensions=True):
+    """
+    Map which pages exist in which version branches, finding each branch's
+    pages once, for pages to load instead of each listing every version:
+    {
+        "versions": ["latest", "1.0"],
+        "extension": ".html",
+        "pages": {"en/index": "11", "en/new-page": "10", ...}
+    }
+    Versions are in the order of the versions file, and each character
+    in a page's flags is "1" if the page exists in that version.
+    """
+
+    names = sorted(
+        version_branches, key=lambda name: version_branches[name]["order"]
+    )
+    pages = {}
+
+    for index, name in enumerate(names):
+        source_path = path.join(
+            version_branches[name]["base_directory"], source_folder
+        )
+
+        for filepath, stats in walk_files(source_path):
+            page, extension = path.splitext(filepath)
+
+            if (
+                extension != ".md" or
+                re.sub(r"\W+", "", path.basename(page)).isupper()
+            ):
+                continue
+
+            pages.setdefault(page, ["0"] * len(names))[index] = "1"
+
+    return {
+        "versions": names,
+        "extension": ".html" if extensions else "",
+        "pages": {page: "".join(flags) for page, flags in pages.items()},
+    }
+
+
 def version_paths(
     version_branches, base_directory, source_folder, relative_filepath
 ):
@@ -387,6 +1419,64 @@ def convert_path_to_html(path):
     return path
 
 
+def sitemap_location(filepath):
+    """
+    The location of a page in the sitemap, from the path to its file:
+    the path without its extension, or the folder of an index page
+    (so "en/index.md" is at "en/", and "en/reindexing.md" at "en/reindexing")
+    """
+
+    location = path.splitext(filepath)[0]
+
+    if path.basename(location) == "index":
+        location = location[:-len("index")]
+
+    return location
+
+
+def write_asset(source_filepath, output_filepath, force=False):
+    """
+    Write a copy of an asset to its content-hashed output filepath
+    (from `asset_path`), unless it's already there
+    """
+
+    if force or not path.isfile(output_filepath):
+        with open(source_filepath, "rb") as source_file:
+            content = source_file.read()
+
+        makedirs(path.dirname(output_filepath), exist_ok=True)
+        atomic_write(output_filepath, content)
+
+
+def write_change_manifest(manifest_path, changes):
+    """
+    Write out a JSON manifest of the output files added, changed or removed
+    by a build, in the format:
+    {
+        'added': [
+            {'path': 'en/index.html', 'hash': [sha256], 'size': [bytes]},
+            ...
+        ],
+        'changed': [...],
+        'removed': [...]
+    }
+    """
+
+    manifest = {
+        change_type: sorted(entries, key=lambda entry: entry["path"])
+        for change_type, entries in changes.items()
+    }
+    manifest_dir = path.dirname(manifest_path)
+
+    if manifest_dir:
+        makedirs(manifest_dir, exist_ok=True)
+
+    atomic_write(
+        manifest_path,
+        json.dumps(manifest, indent=2, sort_keys=True).encode("utf-8"),
+    )
+
+
 def write_html(html, output_filepath):
 
     """
@@ -399,7 +1489,6 @@ def write_html(html, output_filepath):
 
     makedirs(output_dir, exist_ok=True)
 
-    with open(output_filepath, mode="w", encoding="utf-8") as output_file:
-        output_file.write(html)
+    atomic_write(output_filepath, html.encode("utf-8"))
 
     return output_filepath
@@ -1,29 +1,99 @@
 # Core modules
+import hashlib
+import json
 import re
-from os import environ, listdir, makedirs, path, stat
-from shutil import copy2
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from itertools import islice
+from os import (
+    chmod,
+    environ,
+    getpid,
+    link,
+    listdir,
+    makedirs,
+    path,
+    remove,
+    replace,
+    rmdir,
+    scandir,
+    umask,
+)
+from shutil import copy2, copystat
+from threading import BoundedSemaphore, Lock
+from urllib.parse import quote, unquote
 
 
-def mergetree(src, dst, symlinks=False, ignore=None):
+# The process umask, for giving atomically written files
+# the same permissions as files created with open(),
+# read by the first call to process_umask
+_umask = None
+_umask_lock = Lock()
+
+
+def remove_file(filepath, root):
     """
-    Deep-merge two directory trees, overwriting changed files
+    Delete a file if it exists, and then any of its parent
+    directories, up to the root directory, that are left empty
     """
 
-    if not path.isdir(src):
-        raise EnvironmentError('Source tree not found: ' + src)
+    if path.isfile(filepath):
+        remove(filepath)
 
-    makedirs(dst, exist_ok=True)
-    for item in listdir(src):
-        source = path.join(src, item)
-        destination = path.join(dst, item)
-        if path.isdir(source):
-            mergetree(source, destination, symlinks, ignore)
-        else:
+    directory = path.dirname(path.abspath(filepath))
+    root = path.abspath(root)
+
+    while is_inside(directory, root) and directory != root:
+        if not path.isdir(directory) or listdir(directory):
+            break
+
+        rmdir(directory)
+        directory = path.dirname(directory)
+
+
+def is_inside(filepath, directory):
+    """
+    Check if a path is inside (or is) a directory
+    """
+
+    relative_path = path.relpath(filepath, directory)
+
+    return relative_path.split(path.sep)[0] != '..'
+
+
+def walk_files(directory, exclude=[], hidden=False):
+    """
+    Recursively find the files inside a directory, skipping any paths
+    listed in exclude, and hidden files and folders (unless hidden=True).
+    Yield (relative_path, stat_result) pairs, in a stable order
+    """
+
+    excluded = [path.abspath(excluded_path) for excluded_path in exclude]
+
+    def walk(current, relative):
+        for entry in sorted(scandir(current), key=lambda entry: entry.name):
             if (
-                not path.exists(destination) or
-                stat(source).st_mtime - stat(destination).st_mtime > 1
+                (entry.name.startswith('.') and not hidden) or
+                path.abspath(entry.path) in excluded
             ):
-                copy2(source, destination)
+                continue
+
+            entry_path = path.join(relative, entry.name)
+
+            if entry.is_dir():
+                yield from walk(entry.path, entry_path)
+            elif entry.is_file():
+                yield (entry_path, entry.stat())
+
+    if path.isdir(directory):
+        yield from walk(directory, '')
 
 
 def relativize(location, original_base_path, new_base_path):
@@ -40,16 +110,91 @@ def relativize(location, original_base_path, new_base_path):
     return path.relpath(abs_location, abs_dirpath)
 
 
-def replace_link_paths(html, old_link_path, new_link_path):
+def replace_link_paths(
+    html, old_link_path, new_link_path, links=None, filenames=None
+):
     """
-    In some HTML text, replace old link paths with a new path
+    In some HTML text, replace old link paths with a new path.
+    If a `links` set is provided, the rest of each replaced link
+    (the path after the old link path) is added to it.
+    If a `filenames` dictionary is provided, the rest of each link
+    is also replaced with its new filename from the dictionary.
     """
 
     link_search = r'((?<=src=["\'])|(?<=href=["\'])){}(?=/)'.format(
         old_link_path.replace('.', '\.')
     )
 
-    return re.sub(link_search, new_link_path, html)
+    if links is None and filenames is None:
+        return re.sub(link_search, new_link_path, html)
+
+    def replace_link(match):
+        link = match.group(2)
+        filepath = unquote(link)
+
+        if links is not None:
+            links.add(filepath)
+
+        if filenames and filepath in filenames:
+            link = quote(filenames[filepath])
+
+        return new_link_path + '/' + link
+
+    return re.sub(link_search + r'/([^"\'?#]*)', replace_link, html)
+
+
+def responsive_image_tags(html, old_link_path, new_link_path, images):
+    """
+    In some HTML text, add srcset, sizes, width, height and loading
+    attributes to <img> tags linking to images under old_link_path,
+    and wrap them in a <picture> with a WebP <source>,
+    from the `images` dictionary (keyed by path after old_link_path).
+    Attributes the tag already has are left alone.
+    """
+
+    src_search = re.compile(
+        r'\ssrc=(["\']){}/([^"\'?#]*)\1'.format(re.escape(old_link_path))
+    )
+
+    def candidates(sources):
+        return ', '.join(
+            '{}/{} {}w'.format(new_link_path, quote(filename), width)
+            for filename, width in sources
+        )
+
+    def replace_image(match):
+        tag = match.group(0)
+        src = src_search.search(tag)
+        image = images.get(unquote(src.group(2))) if src else None
+
+        if not image:
+            return tag
+
+        sizes = '(max-width: {0}px) 100vw, {0}px'.format(image['width'])
+        attributes = [
+            ('width', image['width']),
+            ('height', image['height']),
+            ('loading', 'lazy'),
+            ('srcset', candidates(image['srcset'])),
+            ('sizes', sizes),
+        ]
+        new_attributes = ''.join(
+            ' {}="{}"'.format(name, value)
+            for name, value in attributes
+            if not re.search(r'\s{}='.format(name), tag)
+        )
+        end = '/>' if tag.endswith('/>') else '>'
+        tag = tag[:-len(end)].rstrip() + new_attributes + ' ' + end
+
+        if image.get('webp'):
+            tag = (
+                '<picture><source type="image/webp" srcset="{}" '
+                'sizes="{}" />{}</picture>'
+            ).format(candidates(image['webp']), sizes, tag)
+
+        return tag
+
+    return re.sub(r'<img\b[^>]*>', replace_image, html)
 
 
 def matching_metadata(metadata_items, context_path):
@@ -89,3 +234,447 @@ def cache_dir(name):
         makedirs(named_cache)
 
     return named_cache
+
+
+def read_file(filepath):
+    """
+    Read the whole of a UTF-8 text file
+    """
+
+    with open(filepath, encoding="utf-8") as text_file:
+        return text_file.read()
+
+
+def content_hash(content):
+    """
+    A hex digest identifying some bytes of content
+    """
+
+    return hashlib.sha256(content).hexdigest()
+
+
+def file_hash(filepath):
+    """
+    A hex digest identifying the content of a file
+    """
+
+    digest = hashlib.sha256()
+
+    with open(filepath, 'rb') as hash_file:
+        for block in iter(lambda: hash_file.read(1024 * 1024), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def blob_hash(filepath):
+    """
+    The git blob hash of a file's content (as `git hash-object` would give),
+    so hashes can also be read from git without reading the file
+    """
+
+    digest = hashlib.sha1(
+        'blob {}\0'.format(path.getsize(filepath)).encode('utf-8')
+    )
+
+    with open(filepath, 'rb') as hash_file:
+        for block in iter(lambda: hash_file.read(1024 * 1024), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def process_umask():
+    """
+    The process umask, read once and then remembered.
+    Where Linux's /proc is available it's read from there. Otherwise,
+    reading it means briefly setting it to 0, while other threads could be
+    creating files, so it should first be called before starting any.
+    """
+
+    global _umask
+
+    with _umask_lock:
+        if _umask is None:
+            try:
+                with open('/proc/self/status') as status_file:
+                    _umask = int(
+                        re.search(
+                            r'^Umask:\s*([0-7]+)$',
+                            status_file.read(),
+                            re.MULTILINE
+                        ).group(1),
+                        8
+                    )
+            except (OSError, AttributeError):
+                _umask = umask(0)
+                umask(_umask)
+
+    return _umask
+
+
+def atomic_write(filepath, content):
+    """
+    Write bytes to a file through a temporary file in the same directory,
+    which is then renamed over the destination, so readers
+    never see a partially written file
+    """
+
+    file_descriptor, temporary_path = tempfile.mkstemp(
+        dir=path.dirname(filepath) or '.',
+        prefix='.' + path.basename(filepath) + '.',
+        suffix='.tmp'
+    )
+
+    try:
+        with open(file_descriptor, 'wb') as temporary_file:
+            temporary_file.write(content)
+        chmod(temporary_path, 0o666 & ~process_umask())
+        replace(temporary_path, filepath)
+    except BaseException:
+        if path.exists(temporary_path):
+            remove(temporary_path)
+        raise
+
+
+def clone_file(source, destination, mode='copy'):
+    """
+    Copy a file to a destination, replacing any existing file atomically.
+
+    With mode='hardlink' the destination is linked to the same data as the
+    source, and with mode='reflink' it's a copy-on-write clone of it
+    (on Linux filesystems which support it, like Btrfs and XFS).
+    Both fall back to a normal copy where they aren't possible.
+    """
+
+    if (
+        mode == 'hardlink' and
+        path.exists(destination) and
+        path.samefile(source, destination)
+    ):
+        return
+
+    temporary_path = path.join(
+        path.dirname(destination),
+        '.{}.{}.tmp'.format(path.basename(destination), uuid.uuid4().hex)
+    )
+
+    try:
+        if mode == 'hardlink':
+            try:
+                link(source, temporary_path)
+            except OSError:
+                copy2(source, temporary_path)
+        elif mode == 'reflink' and _reflink(source, temporary_path):
+            copystat(source, temporary_path)
+        else:
+            copy2(source, temporary_path)
+
+        replace(temporary_path, destination)
+    finally:
+        if path.lexists(temporary_path):
+            remove(temporary_path)
+
+
+def _reflink(source, destination):
+    """
+    Try to create a copy-on-write clone of a file with the Linux FICLONE ioctl
+    """
+
+    try:
+        import fcntl
+    except ImportError:
+        return False
+
+    ficlone = 0x40049409
+
+    with open(source, 'rb') as source_file:
+        with open(destination, 'wb') as destination_file:
+            try:
+                fcntl.ioctl(
+                    destination_file.fileno(), ficlone, source_file.fileno()
+                )
+                return True
+            except OSError:
+                pass
+
+    remove(destination)
+
+    return False
+
+
+def read_ahead(executor, function, items, depth):
+    """
+    Map a function over items using an executor, keeping up to `depth`
+    calls running ahead of the consumer.
+    Yield (item, result) pairs in the original order.
+    """
+
+    items = iter(items)
+    pending = deque(
+        (item, executor.submit(function, item))
+        for item in islice(items, depth)
+    )
+
+    while pending:
+        item, future = pending.popleft()
+
+        for next_item in islice(items, 1):
+            pending.append((next_item, executor.submit(function, next_item)))
+
+        yield (item, future.result())
+
+
+class BoundedExecutor():
+    """
+    A thread pool which blocks new submissions while `bound` tasks
+    are already queued or running, so a fast producer can't build up
+    an unlimited backlog of work (and memory) behind slow workers
+    """
+
+    def __init__(self, max_workers, bound):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._semaphore = BoundedSemaphore(bound)
+
+    def submit(self, function, *args, **kwargs):
+        self._semaphore.acquire()
+
+        try:
+            future = self._executor.submit(function, *args, **kwargs)
+        except Exception:
+            self._semaphore.release()
+            raise
+
+        future.add_done_callback(lambda _: self._semaphore.release())
+
+        return future
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception_info):
+        self.shutdown(wait=True)
+
+
+class Tracer():
+    """
+    Record spans of time spent on each part of the work,
+    on whichever thread it runs on, to save as Chrome trace-event JSON
+    (which chrome://tracing and https://ui.perfetto.dev can open).
+    A Tracer which isn't enabled records nothing.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.events = []
+        self._start = time.perf_counter()
+        self._threads = {}
+
+    @contextmanager
+    def span(self, name, category='build', **args):
+        """
+        Record the time spent in a with block
+        """
+
+        if not self.enabled:
+            yield
+            return
+
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.add(name, start, time.perf_counter(), category, args)
+
+    def wrap(self, name, function, category='build', **args):
+        """
+        Wrap a function (e.g. to run on another thread)
+        so each call is recorded as a span
+        """
+
+        def traced(*function_args, **function_kwargs):
+            with self.span(name, category, **args):
+                return function(*function_args, **function_kwargs)
+
+        return traced if self.enabled else function
+
+    def iterate(self, name, items, category='wait'):
+        """
+        Iterate over items, recording the time spent waiting for each one
+        (e.g. from a read-ahead queue)
+        """
+
+        items = iter(items)
+
+        while True:
+            with self.span(name, category):
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+
+            yield item
+
+    def add(self, name, start, end, category='build', args={}):
+        """
+        Record a span between two time.perf_counter() times
+        """
+
+        thread = threading.current_thread()
+        self._threads[thread.ident] = thread.name
+        event = {
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': round((start - self._start) * 1000000, 1),
+            'dur': round((end - start) * 1000000, 1),
+            'pid': getpid(),
+            'tid': thread.ident,
+        }
+
+        if args:
+            event['args'] = args
+
+        # list.append is atomic, so threads can record spans at once
+        self.events.append(event)
+
+    def save(self, filepath):
+        """
+        Write the recorded spans, and the names of the threads
+        they ran on, to a trace-event JSON file
+        """
+
+        thread_names = [
+            {
+                'name': 'thread_name',
+                'ph': 'M',
+                'pid': getpid(),
+                'tid': ident,
+                'args': {'name': name},
+            }
+            for ident, name in self._threads.items()
+        ]
+
+        atomic_write(
+            filepath,
+            json.dumps(
+                {
+                    'traceEvents': thread_names + self.events,
+                    'displayTimeUnit': 'ms',
+                }
+            ).encode('utf-8')
+        )
+
+
+class MemoryProfiler():
+    """
+    Record the memory used by each stage of the work:
+    the peak and retained size of Python allocations (from tracemalloc),
+    the process's peak resident set size so far,
+    and the call sites which allocated the most memory the stage kept.
+    Stages can't be nested.
+    """
+
+    def __init__(self, frames=1, sites=3):
+        self.stages = []
+        self.sites = sites
+        tracemalloc.start(frames)
+
+    @contextmanager
+    def stage(self, name, **args):
+        """
+        Profile the memory allocated in a with block
+        """
+
+        start_snapshot = self._snapshot()
+        start_size, start_peak = tracemalloc.get_traced_memory()
+
+        # Only Python 3.9 and later can reset the peak
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+            start_peak = 0
+
+        try:
+            yield
+        finally:
+            size, peak = tracemalloc.get_traced_memory()
+
+            # A peak no higher than before the stage wasn't reached in it,
+            # so the most the stage is known to have held is what it kept
+            if peak <= start_peak:
+                peak = max(size, start_size)
+
+            statistics = self._snapshot().compare_to(
+                start_snapshot, 'lineno'
+            )
+            self.stages.append(
+                {
+                    'name': name,
+                    'args': args,
+                    'peak': peak - start_size,
+                    'retained': size - start_size,
+                    'peak_rss': peak_rss(),
+                    'sites': [
+                        {
+                            'site': '{}:{}'.format(
+                                statistic.traceback[0].filename,
+                                statistic.traceback[0].lineno
+                            ),
+                            'size': statistic.size_diff,
+                            'count': statistic.count_diff,
+                        }
+                        for statistic in statistics[:self.sites]
+                        if statistic.size_diff > 0
+                    ],
+                }
+            )
+
+    def top_sites(self, limit=10):
+        """
+        The call sites which allocated the most memory kept by any stage,
+        with the stage they were in
+        """
+
+        sites = [
+            dict(site, stage=stage)
+            for stage in self.stages
+            for site in stage['sites']
+        ]
+
+        return sorted(
+            sites, key=lambda site: site['size'], reverse=True
+        )[:limit]
+
+    def stop(self):
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def _snapshot(self):
+        # Leave out the memory tracemalloc itself uses
+        return tracemalloc.take_snapshot().filter_traces(
+            [
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            ]
+        )
+
+
+def peak_rss():
+    """
+    The most memory the process has had resident so far, in bytes,
+    or None where it can't be measured
+    """
+
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024